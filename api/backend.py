@@ -1,56 +1,89 @@
-import os, time
+import os, time, json, hashlib, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from collections import Counter
-from .utils import abbreviate_book_name_in_full_reference, get_train_test_split_from_verse_list, embed_batch
+from .utils import abbreviate_book_name_in_full_reference, get_train_test_split_from_verse_list, embed_batch, lazy_resources, LazyResource, count_tokens, get_embedding_stats
 from .types import TranslationTriplet, ChatResponse, VerseMap, AIResponse
+from .corpus import corpus_store, VerseIndex
+from . import vector_index
+from .ngrams import NgramIndex
+from .vocabulary import Vocabulary
+from .llm_client import LLMClient, LLM_SEED
+from .llm_cache import LLMResponseCache, LLM_CACHE_ENABLED
 from pydantic import BaseModel, Field
 from typing import Any, List, Optional, Callable
-from random import shuffle
-import requests
-import guidance
-import lancedb
-from lancedb.embeddings import with_embeddings
-from nltk.util import ngrams
-from nltk import FreqDist 
+from random import Random
 
 import logging
 logger = logging.getLogger('uvicorn')
 
 machine = 'http://192.168.1.76:8081'
+llm_client = LLMClient(base_url=machine, cache=LLMResponseCache() if LLM_CACHE_ENABLED else None)
 
-def get_dataframes(target_language_code=None, file_suffix=None):
-    """Get source data dataframes (literalistic english Bible and macula Greek/Hebrew)"""
-    bsb_bible_df = pd.read_csv('data/bsb-utf8.txt', sep='\t', names=['vref', 'content'], header=0)
+# Token budget of a translation prompt: the local model's context, part of which is kept free for the generated translation
+TRANSLATION_CONTEXT_TOKENS = int(os.environ.get('TRANSLATION_CONTEXT_TOKENS', 4096))
+TRANSLATION_OUTPUT_TOKENS = int(os.environ.get('TRANSLATION_OUTPUT_TOKENS', 512))
+TRANSLATION_CANDIDATE_FACTOR = int(os.environ.get('TRANSLATION_CANDIDATE_FACTOR', 3)) # neighbors fetched per example, to choose from
+# Concurrent ANN searches for a batch query against an indexed table (LanceDB searches one vector at a time)
+QUERY_BATCH_SEARCH_THREADS = int(os.environ.get('QUERY_BATCH_SEARCH_THREADS', 8))
+
+BSB_PATH = 'data/bsb-utf8.txt'
+MACULA_PATH = 'data/combined_greek_hebrew_vref.csv' # Note: csv wrangled in notebook: `create-combined-macula-df.ipynb`
+VREF_PATH = 'data/vref.txt'
+DATABASE_PATH = './lancedb'
+
+def load_bsb_df():
+    bsb_bible_df = pd.read_csv(BSB_PATH, sep='\t', names=['vref', 'content'], header=0)
     bsb_bible_df['vref'] = bsb_bible_df['vref'].apply(abbreviate_book_name_in_full_reference)
-    macula_df = pd.read_csv('data/combined_greek_hebrew_vref.csv') # Note: csv wrangled in notebook: `create-combined-macula-df.ipynb`
+    return bsb_bible_df
+
+def load_macula_df():
+    return pd.read_csv(MACULA_PATH)
+
+def get_dataframes(target_language_code=None, file_suffix=None):
+    """
+    Get source data dataframes (literalistic english Bible and macula Greek/Hebrew)
+    
+    Dataframes are loaded once per process and cached in `corpus_store`, so don't modify them in place.
+    """
+    bsb_bible_df = corpus_store.get('bsb_bible', [BSB_PATH], load_bsb_df, pinned=True)
+    macula_df = corpus_store.get('macula', [MACULA_PATH], load_macula_df, pinned=True)
     
     if target_language_code:
-        target_tsv = get_target_vref_df(target_language_code, file_suffix=file_suffix)
         target_df = get_target_vref_df(target_language_code, file_suffix=file_suffix)
         return bsb_bible_df, macula_df, target_df
 
     else:
         return bsb_bible_df, macula_df
 
-def get_vref_list(book_abbreviation=None):
+def load_vref_list():
     vref_url = 'https://raw.githubusercontent.com/BibleNLP/ebible/main/metadata/vref.txt'
-    if not os.path.exists('data/vref.txt'):
-        os.system(f'wget {vref_url} -O data/vref.txt')
+    if not os.path.exists(VREF_PATH):
+        os.system(f'wget {vref_url} -O {VREF_PATH}')
 
-    with open('data/vref.txt', 'r', encoding="utf8") as f:
-        
-        if book_abbreviation:
-            return [i.strip() for i in f.readlines() if i.startswith(book_abbreviation)]
-        
-        else:
-            return list(set([i.strip().split(' ')[0] for i in f.readlines()]))
+    with open(VREF_PATH, 'r', encoding="utf8") as f:
+        return [i.strip() for i in f.readlines()]
 
-def get_target_vref_df(language_code, file_suffix=None, drop_empty_verses=False):
-    """Get target language data by language code"""
-    if not len(language_code) == 3:
-        return 'Invalid language code. Please use 3-letter ISO 639-3 language code.'
+def get_vref_ordinals() -> dict[str, int]:
+    """Map each vref to its line number in the canonical vref.txt"""
+    def load_vref_ordinals():
+        ordinals = {}
+        for i, vref in enumerate(load_vref_list()):
+            ordinals.setdefault(vref, i)
+        return ordinals
+    return corpus_store.get('vref_ordinals', [VREF_PATH], load_vref_ordinals, pinned=True)
+
+def get_vref_list(book_abbreviation=None):
+    vref_list = list(get_vref_ordinals().keys())
+        
+    if book_abbreviation:
+        return [i for i in vref_list if i.startswith(book_abbreviation)]
     
+    else:
+        return list(set([i.split(' ')[0] for i in vref_list]))
+
+def get_target_vref_path(language_code, file_suffix=None):
+    """Get the local path of the target language data file, downloading it from the ebible corpus if needed"""
     language_code = language_code.lower().strip()
     
     language_code = f'{language_code}-{language_code}'
@@ -65,36 +98,175 @@ def get_target_vref_df(language_code, file_suffix=None, drop_empty_verses=False)
         try:
             os.system(f'wget {target_data_url} -O {path}')
         except:
-            return 'No data found for language code. Please check the eBible repo for available data.'
+            return None
+
+    return path
 
+def load_target_vref_df(path):
     with open(path, 'r', encoding="utf8") as f:
         target_text = f.readlines()
         target_text = [i.strip() for i in target_text]
 
     vref_url = 'https://raw.githubusercontent.com/BibleNLP/ebible/main/metadata/vref.txt'
-    if not os.path.exists('data/vref.txt'):
-        os.system(f'wget {vref_url} -O data/vref.txt')
+    if not os.path.exists(VREF_PATH):
+        os.system(f'wget {vref_url} -O {VREF_PATH}')
 
-    with open('data/vref.txt', 'r', encoding="utf8") as f:
+    with open(VREF_PATH, 'r', encoding="utf8") as f:
         target_vref = f.readlines()
         target_vref = [i.strip() for i in target_vref]
 
     target_tsv = [i for i in list(zip(target_vref, target_text))]
     
-    if drop_empty_verses:
-        target_tsv = [i for i in target_tsv if i[1] != '']
+    return pd.DataFrame(target_tsv, columns=['vref', 'content'])
+
+def get_target_vref_df(language_code, file_suffix=None, drop_empty_verses=False):
+    """Get target language data by language code (cached per process, see `get_dataframes`)"""
+    if not len(language_code) == 3:
+        return 'Invalid language code. Please use 3-letter ISO 639-3 language code.'
+    
+    path = get_target_vref_path(language_code, file_suffix=file_suffix)
+    if path is None:
+        return 'No data found for language code. Please check the eBible repo for available data.'
     
-    target_df = pd.DataFrame(target_tsv, columns=['vref', 'content'])
+    target_df = corpus_store.get(path, [path, VREF_PATH], lambda: load_target_vref_df(path))
+    
+    if drop_empty_verses:
+        target_df = target_df[target_df['content'] != '']
     
     return target_df
 
+def get_verse_index_key(language_code: str, file_suffix=None) -> Optional[str]:
+    """The `corpus_store` key of a corpus' verse index"""
+    if language_code == 'bsb' or language_code == 'bsb_bible':
+        return 'bsb_bible:index'
+    elif language_code == 'macula':
+        return 'macula:index'
+    path = get_target_vref_path(language_code, file_suffix=file_suffix)
+    return f'{path}:index' if path is not None else None
+
+def get_verse_index(language_code: str, file_suffix=None) -> Optional[VerseIndex]:
+    """
+    Get the vref index for a corpus ('bsb'/'bsb_bible', 'macula' or a target language code).
+    Indexes are built once and cached alongside the corpus dataframes.
+    """
+    if language_code == 'bsb' or language_code == 'bsb_bible':
+        return corpus_store.get('bsb_bible:index', [BSB_PATH, VREF_PATH], lambda: VerseIndex(get_dataframes()[0], get_vref_ordinals()), pinned=True)
+    elif language_code == 'macula':
+        return corpus_store.get('macula:index', [MACULA_PATH, VREF_PATH], lambda: VerseIndex(get_dataframes()[1], get_vref_ordinals()), pinned=True)
+    
+    target_df = get_target_vref_df(language_code, file_suffix=file_suffix)
+    if isinstance(target_df, str):
+        logger.error(target_df)
+        return None
+    path = get_target_vref_path(language_code, file_suffix=file_suffix)
+    return corpus_store.get(get_verse_index_key(language_code, file_suffix), [path, VREF_PATH], lambda: VerseIndex(target_df, get_vref_ordinals()))
+
+def join_bible_triplets(language_code: str, file_suffix=None) -> Optional[pd.DataFrame]:
+    """
+    Align the BSB, Macula and target corpora on vref in a single pass.
+    
+    Returns one row per BSB verse (in BSB order) with the columns
+    vref, {bsb,macula,target}_verse_number and {bsb,macula,target}_content.
+    Macula/target columns are NaN where that corpus has no matching verse.
+    The joined frame is cached alongside the corpora it was built from.
+    """
+    target_df = get_target_vref_df(language_code, file_suffix=file_suffix)
+    if isinstance(target_df, str):
+        logger.error(target_df)
+        return None
+    path = get_target_vref_path(language_code, file_suffix=file_suffix)
+    
+    def load_joined_df():
+        bsb_bible_df, macula_df = get_dataframes()
+        joined_df = bsb_bible_df[['vref', 'content']].rename_axis('bsb_verse_number').reset_index().rename(columns={'content': 'bsb_content'})
+        for name, df in [('macula', macula_df), ('target', target_df)]:
+            right_df = df[['vref', 'content']].rename_axis(f'{name}_verse_number').reset_index()
+            right_df = right_df.drop_duplicates('vref', keep='first').rename(columns={'content': f'{name}_content'}) # first match wins, as with get_verse_triplet
+            joined_df = joined_df.merge(right_df, on='vref', how='left')
+        return joined_df
+    
+    return corpus_store.get(f'{path}:joined', [BSB_PATH, MACULA_PATH, path, VREF_PATH], load_joined_df)
+
+def iter_verse_triplets(language_code: str, file_suffix=None, complete_only=True):
+    """
+    Yield (vref, triplet) for the whole Bible from the joined corpora, in BSB order.
+    
+    Triplets have the same shape as `get_verse_triplet`. With complete_only (the default),
+    verses missing from any of the three corpora are skipped, as `get_verse_triplet` would return None for them.
+    """
+    joined_df = join_bible_triplets(language_code, file_suffix=file_suffix)
+    if joined_df is None:
+        return
+    
+    for row in joined_df.itertuples(index=False):
+        triplet = {}
+        for name in ['bsb', 'macula', 'target']:
+            verse_number = getattr(row, f'{name}_verse_number')
+            if pd.isna(verse_number):
+                triplet[name] = None
+            else:
+                triplet[name] = {
+                    'verse_number': int(verse_number),
+                    'vref': row.vref,
+                    'content': getattr(row, f'{name}_content')
+                }
+        if complete_only and not all(triplet.values()):
+            continue
+        yield row.vref, triplet
+
+def iter_bible_books(language_code: str, file_suffix=None, book: Optional[str] = None, start_vref: Optional[str] = None):
+    """
+    Yield (book, records) for the Bible one book at a time, in BSB order, as {vref, bsb, macula, target} records
+    (missing verses have empty vref and content). With `book`, only that book is yielded; with `start_vref`,
+    records start at that verse.
+    
+    Macula and target verses are looked up through the verse indexes rather than the joined frame, so the
+    first book is ready without joining the whole Bible. Yields nothing if the target corpus can't be loaded.
+    """
+    bsb_index, macula_index = get_verse_index('bsb'), get_verse_index('macula')
+    target_index = get_verse_index(language_code, file_suffix=file_suffix)
+    if target_index is None:
+        return
+    
+    empty_verse = {'vref': '', 'content': ''}
+    def get_record(vref, content):
+        record = {'vref': vref, 'bsb': {'vref': vref, 'content': content}}
+        for name, index in [('macula', macula_index), ('target', target_index)]:
+            verse = index.get(vref)
+            record[name] = {'vref': verse['vref'], 'content': verse['content']} if verse else empty_verse
+        return record
+    
+    started = start_vref is None
+    current_book, records = None, []
+    for vref, content in zip(bsb_index.vrefs, bsb_index.contents):
+        if not started:
+            started = vref == start_vref
+            if not started:
+                continue
+        verse_book = vref.split(' ')[0]
+        if book and verse_book != book:
+            if current_book == book: # a book's verses are contiguous, so we're done
+                break
+            continue
+        if verse_book != current_book:
+            if records:
+                yield current_book, records
+            current_book, records = verse_book, []
+        records.append(get_record(vref, content))
+    if records:
+        yield current_book, records
+
+def iter_bible_verses(language_code: str, file_suffix=None, book: Optional[str] = None, start_vref: Optional[str] = None):
+    """Yield the Bible as {vref, bsb, macula, target} records, see `iter_bible_books`"""
+    for _, records in iter_bible_books(language_code, file_suffix=file_suffix, book=book, start_vref=start_vref):
+        yield from records
+
 from pandas import DataFrame as DataFrameClass
 
 def create_lancedb_table_from_df(df: DataFrameClass, table_name, content_column_name='content'):
     """Turn a pandas dataframe into a LanceDB table."""
     start_time = time.time()
     logger.info('Creating LanceDB table...')
-    import lancedb
     from lancedb.embeddings import with_embeddings
     
     logger.error(f'Creating LanceDB table: {table_name}, {df.head}')
@@ -108,16 +280,11 @@ def create_lancedb_table_from_df(df: DataFrameClass, table_name, content_column_
     # Add target_language_code to the dataframe
     df['language_code'] = table_name
     
-    # mkdir lancedb if it doesn't exist
-    if not os.path.exists('./lancedb'):
-        os.mkdir('./lancedb')
-    
-    # Connect to LanceDB
-    db = lancedb.connect("./lancedb")
+    db = get_database()
     
     table = get_table_from_database(table_name)
     
-    if not table:
+    if table is None:
         # If it doesn't exist, create it
         df_filtered = df[df['text'].str.strip() != '']
         # data = with_embeddings(embed_batch, df_filtered.sample(1000)) # FIXME: I can't process the entirety of the bsb bible for some reason. Something is corrupt or malformed in the data perhaps
@@ -130,12 +297,19 @@ def create_lancedb_table_from_df(df: DataFrameClass, table_name, content_column_
             data=data,
             mode="create",
         )
+        vector_index.build_vector_index(table_name, table)
     else:
         # If it exists, append to it
         df_filtered = df[df['text'].str.strip() != '']
         data = with_embeddings(embed_batch, df_filtered.sample(10000))
         data = data.fillna(0)  # Fill missing values with 0
         table.append(data)
+        vector_index.record_append(table_name, table, len(data), lambda: get_table_from_database(table_name))
+    
+    # Other handles to this table may not see the new data, so drop them and cache the fresh one
+    invalidate_table_cache(table_name)
+    with table_cache_lock:
+        table_cache[table_name] = table
     
     print('LanceDB table created. Time elapsed: ', time.time() - start_time, 'seconds.')
     return table  
@@ -166,23 +340,74 @@ def load_database(target_language_code=None, file_suffix=None):
     print('Database populated.')
     return True
     
+def connect_to_database():
+    import lancedb
+    # mkdir lancedb if it doesn't exist
+    if not os.path.exists(DATABASE_PATH):
+        os.mkdir(DATABASE_PATH)
+    return lancedb.connect(DATABASE_PATH)
+
+# One connection per process, plus a cache of open table handles (see `get_table_from_database`)
+database_connection = LazyResource('lancedb', connect_to_database)
+table_cache: dict[str, Any] = {}
+table_cache_lock = threading.Lock()
+
+def get_database():
+    """Get the process-wide LanceDB connection"""
+    return database_connection.get()
+
+def invalidate_table_cache(table_name: Optional[str] = None):
+    """Forget cached table handles (all of them if no table_name), e.g., after a table is created or appended to"""
+    with table_cache_lock:
+        if table_name is None:
+            table_cache.clear()
+        else:
+            table_cache.pop(table_name, None)
+    for entry in corpus_store.info()['entries']:
+        if entry['key'].startswith('lancedb:') and table_name in (None, entry['key'][len('lancedb:'):]):
+            corpus_store.invalidate(entry['key'])
+
 def get_table_from_database(table_name):
     """
     Returns a table by name. 
     Use '/api/db_info' endpoint to see available tables.
+    
+    Open tables are cached, so the connect/list/open cost is only paid on first use.
     """
-    import lancedb
-    db = lancedb.connect("./lancedb")
-    table_names = db.table_names()
-    if table_name not in table_names:
-        logger.error(f'''Table {table_name} not found. Please check the table name and try again.
-                     Available tables: {table_names}''')
-        return None
+    table = table_cache.get(table_name)
+    if table is not None:
+        return table
+    
+    db = get_database()
+    with table_cache_lock:
+        if table_name in table_cache:
+            return table_cache[table_name]
+        table_names = db.table_names()
+        if table_name not in table_names:
+            logger.error(f'''Table {table_name} not found. Please check the table name and try again.
+                         Available tables: {table_names}''')
+            return None
 
-    table = db.open_table(table_name)
+        table = db.open_table(table_name)
+        table_cache[table_name] = table
+    vector_index.get_index_state(table_name, table) # picks up an existing ANN index
     return table
 
-def get_verse_triplet(full_verse_ref: str, language_code: str, bsb_bible_df, macula_df):
+def build_vector_index(table_name: str, force=False):
+    """Build the ANN (IVF-PQ) index for a table. Tables below VECTOR_INDEX_MIN_ROWS are only indexed with `force`."""
+    table = get_table_from_database(table_name)
+    if table is None:
+        return {'error': 'table not found'}
+    return vector_index.build_vector_index(table_name, table, force=force)
+
+def get_vector_index_report(table_name: str, num_queries=50, k=10):
+    """Recall vs latency of the ANN index compared to exact search, see `vector_index.evaluate_vector_index`"""
+    table = get_table_from_database(table_name)
+    if table is None:
+        return {'error': 'table not found'}
+    return vector_index.evaluate_vector_index(table_name, table, num_queries=num_queries, k=k)
+
+def get_verse_triplet(full_verse_ref: str, language_code: str, bsb_bible_df=None, macula_df=None):
     """
     Get verse from bsb_bible_df, 
     AND macula_df (greek and hebrew)
@@ -190,73 +415,211 @@ def get_verse_triplet(full_verse_ref: str, language_code: str, bsb_bible_df, mac
     
     e.g., http://localhost:3000/api/verse/GEN%202:19&aai
     or NT: http://localhost:3000/api/verse/ROM%202:19&aai
+    
+    NOTE: lookups go through the cached vref indexes, so bsb_bible_df and macula_df are
+    only kept as arguments for backwards compatibility.
     """
+    bsb_index = get_verse_index('bsb_bible')
+    macula_index = get_verse_index('macula')
+    target_index = get_verse_index(language_code)
     
-    bsb_row = bsb_bible_df[bsb_bible_df['vref'] == full_verse_ref]
-    macula_row = macula_df[macula_df['vref'] == full_verse_ref]
-    target_df = get_target_vref_df(language_code)
-    target_row = target_df[target_df['vref'] == full_verse_ref]
+    bsb_verse = bsb_index.get(full_verse_ref)
+    macula_verse = macula_index.get(full_verse_ref)
+    target_verse = target_index.get(full_verse_ref) if target_index is not None else None
     
-    if not bsb_row.empty and not macula_row.empty:
+    if bsb_verse and macula_verse and target_verse:
         return {
-            'bsb': {
-                'verse_number': int(bsb_row.index[0]),
-                'vref': bsb_row['vref'][bsb_row.index[0]],
-                'content': bsb_row['content'][bsb_row.index[0]]
-            },
-            'macula': {
-                'verse_number': int(macula_row.index[0]),
-                'vref': macula_row['vref'][macula_row.index[0]],
-                'content': macula_row['content'][macula_row.index[0]]
-            },
-            'target': {
-                'verse_number': int(target_row.index[0]),
-                'vref': target_row['vref'][target_row.index[0]],
-                'content': target_row['content'][target_row.index[0]]
-            }
+            'bsb': bsb_verse,
+            'macula': macula_verse,
+            'target': target_verse
         }
     else:
         return None
 
 def query_lancedb_table(language_code: str, query: str, limit: str='50'):
-    """Get similar sentences from a LanceDB table."""
-    # limit = int(limit) # I don't know if this is necessary. The FastAPI endpoint might infer an int from the query param if I typed it that way
+    """
+    Get similar sentences from a LanceDB table.
+    
+    Only the `text` and `vref` columns (plus the `_distance` score) are read, straight from Arrow,
+    so the vector column and the rest of the row never get materialized.
+    """
     table = get_table_from_database(language_code)
-    query_vector = embed_batch([query])[0]
-    if not table:
+    if table is None:
         return {'error':'table not found'}
-    result = table.search(query_vector).limit(limit).to_df().to_dict()
-    if not result.values():
+    query_vector = embed_batch([query])[0]
+    result = (
+        vector_index.apply_search_params(language_code, table.search(query_vector))
+        .limit(int(limit))
+        .select(['text', 'vref'])
+        .to_arrow()
+    )
+    texts = result['text'].to_pylist()
+    vrefs = result['vref'].to_pylist()
+    scores = result['_distance'].to_pylist()
+    
+    return [
+        {'text': text, 'vref': vref, 'score': score}
+        for text, vref, score in zip(texts, vrefs, scores)
+    ]
+    
+class TableMatrix():
+    """The vectors, texts and vrefs of a (small, unindexed) table, held in memory for vectorized batch search"""
+    
+    def __init__(self, arrow_table):
+        self.vectors = vector_index.get_table_vectors(arrow_table)
+        self.squared_norms = (self.vectors ** 2).sum(axis=1)
+        self.texts = arrow_table['text'].to_pylist()
+        self.vrefs = arrow_table['vref'].to_pylist()
+        self.nbytes = self.vectors.nbytes + self.squared_norms.nbytes + sum(len(text or '') for text in self.texts) * 2
+
+def get_table_matrix(table_name: str) -> Optional[TableMatrix]:
+    """
+    In-memory copy of a table for batch search. Kept in `corpus_store`, so it counts against
+    CORPUS_MEMORY_BUDGET_MB and is evicted least-recently-used like the target corpora.
+    """
+    table = get_table_from_database(table_name)
+    if table is None:
+        return None
+    return corpus_store.get(f'lancedb:{table_name}', [], lambda: TableMatrix(table.to_arrow()))
+
+def query_lancedb_table_batch(
+        language_code: str, 
+        queries: Optional[list[str]] = None, 
+        vrefs: Optional[list[str]] = None, 
+        limit: int = 10, 
+        exclude_self: bool = True, 
+        target_language_code: Optional[str] = None, 
+        drop_empty_targets: bool = False, 
+        chunk_size: int = 256):
+    """
+    Get similar sentences for many queries at once.
+    
+    Params:
+    - language_code (str): table to search
+    - queries (list[str]): query texts
+    - vrefs (list[str]): verses to use as queries (their text is looked up in the `language_code` corpus)
+    - limit (int): neighbors per query
+    - exclude_self (bool): drop a vref query's own verse from its neighbors
+    - target_language_code (str) + drop_empty_targets (bool): drop neighbors that have no target language text yet
+    
+    All queries are embedded in one batch. Smaller, unindexed tables are then searched in one vectorized
+    (exact L2) pass over their vectors held in memory (see `get_table_matrix`), `chunk_size` queries at a time.
+    
+    NOTE: LanceDB (0.3) only searches one vector at a time, so tables with an ANN index are still searched
+    once per query; those searches run on QUERY_BATCH_SEARCH_THREADS threads, which saves wall time but
+    not work. Only the embedding and the HTTP round trips are batched for them.
+    """
+    table = get_table_from_database(language_code)
+    if table is None:
+        return {'error': 'table not found'}
+    
+    target_index = None
+    if drop_empty_targets:
+        if not target_language_code:
+            return {'error': 'drop_empty_targets needs a target_language_code'}
+        target_index = get_verse_index(target_language_code)
+        if target_index is None:
+            return {'error': f'No corpus found for target language code {target_language_code}'}
+    
+    query_items = [{'query': query, 'vref': None} for query in queries or []]
+    if vrefs:
+        source_index = get_verse_index(language_code)
+        for vref in vrefs:
+            content = source_index.get_content(vref) if source_index is not None else None
+            if isinstance(content, str) and content.strip():
+                query_items.append({'query': content, 'vref': vref})
+            else:
+                logger.error(f'No {language_code} text found for vref {vref}')
+    if not query_items:
         return []
-    texts = result['text']
-    # scores = result['_distance']
-    vrefs = result['vref']
     
+    def keep_neighbor(query_item, neighbor_vref):
+        if exclude_self and query_item['vref'] is not None and neighbor_vref == query_item['vref']:
+            return False
+        if target_index is not None:
+            target_content = target_index.get_content(neighbor_vref)
+            return isinstance(target_content, str) and target_content.strip() != ''
+        return True
+    
+    num_rows = len(table)
+    if num_rows == 0:
+        return [{**query_item, 'neighbors': []} for query_item in query_items]
+    query_vectors = embed_batch([item['query'] for item in query_items])
+    candidate_count = min(num_rows, limit * 2 + 10) # over-fetch a little to leave room for filtering
+    
+    if vector_index.get_index_state(language_code, table).indexed:
+        def search(query_vector, count):
+            result = (
+                vector_index.apply_search_params(language_code, table.search(query_vector))
+                .limit(count)
+                .select(['text', 'vref'])
+                .to_arrow()
+            )
+            return list(zip(result['text'].to_pylist(), result['vref'].to_pylist(), result['_distance'].to_pylist()))
+        
+        def search_item(query_item, query_vector):
+            candidates = search(query_vector, candidate_count)
+            neighbors = [candidate for candidate in candidates if keep_neighbor(query_item, candidate[1])]
+            if len(neighbors) < limit and candidate_count < num_rows: # filters removed too many, search again for the full ranking
+                neighbors = [candidate for candidate in search(query_vector, num_rows) if keep_neighbor(query_item, candidate[1])]
+            return {
+                'query': query_item['query'],
+                'vref': query_item['vref'],
+                'neighbors': [{'text': text, 'vref': vref, 'score': score} for text, vref, score in neighbors[:limit]],
+            }
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(QUERY_BATCH_SEARCH_THREADS, len(query_items)))) as executor:
+            return list(executor.map(search_item, query_items, query_vectors))
+    
+    matrix = get_table_matrix(language_code)
+    vectors, squared_norms = matrix.vectors, matrix.squared_norms
+    candidate_count = min(len(vectors), candidate_count)
     output = []
-    for i in range(len(texts)):
-        output.append({
-            'text': texts[i],
-            # 'score': scores[i],
-            'vref': vrefs[i]
-        })
+    for chunk_start in range(0, len(query_items), chunk_size):
+        chunk_vectors = query_vectors[chunk_start:chunk_start + chunk_size]
+        # squared L2 distance, same as LanceDB's `_distance`
+        distances = squared_norms[None, :] - 2 * chunk_vectors @ vectors.T + (chunk_vectors ** 2).sum(axis=1)[:, None]
+        candidates = np.argpartition(distances, candidate_count - 1, axis=1)[:, :candidate_count]
         
+        for i, query_item in enumerate(query_items[chunk_start:chunk_start + chunk_size]):
+            row_distances = distances[i]
+            rows = candidates[i][np.argsort(row_distances[candidates[i]])]
+            neighbors = [row for row in rows if keep_neighbor(query_item, matrix.vrefs[row])]
+            if len(neighbors) < limit and candidate_count < len(vectors): # filters removed too many, fall back to the full ranking
+                neighbors = [row for row in np.argsort(row_distances) if keep_neighbor(query_item, matrix.vrefs[row])]
+            output.append({
+                'query': query_item['query'],
+                'vref': query_item['vref'],
+                'neighbors': [
+                    {'text': matrix.texts[row], 'vref': matrix.vrefs[row], 'score': float(row_distances[row])}
+                    for row in neighbors[:limit]
+                ],
+            })
     return output
+
+derived_indexes_lock = threading.Lock()
+
+def get_ngram_index(language_code: str) -> Optional[NgramIndex]:
+    """
+    Get the n-gram index for a corpus, synced with the corpus currently on disk.
     
-def get_unique_tokens_for_language(language_code):
-    """Get unique tokens for a language"""
-    tokens_to_ignore = ['']
-    
-    if language_code == 'bsb' or language_code =='bsb_bible':
-        df, _, _ = get_dataframes()
-    elif language_code =='macula':
-        _, df, _ = get_dataframes()
-    else:
-        _, _, df = get_dataframes(target_language_code=language_code)
-        
-    target_tokens = df['content'].apply(lambda x: x.split(' ')).explode().tolist()
-    target_tokens = [token for token in target_tokens if token not in tokens_to_ignore]
-    unique_tokens = Counter(target_tokens)
-    return unique_tokens
+    The index is attached to the corpus' verse index in `corpus_store`, so it counts towards
+    CORPUS_MEMORY_BUDGET_MB and is evicted with the corpus (and kept, then synced, when the file changes).
+    """
+    if language_code == 'bsb':
+        language_code = 'bsb_bible'
+    verse_index = get_verse_index(language_code)
+    if verse_index is None:
+        return None
+    key = get_verse_index_key(language_code)
+    with derived_indexes_lock:
+        ngram_index = corpus_store.get_attachment(key, 'ngrams')
+        if ngram_index is None:
+            ngram_index = NgramIndex()
+            corpus_store.set_attachment(key, 'ngrams', ngram_index)
+    # The verse index is rebuilt whenever the corpus file changes, so a new one means some verses may have changed
+    ngram_index.sync(verse_index.contents, source=verse_index)
+    return ngram_index
 
 def get_ngrams(language_code: str, size: int=2, n=100, string_filter: list[str]=[]):
     """Get ngrams with frequencies for a language
@@ -269,35 +632,216 @@ def get_ngrams(language_code: str, size: int=2, n=100, string_filter: list[str]=
     
     A string_filter might be, for example, a tokenized sentence where you want to detect ngrams relative to the entire corpus.
     
-    NOTE: calculating these is not slow, and it is assumed that the corpus itself will change during iterative translation
-    If it winds up being slow, we can cache the results and only recalculate when the corpus changes. # ?FIXME
+    NOTE: counts come from a per-language `NgramIndex` that is kept in memory and only recounts
+    the verses that changed when the corpus changes. N-grams don't cross verse boundaries.
     """
-    tokens_to_ignore = ['']
     # TODO: use a real character filter. I'm sure NLTK has something built in
+    ngram_index = get_ngram_index(language_code)
+    if ngram_index is None:
+        return {'error': f'No corpus found for {language_code}'}
     
-    if language_code == 'bsb' or language_code =='bsb_bible':
-        df, _, _ = get_dataframes()
-    elif language_code =='macula':
-        _, df, _ = get_dataframes()
-    else:
-        _, _, df = get_dataframes(target_language_code=language_code)
-    
-    target_tokens = df['content'].apply(lambda x: x.split(' ')).explode().tolist() 
-    target_tokens = [token for token in target_tokens if token not in tokens_to_ignore]
-    
-    n_grams = [tuple(gram) for gram in ngrams(target_tokens, size)]
+    try:
+        return ngram_index.most_common(size, n=n, string_filter=string_filter)
+    except ValueError as e:
+        return {'error': str(e)}
 
-    print('ngrams before string_filter:', len(n_grams))
 
-    if string_filter:
-        print('filtering with string_filter')
-        n_grams = [gram for gram in n_grams if all(token in string_filter for token in gram)]
+def get_vocabulary(language_code: str) -> Optional[Vocabulary]:
+    """Token frequencies for a corpus, rebuilt from its n-gram index whenever the corpus changes (attached alongside it)"""
+    if language_code == 'bsb':
+        language_code = 'bsb_bible'
+    ngram_index = get_ngram_index(language_code)
+    if ngram_index is None:
+        return None
+    key = get_verse_index_key(language_code)
+    with derived_indexes_lock:
+        vocabulary = corpus_store.get_attachment(key, 'vocabulary')
+        if vocabulary is None or vocabulary.version != ngram_index.version:
+            vocabulary = Vocabulary(ngram_index)
+            corpus_store.set_attachment(key, 'vocabulary', vocabulary)
+        return vocabulary
+
+def get_unique_tokens_for_language(language_code, offset: int=0, limit: int=100, prefix: Optional[str]=None, subset: Optional[str]=None, all: bool=False):
+    """Get unique tokens for a language
+    
+    Params:
+    - language_code (str): corpus (bsb, macula or a target language code)
+    - offset, limit (int): page through the tokens, most frequent first
+    - prefix (str): only tokens starting with prefix (alphabetical order)
+    - subset (str): 'hapax' (tokens that occur once), or 'oov_bsb' / 'oov_macula' (tokens not in that corpus)
+    - all (bool): return the whole vocabulary instead of a page
+    
+    Returns {'total': ..., 'offset': ..., 'tokens': [[token, count], ...]}, or every token with its count,
+    as {token: count}, with `all`.
+    """
+    vocabulary = get_vocabulary(language_code)
+    if vocabulary is None:
+        return {'error': f'No corpus found for language code {language_code}'}
+    if all:
+        return vocabulary.to_dict()
+    
+    if subset == 'hapax':
+        total = len(vocabulary.hapax_ids)
+        tokens = vocabulary.hapax(limit, offset)
+    elif subset in ('oov_bsb', 'oov_macula'):
+        other_code = subset[len('oov_'):]
+        other = get_vocabulary(other_code)
+        if other is None:
+            return {'error': f'No corpus found for language code {other_code}'}
+        total = len(vocabulary.get_oov_ids(other_code, other))
+        tokens = vocabulary.oov(other_code, other, limit, offset)
+    elif subset is not None:
+        return {'error': f'Unknown subset {subset}, expected hapax, oov_bsb or oov_macula'}
+    elif prefix is not None:
+        tokens = vocabulary.with_prefix(prefix, limit, offset)
+        total = None
+    else:
+        total = len(vocabulary)
+        tokens = vocabulary.top_k(limit, offset)
+    return {'total': total, 'offset': offset, 'tokens': tokens}
 
-    freq_dist = FreqDist(n_grams)
+def get_vocabulary_stats(language_code: str):
+    """Token, hapax and out-of-vocabulary (relative to BSB and Macula) counts for a language"""
+    vocabulary = get_vocabulary(language_code)
+    if vocabulary is None:
+        return {'error': f'No corpus found for language code {language_code}'}
+    others = {code: get_vocabulary(code) for code in ['bsb', 'macula'] if code != language_code.replace('bsb_bible', 'bsb')}
+    return vocabulary.stats({code: other for code, other in others.items() if other is not None})
 
-    print('ngrams after string_filter:', len(n_grams))
+class TranslationContext():
+    """
+    Everything a few-shot translation of one verse is built from, computed once:
+    the source text, its nearest neighbors in the source table, their BSB/Macula/target triplets, and the prompt.
+    
+    Share one context between the generate and evaluate stages (see `Translation`) rather than
+    rebuilding the prompt for each, since every build costs an embedding and a vector search.
+    """
+    
+    def __init__(
+            self,
+            vref,
+            target_language_code,
+            source_language_code=None,
+            number_of_examples=3,
+            backtranslate=False,
+            context_tokens=TRANSLATION_CONTEXT_TOKENS,
+            output_tokens=TRANSLATION_OUTPUT_TOKENS):
+        self.vref = vref
+        self.target_language_code = target_language_code
+        self.source_language_code = source_language_code
+        self.number_of_examples = number_of_examples
+        self.backtranslate = backtranslate
+        self.context_tokens = context_tokens
+        self.output_tokens = output_tokens
+        
+        source_index = get_verse_index(source_language_code if source_language_code else 'bsb_bible')
+        macula_index = get_verse_index('macula')
+        target_index = get_verse_index(target_language_code)
+        
+        self.source_text = source_index.get_content(vref)
+        self.original_language_source = macula_index.get_content(vref)
+        self.target_text = target_index.get_content(vref) if target_index is not None else None
+        self.verse = get_verse_triplet(full_verse_ref=vref, language_code=target_language_code)
+        logger.info(f'Query result: {self.source_text}')
+        
+        # Query the LanceDB table for the most similar verses to the source text (or bsb if source_language_code is None).
+        # We ask for a few more than we need, so that long verses can be passed over for shorter ones that fit the budget.
+        table_name = source_language_code if source_language_code else 'bsb_bible'
+        self.neighbors = query_lancedb_table(table_name, self.source_text, limit=number_of_examples * TRANSLATION_CANDIDATE_FACTOR)
+        if isinstance(self.neighbors, dict): # {'error': ...}
+            logger.error(f'No similar verses for {vref}: {self.neighbors}')
+            self.neighbors = []
+        
+        # The verse itself is usually its own nearest neighbor, but it's added as the query anyway
+        triplets = [get_verse_triplet(neighbor['vref'], target_language_code) for neighbor in self.neighbors if neighbor['vref'] != vref]
+        self.candidates = [triplet for triplet in triplets if triplet is not None]
+        self.triplets = self.select_triplets()
+        self.prompt = self.build_prompt()
+        self.prompt_tokens = count_tokens(json.dumps(self.prompt, ensure_ascii=False))
+        # Examples are counted one by one, so the whole prompt can still come out a little over: drop the least similar until it fits
+        while self.prompt_tokens + self.output_tokens > self.context_tokens and self.triplets:
+            dropped = self.triplets.pop()['bsb']['vref']
+            self.skipped_vrefs.append(dropped)
+            del self.example_tokens[dropped]
+            self.prompt = self.build_prompt()
+            self.prompt_tokens = count_tokens(json.dumps(self.prompt, ensure_ascii=False))
+        if self.prompt_tokens + self.output_tokens > self.context_tokens:
+            raise ValueError(f'Prompt for {vref} is {self.prompt_tokens} tokens without any examples, which overflows the {self.context_tokens}-token context with the {self.output_tokens}-token output reserve')
+        # The translation may use whatever context the prompt leaves (at least the reserve)
+        self.max_tokens = self.context_tokens - self.prompt_tokens
+    
+    @staticmethod
+    def build_prompt_entry(source, bridge_translation, target) -> dict:
+        return TranslationTriplet(source=source, bridge_translation=bridge_translation, target=target).to_dict()
+    
+    def select_triplets(self) -> list[dict]:
+        """
+        Greedily pick the most similar triplets that fit the token budget: the context minus the room reserved for
+        the translation, minus the query verse itself. A triplet too long for what's left is skipped (and a shorter,
+        less similar one may take its place), up to `number_of_examples` triplets.
+        """
+        budget = self.context_tokens - self.output_tokens
+        query_entry = {self.vref: self.build_prompt_entry(self.original_language_source, self.source_text, self.target_text)}
+        used_tokens = count_tokens(json.dumps(query_entry, ensure_ascii=False))
+        selected = []
+        self.example_tokens: dict[str, int] = {}
+        self.skipped_vrefs: list[str] = []
+        for triplet in self.candidates:
+            if len(selected) >= self.number_of_examples:
+                break
+            entry = {triplet['bsb']['vref']: self.build_prompt_entry(triplet['macula']['content'], triplet['bsb']['content'], triplet['target']['content'])}
+            tokens = count_tokens(json.dumps(entry, ensure_ascii=False))
+            if used_tokens + tokens > budget:
+                self.skipped_vrefs.append(triplet['bsb']['vref'])
+                continue
+            selected.append(triplet)
+            self.example_tokens[triplet['bsb']['vref']] = tokens
+            used_tokens += tokens
+        if len(selected) < self.number_of_examples:
+            logger.info(f'Prompt for {self.vref}: {len(selected)} of {self.number_of_examples} examples fit the {budget}-token budget')
+        return selected
+    
+    def build_prompt(self) -> dict[str, TranslationTriplet]:
+        # Initialize an empty dictionary to store the JSON objects
+        json_objects: dict[str, TranslationTriplet] = dict()
+        
+        for triplet in self.triplets:
+            # Create a JSON object for each triplet with top-level keys being the VREFs
+            json_objects[triplet["bsb"]["vref"]] = self.build_prompt_entry(
+                source=triplet["macula"]["content"],
+                bridge_translation=triplet["bsb"]["content"],
+                target=triplet["target"]["content"] # FIXME: validate that content exists here?
+            )
+        
+        # Add the source verse Greek/Hebrew and English reference to the JSON objects
+        json_objects[self.vref] = self.build_prompt_entry(
+            source=self.original_language_source,
+            bridge_translation=self.source_text,
+            target=self.target_text
+        )
+        
+        return json_objects
+    
+    def get_token_counts(self) -> dict:
+        return {
+            'context': self.context_tokens,
+            'reserved_for_output': self.output_tokens,
+            'prompt': self.prompt_tokens,
+            'max_tokens': self.max_tokens,
+            'examples': self.example_tokens,
+            'skipped_for_budget': self.skipped_vrefs,
+        }
     
-    return list(freq_dist.most_common(n))
+    def to_dict(self) -> dict:
+        return {
+            'vref': self.vref,
+            'source_text': self.source_text,
+            'original_language_source': self.original_language_source,
+            'target_text': self.target_text,
+            'neighbors': self.neighbors,
+            'prompt': self.prompt,
+            'token_counts': self.get_token_counts(),
+        }
 
 def build_translation_prompt(
         vref, 
@@ -308,65 +852,13 @@ def build_translation_prompt(
         number_of_examples=3, 
         backtranslate=False) -> dict[str, TranslationTriplet]:
     
-    """Build a prompt for translation"""
-    if bsb_bible_df is None or bsb_bible_df.empty or macula_df is None or macula_df.empty: # build bsb_bible_df and macula_df only if not supplied (saves overhead)
-        bsb_bible_df, macula_df, target_df = get_dataframes(target_language_code=target_language_code)
-    if source_language_code:
-        _, _, source_df = get_dataframes(target_language_code=source_language_code)
-    else:
-        source_df = bsb_bible_df
-    
-    # Query the LanceDB table for the most similar verses to the source text (or bsb if source_language_code is None)
-    table_name = source_language_code if source_language_code else 'bsb_bible'
-    query = source_df[source_df['vref']==vref]['content'].values[0]
-    original_language_source = macula_df[macula_df['vref']==vref]['content'].values[0]
-    print(f'Query result: {query}')
-    similar_verses = query_lancedb_table(table_name, query, limit=number_of_examples) # FIXME: query 50 and then filter to first n that have target content?
-    
-    triplets = [get_verse_triplet(similar_verse['vref'], target_language_code, bsb_bible_df, macula_df) for similar_verse in similar_verses]
-    
-    target_verse = target_df[target_df['vref']==vref]['content'].values[0]
-    
-    # Initialize an empty dictionary to store the JSON objects
-    json_objects: dict[str, TranslationTriplet] = dict()
-    
-    for triplet in triplets:
-        # Create a JSON object for each triplet with top-level keys being the VREFs
-        json_objects[triplet["bsb"]["vref"]] = TranslationTriplet(
-            source=triplet["macula"]["content"],
-            bridge_translation=triplet["bsb"]["content"],
-            target=triplet["target"]["content"] # FIXME: validate that content exists here?
-        ).to_dict()
-    
-    # Add the source verse Greek/Hebrew and English reference to the JSON objects
-    json_objects[vref] = TranslationTriplet(
-        source=original_language_source,
-        bridge_translation=query,
-        target=target_verse
-    ).to_dict()
-        
-    return json_objects
+    """Build a prompt for translation (see `TranslationContext` to also keep the intermediate results)"""
+    # NOTE: verses are looked up through the cached vref indexes, so bsb_bible_df and macula_df no longer need to be supplied
+    return TranslationContext(vref, target_language_code, source_language_code, number_of_examples, backtranslate).prompt
 
 
-def execute_discriminator_evaluation(verse_triplets: dict[str, TranslationTriplet], hypothesis_vref: str, hypothesis_key='target') -> ChatResponse:
-    """
-    Accepts an array of verses as verse_triplets.
-    The final triplet is assumed to be the hypothesis.
-    The hypothesis string is assumed to be the target language rendering.
-    
-    This simple discriminator type of evaluation scrambles the input verse_triplets
-    and prompts the LLM to detect which is the hypothesis.
-    
-    The return value is:
-    {
-        'y_index': index_of_hypothesis,
-        'y_hat_index': llm_predicted_index,
-        'rationale': rationale_string,
-    }
-    
-    If you introduce any intermediate translation steps (e.g., leaving unknown tokens untranslated),
-    then this type of evaluation is not recommended.
-    """
+def build_discriminator_payload(verse_triplets: dict[str, TranslationTriplet], hypothesis_vref: str, hypothesis_key='target') -> dict:
+    """Chat completion payload for the discriminator evaluation (see `execute_discriminator_evaluation_async`)"""
     hypothesis_triplet = verse_triplets[hypothesis_vref]
     print(f'Hypothesis: {hypothesis_triplet}')
     
@@ -374,7 +866,9 @@ def execute_discriminator_evaluation(verse_triplets: dict[str, TranslationTriple
     
     print('Verse triplets keys:', [k for k, v in verse_triplets_list])
     # # Shuffle the verse_triplets
-    shuffle(verse_triplets_list)
+    # The order is seeded by the triplets themselves, so the same input always gives the same prompt (and can be served from the LLM cache)
+    seed = hashlib.sha1(json.dumps(verse_triplets_list, sort_keys=True, default=str).encode('utf8')).hexdigest()
+    Random(seed).shuffle(verse_triplets_list)
     print(f'Shuffled verse triplets keys: {[k for k, v in verse_triplets_list]}')
     
     # # Build the prompt
@@ -383,40 +877,74 @@ def execute_discriminator_evaluation(verse_triplets: dict[str, TranslationTriple
         print(f'Verse triplet {i}: {triplet}')
         prompt += f'\n{triplet[0]}. Target: {triplet[1]["target"]}'
 
-    url = f"{machine}/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-    }
     payload = {
         "messages": [
             # FIXME: I think I should just ask the model to designate which verse stands out as the least likely to be correct.
             {"role": "user", "content": f"### Instruction: One of these translations is incorrect, and you can only try to determine by comparing the examples given:\n{prompt}\nWhich one of these is incorrect? (show only '[put verse ref here] -- rationale as to why you picked this one relative only to the other options')\n###Response:"}
         ],
         "temperature": 0.7,
+        "seed": LLM_SEED, # so the same prompt gets the same answer, and can be served from the LLM cache
         "max_tokens": -1,
         "stream": False,
     }
+    return payload
 
-    response = requests.post(url, json=payload, headers=headers)
-    
-    return response.json()
+def execute_discriminator_evaluation(verse_triplets: dict[str, TranslationTriplet], hypothesis_vref: str, hypothesis_key='target', use_cache=None) -> ChatResponse:
+    """Blocking version of `execute_discriminator_evaluation_async`"""
+    payload = build_discriminator_payload(verse_triplets, hypothesis_vref, hypothesis_key)
+    return llm_client.chat_completion_sync(payload, use_cache=use_cache)
 
-def execute_fewshot_translation(vref, target_language_code, source_language_code=None, bsb_bible_df=None, macula_df=None, number_of_examples=3, backtranslate=False) -> ChatResponse:
-    prompt = build_translation_prompt(vref, target_language_code, source_language_code, bsb_bible_df, macula_df, number_of_examples, backtranslate)
-    url = f"{machine}/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
+async def execute_discriminator_evaluation_async(verse_triplets: dict[str, TranslationTriplet], hypothesis_vref: str, hypothesis_key='target', use_cache=None) -> ChatResponse:
+    """
+    Accepts an array of verses as verse_triplets.
+    The final triplet is assumed to be the hypothesis.
+    The hypothesis string is assumed to be the target language rendering.
+    
+    This simple discriminator type of evaluation scrambles the input verse_triplets
+    and prompts the LLM to detect which is the hypothesis.
+    
+    The return value is:
+    {
+        'y_index': index_of_hypothesis,
+        'y_hat_index': llm_predicted_index,
+        'rationale': rationale_string,
     }
-    payload = {
+    
+    If you introduce any intermediate translation steps (e.g., leaving unknown tokens untranslated),
+    then this type of evaluation is not recommended.
+    
+    The request is seeded (LLM_SEED), so responses are cached unless use_cache=False; see `LLMClient._should_use_cache`.
+    """
+    payload = build_discriminator_payload(verse_triplets, hypothesis_vref, hypothesis_key)
+    return await llm_client.chat_completion(payload, use_cache=use_cache)
+
+def build_fewshot_payload(prompt, max_tokens=-1) -> dict:
+    return {
         "messages": [
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.7,
-        "max_tokens": -1,
+        "seed": LLM_SEED, # so the same prompt gets the same answer, and can be served from the LLM cache
+        "max_tokens": max_tokens,
         "stream": False,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    return response.json()
+
+def execute_fewshot_translation(vref, target_language_code, source_language_code=None, bsb_bible_df=None, macula_df=None, number_of_examples=3, backtranslate=False, prompt=None, max_tokens=-1, use_cache=None) -> ChatResponse:
+    """
+    Translate a verse with a few-shot prompt (pass `prompt`, e.g. from a `TranslationContext`, to skip building it,
+    along with the context's `max_tokens`). The request is seeded, so responses are cached unless use_cache=False.
+    """
+    if prompt is None:
+        context = TranslationContext(vref, target_language_code, source_language_code, number_of_examples, backtranslate)
+        prompt, max_tokens = context.prompt, context.max_tokens
+    return llm_client.chat_completion_sync(build_fewshot_payload(prompt, max_tokens), use_cache=use_cache)
+
+async def execute_fewshot_translation_async(vref, target_language_code, source_language_code=None, bsb_bible_df=None, macula_df=None, number_of_examples=3, backtranslate=False, prompt=None, max_tokens=-1, use_cache=None) -> ChatResponse:
+    if prompt is None:
+        # Building the prompt embeds and searches, which is blocking work, so it runs in a worker thread
+        context = await asyncio.to_thread(TranslationContext, vref, target_language_code, source_language_code, number_of_examples, backtranslate)
+        prompt, max_tokens = context.prompt, context.max_tokens
+    return await llm_client.chat_completion(build_fewshot_payload(prompt, max_tokens), use_cache=use_cache)
 
 class RevisionLoop(BaseModel):
     # FIXME: this loop should only work for (revise-evaluate)*n, where you start with a translation draft.
@@ -465,23 +993,104 @@ class RevisionLoop(BaseModel):
 class Translation():
     """Translations differ from revisions insofar as revisions require an existing draft of the target"""
     
-    def __init__(self, vref: str, target_language_code: str, number_of_examples=3, should_backtranslate=False):
+    def __init__(self, vref: str, target_language_code: str, number_of_examples=3, should_backtranslate=False, run=True, use_cache=None):
         self.vref = vref
+        self.use_cache = use_cache
         self.target_language_code = target_language_code
         self.number_of_examples = number_of_examples
         self.should_backtranslate = should_backtranslate
-        
-        bsb_bible_df, macula_df = get_dataframes()
-        self.verse = get_verse_triplet(full_verse_ref=self.vref, language_code=self.target_language_code, bsb_bible_df=bsb_bible_df, macula_df=macula_df)
-        self.vref_triplets = build_translation_prompt(vref, target_language_code)
+        self.context: Optional[TranslationContext] = None
+        self.verse: Optional[dict] = None # set by `prepare`
+        self.vref_triplets: Optional[dict] = None
+        self.hypothesis: Optional[ChatResponse] = None
+        self.feedback: Optional[ChatResponse] = None
+        if run:
+            self.run()
+    
+    def prepare(self) -> TranslationContext:
+        """Look up the verse, its neighbors and the prompt (once; the generate and evaluate stages share them)"""
+        if self.context is None:
+            self.context = TranslationContext(self.vref, self.target_language_code, number_of_examples=self.number_of_examples, backtranslate=self.should_backtranslate)
+            self.verse = self.context.verse
+            self.vref_triplets = self.context.prompt
+        return self.context
+    
+    def run(self):
+        context = self.prepare()
         # Predict translation
-        self.hypothesis: ChatResponse = execute_fewshot_translation(vref, target_language_code, source_language_code=None, bsb_bible_df=bsb_bible_df, macula_df=macula_df, number_of_examples=3, backtranslate=False)
+        self.hypothesis = execute_fewshot_translation(self.vref, self.target_language_code, prompt=context.prompt, max_tokens=context.max_tokens, use_cache=self.use_cache)
         # Get feedback on the translation
         # NOTE: here is where various evaluation functions could be swapped out
-        self.feedback: ChatResponse = execute_discriminator_evaluation(self.vref_triplets, self.vref)
+        self.feedback = execute_discriminator_evaluation(context.prompt, self.vref, use_cache=self.use_cache)
+    
+    async def run_async(self):
+        """Same as `run`, without blocking the event loop (for async API handlers)"""
+        context = await asyncio.to_thread(self.prepare)
+        self.hypothesis = await execute_fewshot_translation_async(self.vref, self.target_language_code, prompt=context.prompt, max_tokens=context.max_tokens, use_cache=self.use_cache)
+        self.feedback = await execute_discriminator_evaluation_async(context.prompt, self.vref, use_cache=self.use_cache)
+    
+    async def stream_async(self):
+        """
+        Same as `run_async`, but yields (event, data) pairs as it goes: 'context' (the verse's neighbors and prompt),
+        a 'token' event for each piece of the translation as the LLM generates it, then 'hypothesis' (the assembled response) and 'feedback'.
+        """
+        context = await asyncio.to_thread(self.prepare)
+        yield 'context', context.to_dict()
+        payload = build_fewshot_payload(context.prompt, context.max_tokens)
+        content, last_chunk, finish_reason = '', {}, None
+        chunks = llm_client.stream_chat_completion(payload)
+        try:
+            async for chunk in chunks:
+                last_chunk = chunk
+                choice = (chunk.get('choices') or [{}])[0]
+                token = (choice.get('delta') or {}).get('content')
+                finish_reason = choice.get('finish_reason') or finish_reason
+                if token:
+                    content += token
+                    yield 'token', {'content': token}
+        finally: # if our caller stops early, stop the generation and free the LLM slot right away
+            await chunks.aclose()
+        self.hypothesis = {
+            'id': last_chunk.get('id', ''),
+            'object': 'chat.completion',
+            'created': last_chunk.get('created', int(time.time())),
+            'model': last_chunk.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': finish_reason}],
+            'usage': last_chunk.get('usage') or {},
+        }
+        yield 'hypothesis', self.hypothesis
+        self.feedback = await execute_discriminator_evaluation_async(context.prompt, self.vref, use_cache=self.use_cache)
+        yield 'feedback', self.feedback
 
     def get_hypothesis(self):
         return self.hypothesis
     
     def get_feedback(self):
         return self.feedback
+    
+    def get_context(self) -> Optional[TranslationContext]:
+        return self.context
+
+def warm_up():
+    """Load the heavy resources (corpora, vref indexes, embedding model) ahead of the first request that needs them"""
+    start_time = time.time()
+    logger.info('Warming up...')
+    for language_code in ['bsb_bible', 'macula']:
+        try:
+            get_verse_index(language_code)
+        except Exception as e:
+            logger.error(f'Failed to load {language_code} corpus: {e}')
+    for resource in list(lazy_resources.values()):
+        resource.warm_up()
+    logger.info(f'Warm-up finished in {time.time() - start_time:.2f} seconds')
+
+def get_readiness() -> dict:
+    """Report which of the heavy resources have been loaded, and the embedding throughput so far"""
+    loaded_corpora = [entry['key'] for entry in corpus_store.info()['entries']]
+    resources = {name: resource.status() for name, resource in lazy_resources.items()}
+    resources['corpora'] = {'ready': 'bsb_bible' in loaded_corpora and 'macula' in loaded_corpora, 'loaded': loaded_corpora}
+    return {
+        'ready': all(resource['ready'] for resource in resources.values()),
+        'resources': resources,
+        'embedding': get_embedding_stats(),
+    }
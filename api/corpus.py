@@ -0,0 +1,217 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Upper bound for the target-language corpora kept in memory (BSB and Macula are always kept)
+CORPUS_MEMORY_BUDGET_MB = int(os.environ.get('CORPUS_MEMORY_BUDGET_MB', 512))
+
+
+def get_file_mtimes(paths: list[str]) -> tuple:
+    """Modification times for a list of files (None for files that don't exist)"""
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+
+def estimate_nbytes(value: Any) -> int:
+    """Rough in-memory size of a cached value (deep for pandas objects)"""
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(deep=True).sum())
+    return 0
+
+
+class CorpusEntry():
+    def __init__(self, value: Any, paths: list[str], mtimes: tuple, pinned: bool):
+        self.value = value
+        self.paths = paths
+        self.mtimes = mtimes
+        self.pinned = pinned
+        self.nbytes = estimate_nbytes(value)
+        self.attachments: dict[str, Any] = {} # values derived from this one, see `CorpusStore.get_attachment`
+
+    def get_nbytes(self) -> int:
+        """Size of the value plus its attachments (which may grow, so they're measured every time)"""
+        return self.nbytes + sum(estimate_nbytes(attachment) for attachment in self.attachments.values())
+
+
+class CorpusStore():
+    """
+    Process-wide cache for corpus dataframes.
+
+    Each entry is loaded once per process and reused until one of the files it was
+    built from changes on disk (mtime check on every access). Pinned entries (BSB, Macula)
+    are never evicted; the rest (target languages) are evicted least-recently-used first
+    once the memory budget is exceeded.
+
+    Values derived from an entry (e.g., a corpus' n-gram index) can be attached to it: they count
+    towards its size, are evicted with it, and are handed over to the reloaded entry when the
+    files change, so they can be updated incrementally rather than rebuilt.
+
+    NOTE: cached values are shared between callers, so don't mutate them in place.
+    """
+
+    def __init__(self, memory_budget_mb: int = CORPUS_MEMORY_BUDGET_MB):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._entries: 'OrderedDict[str, CorpusEntry]' = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks: dict[str, threading.Lock] = {}
+        self._stale_attachments: dict[str, dict[str, Any]] = {} # attachments of entries that are being reloaded
+        self.hits = 0
+        self.misses = 0
+
+    def _get_key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _get_fresh_entry(self, key: str) -> Optional[CorpusEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.mtimes != get_file_mtimes(entry.paths):
+                logger.info(f'Corpus {key} changed on disk, reloading...')
+                self._stale_attachments[key] = entry.attachments
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1 # counted under the lock, since requests come in on several threads
+            return entry
+
+    def get(self, key: str, paths: list[str], loader: Callable[[], Any], pinned: bool = False) -> Any:
+        """Get a cached value, (re)loading it with `loader` if missing or stale"""
+        entry = self._get_fresh_entry(key)
+        if entry is not None:
+            return entry.value
+
+        # Only one thread loads a given corpus; the others wait and then reuse it
+        with self._get_key_lock(key):
+            entry = self._get_fresh_entry(key)
+            if entry is not None:
+                return entry.value
+
+            with self._lock:
+                self.misses += 1
+            mtimes = get_file_mtimes(paths) # taken before loading so that a write during the load triggers a reload
+            value = loader()
+            entry = CorpusEntry(value, paths, mtimes, pinned)
+            with self._lock:
+                entry.attachments = self._stale_attachments.pop(key, {})
+                self._entries[key] = entry
+                self._evict()
+            logger.info(f'Loaded corpus {key} ({entry.nbytes / 1024 / 1024:.1f} MB)')
+            return value
+
+    def get_attachment(self, key: str, name: str) -> Any:
+        """A value attached to a cached entry (None if there isn't one, or the entry isn't cached)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.attachments.get(name) if entry is not None else None
+
+    def set_attachment(self, key: str, name: str, value: Any) -> bool:
+        """Attach a value to a cached entry; returns False (and keeps nothing) if the entry isn't cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry.attachments[name] = value
+            self._evict()
+            return True
+
+    def _evict(self):
+        sizes = {key: entry.get_nbytes() for key, entry in self._entries.items()}
+        total = sum(sizes.values())
+        for key in list(self._entries.keys()): # oldest first
+            if total <= self.memory_budget:
+                break
+            entry = self._entries[key]
+            if entry.pinned:
+                continue
+            total -= sizes[key]
+            del self._entries[key]
+            logger.info(f'Evicted corpus {key} from memory')
+
+    def invalidate(self, key: Optional[str] = None):
+        """Drop one cached entry (or all of them)"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._stale_attachments.clear()
+            else:
+                self._entries.pop(key, None)
+                self._stale_attachments.pop(key, None)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                'memory_budget_mb': self.memory_budget / 1024 / 1024,
+                'memory_used_mb': sum(entry.get_nbytes() for entry in self._entries.values()) / 1024 / 1024,
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': [
+                    {'key': key, 'pinned': entry.pinned, 'size_mb': entry.get_nbytes() / 1024 / 1024, 'attachments': list(entry.attachments)}
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+
+class VerseIndex():
+    """
+    Constant-time verse lookup for a corpus dataframe with `vref` and `content` columns.
+
+    Rows are addressed by verse ordinal (line number of the vref in the canonical vref.txt),
+    so the BSB, Macula and target corpora all share the same key space. Vrefs that are
+    not in vref.txt fall back to a plain dictionary lookup.
+    """
+
+    def __init__(self, df, vref_ordinals: dict[str, int]):
+        self.vrefs: list[str] = df['vref'].tolist()
+        self.contents: list[Any] = df['content'].tolist()
+        self.labels: list[int] = [int(label) for label in df.index]
+        self.positions = np.full(len(vref_ordinals), -1, dtype=np.int32) # verse ordinal -> row position
+        self.extra_positions: dict[str, int] = {}
+        
+        for position, vref in enumerate(self.vrefs):
+            ordinal = vref_ordinals.get(vref)
+            if ordinal is None:
+                self.extra_positions.setdefault(vref, position)
+            elif self.positions[ordinal] == -1: # first occurrence wins, as with the old boolean masks
+                self.positions[ordinal] = position
+        
+        self.vref_ordinals = vref_ordinals
+        self.nbytes = self.positions.nbytes + sum(len(str(content)) for content in self.contents) * 2
+
+    def get_position(self, vref: str) -> Optional[int]:
+        ordinal = self.vref_ordinals.get(vref)
+        if ordinal is None:
+            return self.extra_positions.get(vref)
+        position = int(self.positions[ordinal])
+        return position if position != -1 else None
+
+    def get(self, vref: str) -> Optional[dict]:
+        """Get a verse as {verse_number, vref, content}, or None if the corpus doesn't have it"""
+        position = self.get_position(vref)
+        if position is None:
+            return None
+        return {
+            'verse_number': self.labels[position],
+            'vref': self.vrefs[position],
+            'content': self.contents[position],
+        }
+
+    def get_content(self, vref: str, default: Any = None) -> Any:
+        position = self.get_position(vref)
+        return self.contents[position] if position is not None else default
+
+    def __contains__(self, vref: str) -> bool:
+        return self.get_position(vref) is not None
+
+
+corpus_store = CorpusStore()
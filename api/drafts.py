@@ -0,0 +1,200 @@
+import os, json, time, asyncio
+from typing import Optional, Union
+
+from . import backend
+from .llm_client import LLM_MAX_CONCURRENCY
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+DRAFTS_DIR = os.environ.get('DRAFTS_DIR', 'data/drafts')
+# Verses translated at once per job (each verse is a prompt build, a generation and an evaluation)
+DRAFT_CONCURRENCY = int(os.environ.get('DRAFT_CONCURRENCY', LLM_MAX_CONCURRENCY))
+
+
+def get_draft_job_id(target_language_code: str, book: str, chapter: Optional[int] = None) -> str:
+    """Jobs are named after what they draft, so re-submitting the same job resumes it"""
+    return f'{target_language_code}-{book}' + (f'-{chapter}' if chapter is not None else '')
+
+
+def validate_draft_job(target_language_code: str, book: str, chapter: Optional[int] = None, concurrency: int = DRAFT_CONCURRENCY) -> Optional[str]:
+    """What's wrong with a draft job request, if anything (the job id ends up in a file path, so it must be safe)"""
+    if not (len(target_language_code) == 3 and target_language_code.isalpha()):
+        return 'Invalid language code. Please use 3-letter ISO 639-3 language code.'
+    if book not in backend.get_vref_list():
+        return f'Unknown book {book}. Please use a 3-letter USFM book code, e.g. GEN.'
+    if chapter is not None and chapter < 1:
+        return f'Invalid chapter {chapter}'
+    if concurrency < 1:
+        return f'Invalid concurrency {concurrency}, it must be at least 1'
+    job_id = get_draft_job_id(target_language_code, book, chapter)
+    if '/' in job_id or '..' in job_id:
+        return f'Invalid draft job {job_id}'
+    return None
+
+
+def get_draft_vrefs(book: str, chapter: Optional[int] = None) -> list[str]:
+    """The vrefs of a book (or one chapter of it) that have BSB source text to translate from"""
+    bsb_index = backend.get_verse_index('bsb_bible')
+    vrefs = [vref for vref in backend.get_vref_list(book) if vref.split(' ')[0] == book and vref in bsb_index]
+    if chapter is not None:
+        vrefs = [vref for vref in vrefs if vref.split(' ')[1].split(':')[0] == str(chapter)]
+    return vrefs
+
+
+class DraftJob():
+    """
+    Drafts a translation of a book or chapter in the background, a few verses at a time.
+
+    Each verse goes through `backend.Translation` (prompt, generation, discriminator evaluation), and its
+    result is appended to `data/drafts/{job_id}.jsonl` as soon as it finishes, so results arrive in
+    completion order. Verses already in the file without an error are skipped, so a job that was stopped
+    (or crashed) picks up where it left off when it's started again.
+    """
+
+    def __init__(self, target_language_code: str, book: str, chapter: Optional[int] = None, concurrency: int = DRAFT_CONCURRENCY):
+        self.job_id = get_draft_job_id(target_language_code, book, chapter)
+        self.target_language_code = target_language_code
+        self.book = book
+        self.chapter = chapter
+        self.concurrency = concurrency
+        if '/' in self.job_id or '..' in self.job_id: # see `validate_draft_job`
+            raise ValueError(f'Invalid draft job {self.job_id}')
+        self.path = os.path.join(DRAFTS_DIR, f'{self.job_id}.jsonl')
+
+        self.status = 'pending'
+        self.error = None
+        self.total = 0
+        self.skipped = 0 # already drafted by an earlier run
+        self.completed = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self._task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    def get_drafted_vrefs(self) -> set[str]:
+        """Vrefs with a successful result in the output file"""
+        drafted = set()
+        if not os.path.exists(self.path):
+            return drafted
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError: # partial line from an interrupted write
+                    continue
+                if not result.get('error'):
+                    drafted.add(result['vref'])
+        return drafted
+
+    async def _write_result(self, result: dict):
+        async with self._write_lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    async def _draft_verse(self, vref: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            start_time = time.time()
+            try:
+                translation = backend.Translation(vref, target_language_code=self.target_language_code, run=False)
+                await translation.run_async()
+                result = {
+                    'vref': vref,
+                    'hypothesis': translation.get_hypothesis(),
+                    'feedback': translation.get_feedback(),
+                    'prompt': translation.get_context().prompt,
+                    'token_counts': translation.get_context().get_token_counts(),
+                }
+                self.completed += 1
+            except Exception as e:
+                logger.error(f'Draft job {self.job_id}: failed to translate {vref}: {e}')
+                result = {'vref': vref, 'error': str(e)}
+                self.failed += 1
+            result['seconds'] = time.time() - start_time
+            await self._write_result(result)
+
+    async def run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        try:
+            os.makedirs(DRAFTS_DIR, exist_ok=True)
+            vrefs = await asyncio.to_thread(get_draft_vrefs, self.book, self.chapter)
+            drafted = await asyncio.to_thread(self.get_drafted_vrefs)
+            remaining = [vref for vref in vrefs if vref not in drafted]
+            self.total = len(vrefs)
+            self.skipped = len(vrefs) - len(remaining)
+            logger.info(f'Draft job {self.job_id}: {len(remaining)} of {len(vrefs)} verses to translate')
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*[self._draft_verse(vref, semaphore) for vref in remaining])
+            self.status = 'finished'
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+        except Exception as e:
+            logger.error(f'Draft job {self.job_id} failed: {e}')
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def progress(self) -> dict:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0
+        processed = self.completed + self.failed
+        remaining = max(self.total - self.skipped - processed, 0)
+        verses_per_minute = processed / elapsed * 60 if elapsed > 0 else 0
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'error': self.error,
+            'target_language_code': self.target_language_code,
+            'book': self.book,
+            'chapter': self.chapter,
+            'concurrency': self.concurrency,
+            'path': self.path,
+            'total': self.total,
+            'skipped': self.skipped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'remaining': remaining,
+            'elapsed_seconds': elapsed,
+            'verses_per_minute': verses_per_minute,
+            'eta_seconds': remaining / verses_per_minute * 60 if verses_per_minute > 0 else None,
+        }
+
+
+draft_jobs: dict[str, DraftJob] = {}
+
+
+async def start_draft_job(target_language_code: str, book: str, chapter: Optional[int] = None, concurrency: int = DRAFT_CONCURRENCY, restart: bool = False) -> Union[DraftJob, dict]:
+    """
+    Start (or resume) a draft job in the background.
+    If the same job is already running it's returned as is. With `restart`, earlier results are discarded.
+    Returns {'error': ...} instead if the request is invalid (see `validate_draft_job`), or
+    {'error': ..., 'job': <progress>} if a restart was asked for while the job is running (cancel it first).
+    """
+    error = await asyncio.to_thread(validate_draft_job, target_language_code, book, chapter, concurrency) # loads the vref list
+    if error:
+        return {'error': error}
+    job_id = get_draft_job_id(target_language_code, book, chapter)
+    job = draft_jobs.get(job_id)
+    if job is not None and job.is_running():
+        if restart:
+            return {'error': f'Draft job {job_id} is already running. Cancel it before restarting.', 'job': job.progress()}
+        return job
+    job = DraftJob(target_language_code, book, chapter, concurrency)
+    if restart and os.path.exists(job.path):
+        os.remove(job.path)
+    draft_jobs[job_id] = job
+    job.start()
+    return job
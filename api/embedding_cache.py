@@ -0,0 +1,130 @@
+import os
+import hashlib
+import threading
+from typing import Optional
+
+import numpy as np
+from filelock import FileLock
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', 'data/embedding_cache')
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+class EmbeddingCache():
+    """
+    Content-addressed, on-disk cache of sentence embeddings for one model.
+
+    Vectors are appended to a flat float32 file (`vectors.f32`) that is read through a memory map,
+    and `keys.txt` holds the sha1 of each embedded text, one per line, in the same order as the rows.
+    Vectors are always written before their keys, so a crash can never leave a key without a vector.
+    The cache is shared between tables, processes and restarts; appends are guarded by a file lock.
+    """
+
+    def __init__(self, model_name: str, dimension: int, directory: str = EMBEDDING_CACHE_DIR):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.directory = os.path.join(directory, f'{model_name.replace("/", "_")}-{dimension}')
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.keys_path = os.path.join(self.directory, 'keys.txt')
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._file_lock = FileLock(os.path.join(self.directory, '.lock'))
+        self._lock = threading.RLock()
+        self._rows: dict[str, int] = {}
+        self._num_rows = 0 # lines read from keys.txt (== vector rows)
+        self._keys_offset = 0 # how far into keys.txt we've read
+        self._vectors: Optional[np.memmap] = None
+        self.hits = 0
+        self.misses = 0
+        self._read_new_keys()
+
+    def _vector_rows_on_disk(self) -> int:
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dimension * 4)
+
+    def _read_new_keys(self):
+        """Pick up keys appended since we last looked (by this or another process)"""
+        if not os.path.exists(self.keys_path) or os.path.getsize(self.keys_path) <= self._keys_offset:
+            return
+        max_rows = self._vector_rows_on_disk()
+        with open(self.keys_path, 'r') as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith('\n') or self._num_rows >= max_rows: # partially written, read it next time
+                    break
+                self._keys_offset += len(line.encode('utf8'))
+                self._rows.setdefault(line.strip(), self._num_rows)
+                self._num_rows += 1
+        self._vectors = None # remap on next read
+
+    def _get_vectors(self) -> np.memmap:
+        if self._vectors is None or len(self._vectors) < self._num_rows:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._vector_rows_on_disk(), self.dimension))
+        return self._vectors
+
+    def get_many(self, texts: list[str]):
+        """
+        Look up embeddings for a list of texts.
+        Returns (keys, vectors, missing): vectors is a float32 matrix with a row per text
+        (rows for missing texts are left empty), and missing lists the indices that weren't cached.
+        """
+        keys = [hash_text(text) for text in texts]
+        vectors = np.empty((len(texts), self.dimension), dtype=np.float32)
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._read_new_keys()
+            missing = []
+            found_indices, found_rows = [], []
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is None:
+                    missing.append(i)
+                else:
+                    found_indices.append(i)
+                    found_rows.append(row)
+            if found_rows:
+                vectors[found_indices] = self._get_vectors()[found_rows]
+            self.hits += len(texts) - len(missing) # counted under the lock, since batches are embedded from several threads
+            self.misses += len(missing)
+        return keys, vectors, missing
+
+    def put_many(self, keys: list[str], vectors: np.ndarray):
+        """Append new embeddings (keys from `get_many`) to the cache"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock:
+            self._read_new_keys() # another process may have added some of these already
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            new = list({keys[i]: i for i in new}.values()) # drop duplicates within the batch
+            if not new:
+                return
+
+            # Drop anything a crashed writer left behind: partial key lines, and vectors whose keys never made it to disk
+            if os.path.exists(self.keys_path) and os.path.getsize(self.keys_path) != self._keys_offset:
+                os.truncate(self.keys_path, self._keys_offset)
+            expected_size = self._num_rows * self.dimension * 4
+            if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != expected_size:
+                os.truncate(self.vectors_path, expected_size)
+
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors[new].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_path, 'a') as f:
+                f.write(''.join(f'{keys[i]}\n' for i in new))
+            self._read_new_keys()
+
+    def info(self) -> dict:
+        return {
+            'model': self.model_name,
+            'directory': self.directory,
+            'entries': len(self._rows),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,13 +1,14 @@
 from typing import Union, List, Optional
 import pandas as pd
-from fastapi import FastAPI, BackgroundTasks, Query, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, BackgroundTasks, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 import time
-import os, json, urllib
-import lancedb
-from pydantic import BaseModel
-from . import backend
-from .utils import get_full_book_name, get_book_abbreviation, embed_batch
+import os, json, urllib, uuid, threading
+from pydantic import BaseModel, Field
+from . import backend, drafts
+from .utils import get_full_book_name, get_book_abbreviation, embed_batch, gzip_chunks, parse_byte_range, iter_file_range, format_sse
 from .types import Message, RequestModel, TranslationTriplet
 import requests
 import logging
@@ -16,13 +17,40 @@ logger = logging.getLogger('uvicorn')
 
 app = FastAPI()
 
+# Heavy resources (corpora, embedding model) load lazily on first use. By default we also start
+# loading them in the background at startup, so that the first real request doesn't pay for it.
+WARM_UP_ON_STARTUP = os.environ.get('WARM_UP_ON_STARTUP', '1') == '1'
 
-bsb_bible_df, macula_df = backend.get_dataframes() # Store these in global state
+@app.on_event("startup")
+def start_warm_up():
+    if WARM_UP_ON_STARTUP:
+        threading.Thread(target=backend.warm_up, daemon=True).start()
+
+# LLM client stats: requests, retries, and response cache hits/misses
+@app.get("/api/llm_info")
+def get_llm_info():
+    return backend.llm_client.info()
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    await backend.llm_client.aclose()
 
 @app.get("/api/python")
 def read_root():
     return {"Hello": "World"}
 
+# readiness check: 200 once the heavy resources are loaded, 503 until then
+@app.get("/api/ready")
+def get_readiness():
+    readiness = backend.get_readiness()
+    return JSONResponse(readiness, status_code=200 if readiness['ready'] else 503)
+
+# explicitly load the heavy resources in the background (e.g., if WARM_UP_ON_STARTUP is disabled)
+@app.post("/api/warm_up")
+def warm_up(background_tasks: BackgroundTasks):
+    background_tasks.add_task(backend.warm_up)
+    return {"status": "Warm-up started. Check /api/ready for progress."}
+
 # get bsb verse by ref
 @app.get("/api/bsb_verses/{full_verse_ref}")
 def read_item(full_verse_ref: str):
@@ -30,15 +58,10 @@ def read_item(full_verse_ref: str):
     Get verse from bsb_bible_df (Berean Standard Bible)
     e.g., http://localhost:3000/api/bsb_verses/GEN%202:19
     """
-    logger.info('debug: ', bsb_bible_df.head())
-    verse = bsb_bible_df[bsb_bible_df['vref'] == full_verse_ref]
-    entry_number_of_verse = verse.index[0]
-    verse_output = {
-        'verse_number': int(entry_number_of_verse),
-        'vref': verse['vref'][entry_number_of_verse],
-        'content': verse['content'][entry_number_of_verse]
-    }
-    return verse_output
+    verse = backend.get_verse_index('bsb_bible').get(full_verse_ref)
+    if verse is None:
+        return {'error': f'Verse {full_verse_ref} not found'}
+    return verse
 
 # get macula verse by ref
 @app.get("/api/macula_verses/{full_verse_ref}")
@@ -48,15 +71,10 @@ def read_macula_verse_item(full_verse_ref: str):
     e.g., http://localhost:3000/api/macula_verses/GEN%202:19
     or NT: http://localhost:3000/api/macula_verses/ROM%202:19
     """
-    logger.info('full_verse_ref', full_verse_ref)
-    verse = macula_df[macula_df['vref'] == full_verse_ref]
-    entry_number_of_verse = verse.index[0]
-    verse_output = {
-        'verse_number': int(entry_number_of_verse),
-        'vref': verse['vref'][entry_number_of_verse],
-        'content': verse['content'][entry_number_of_verse]
-    }
-    return verse_output
+    verse = backend.get_verse_index('macula').get(full_verse_ref)
+    if verse is None:
+        return {'error': f'Verse {full_verse_ref} not found'}
+    return verse
 
 # get target language data by language code
 # @app.get("/api/target_vref_data/{language_code}")
@@ -69,28 +87,41 @@ def read_macula_verse_item(full_verse_ref: str):
 #     return target_vref_data
 
 @app.get("/api/download_triplets")
-async def download_triplets(target_language_code: str, file_suffix: Optional[str] = None, force: bool=False):
+async def download_triplets(target_language_code: str, file_suffix: Optional[str] = None, force: bool=False, stream: bool=False):
+    """
+    Export every complete verse triplet for a target language as one JSON object keyed by vref.
+    With `stream=true` the JSON is streamed back as it is generated instead of being written to disk.
+    """
     print(f'target_language_code: {target_language_code}')
     filename = f"{target_language_code}_triplets.json"
     
-    verse_triplets = {}
-    book_list = backend.get_vref_list()
-    for book in book_list:
-        vref_list = backend.get_vref_list(book)
-        # print(f'vref_list: {vref_list[:10]}')
-
-        for vref in vref_list:
-            verse_triplet = backend.get_verse_triplet(vref, target_language_code, bsb_bible_df, macula_df)
-            # print('verse_triplet', verse_triplet)
-            if verse_triplet is not None:
-                verse_triplets[vref] = verse_triplet
-    print(len(verse_triplets), 'verse triplets')
-    json_str = json.dumps(verse_triplets)
-
-    # Write the json_str to a file
-    with open(filename, 'w') as f:
-        f.write(json_str)
+    verse_triplets = backend.iter_verse_triplets(target_language_code, file_suffix=file_suffix)
+    
+    if stream:
+        def generate_json():
+            yield '{'
+            for i, (vref, verse_triplet) in enumerate(verse_triplets):
+                yield f'{"," if i else ""}{json.dumps(vref)}: {json.dumps(verse_triplet)}'
+            yield '}'
+        return StreamingResponse(
+            generate_json(),
+            media_type="application/json",
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}"
+            }
+        )
+    
+    def write_json():
+        triplets = dict(verse_triplets)
+        print(len(triplets), 'verse triplets')
+        json_str = json.dumps(triplets)
+
+        # Write the json_str to a file
+        with open(filename, 'w') as f:
+            f.write(json_str)
     
+    # Joining and serializing the whole Bible is blocking work, so keep it off the event loop
+    await run_in_threadpool(write_json)
 
 
     # return FileResponse(
@@ -105,17 +136,34 @@ async def download_triplets(target_language_code: str, file_suffix: Optional[str
 # get a single verse with source text and gloss, bsb english, and target language
 @app.get("/api/verse/{full_verse_ref}&{language_code}")
 def get_verse(full_verse_ref: str, language_code: str):
-    return backend.get_verse_triplet(full_verse_ref, language_code, bsb_bible_df, macula_df)
+    return backend.get_verse_triplet(full_verse_ref, language_code)
 
 @app.get("/api/bible")
-async def get_bible(language_code: str, file_suffix: Optional[str], force: Optional[bool], background_tasks: BackgroundTasks):
+async def get_bible(
+        language_code: str, 
+        file_suffix: Optional[str], 
+        force: Optional[bool], 
+        background_tasks: BackgroundTasks, 
+        request: Request, 
+        stream: bool = False, 
+        gzip: bool = False, 
+        book: Optional[str] = None, 
+        start_vref: Optional[str] = None):
     """
     Get the entire Bible from bsb_bible_df, 
     AND macula_df (greek and hebrew)
     AND target_vref_data (target language)
     
     e.g., http://localhost:3000/api/bible/aai
+    
+    With `stream=true`, verses are streamed back as NDJSON (one {vref, bsb, macula, target} object per line)
+    a book at a time, optionally gzipped (`gzip=true`) and filtered by `book` (e.g., GEN)
+    or resumed from `start_vref` (e.g., GEN 2:19); an unknown language, book or start_vref is a 404.
+    Uncompressed, unfiltered exports support `Range: bytes=...` requests for resuming interrupted downloads:
+    they're served from the NDJSON file on disk, which is generated first if needed.
     """
+    if stream:
+        return await stream_bible(language_code, file_suffix, force, request, gzip=gzip, book=book, start_vref=start_vref)
     
     filename = f'data/bible/{language_code}{file_suffix}.json'
     
@@ -133,30 +181,79 @@ async def get_bible(language_code: str, file_suffix: Optional[str], force: Optio
     background_tasks.add_task(process_bible, language_code, file_suffix)
     return {"status": "Processing started. Check back later for results."}
 
-async def process_bible(language_code: str, file_suffix: Optional[str] = None): 
-    target_vref_df = backend.get_target_vref_df(language_code, file_suffix=file_suffix)
+def get_bible_request_error(language_code: str, file_suffix: Optional[str], book=None, start_vref=None) -> Optional[str]:
+    if backend.get_verse_index(language_code, file_suffix=file_suffix) is None:
+        return f'No corpus found for language code {language_code}'
+    if book and book not in backend.get_vref_list():
+        return f'Unknown book {book}'
+    if start_vref and start_vref not in backend.get_verse_index('bsb'):
+        return f'Verse {start_vref} not found'
+    return None
+
+async def stream_bible(language_code: str, file_suffix: Optional[str], force: Optional[bool], request: Request, gzip=False, book=None, start_vref=None):
+    """Stream the Bible as NDJSON, see `get_bible`"""
+    error = await run_in_threadpool(get_bible_request_error, language_code, file_suffix, book, start_vref)
+    if error:
+        return JSONResponse({'error': error}, status_code=404)
     
-    output = []
-    for vref in bsb_bible_df['vref']:
-        bsb_row = bsb_bible_df[bsb_bible_df['vref'] == vref]
-        macula_row = macula_df[macula_df['vref'] == vref]
-        target_row = target_vref_df[target_vref_df['vref'] == vref]
-        
-        output.append({
-            'vref': vref,
-            'bsb': {
-                'vref': bsb_row['vref'].values[0] if not bsb_row.empty else '',
-                'content': bsb_row['content'].values[0] if not bsb_row.empty else ''
-            },
-            'macula': {
-                'vref': macula_row['vref'].values[0] if not macula_row.empty else '',
-                'content': macula_row['content'].values[0] if not macula_row.empty else ''
-            },
-            'target': {
-                'vref': target_row['vref'].values[0] if not target_row.empty else '',
-                'content': target_row['content'].values[0] if not target_row.empty else ''
-            }
-        })
+    filename = f'data/bible/{language_code}{file_suffix}.ndjson'
+    is_filtered = bool(book or start_vref)
+    headers = {
+        "Content-Disposition": f"attachment; filename={language_code}.ndjson",
+    }
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    elif not is_filtered:
+        headers["Accept-Ranges"] = "bytes" # ranges are served from the complete export on disk
+    range_header = None if gzip or is_filtered else request.headers.get('range')
+    
+    def generate_ndjson():
+        # Only unfiltered exports are saved, so that the cached file is always the whole Bible
+        os.makedirs('data/bible', exist_ok=True)
+        tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+        cache_file = None if is_filtered else open(tmp_filename, 'w', encoding='utf8')
+        try:
+            for _, records in backend.iter_bible_books(language_code, file_suffix=file_suffix, book=book, start_vref=start_vref):
+                chunk = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records) # one book at a time
+                if cache_file:
+                    cache_file.write(chunk)
+                yield chunk.encode('utf8')
+            if cache_file:
+                cache_file.close()
+                os.replace(tmp_filename, filename)
+        finally:
+            if cache_file and not cache_file.closed: # client went away before the export finished
+                cache_file.close()
+                os.remove(tmp_filename)
+    
+    if range_header and (force or not os.path.exists(filename)):
+        # A range needs the size of the complete export, so write it to disk first and serve the range from there
+        def write_export():
+            for _ in generate_ndjson():
+                pass
+        await run_in_threadpool(write_export)
+        force = False
+    
+    # Serve the complete export from disk if we already have it (ranges only apply to uncompressed output)
+    if os.path.exists(filename) and not force and not is_filtered:
+        file_size = os.path.getsize(filename)
+        try:
+            byte_range = parse_byte_range(range_header, file_size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{file_size}"})
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(iter_file_range(filename, start, end), status_code=206, media_type="application/x-ndjson", headers=headers)
+        chunks = iter_file_range(filename)
+        return StreamingResponse(gzip_chunks(chunks) if gzip else chunks, media_type="application/x-ndjson", headers=headers)
+    
+    chunks = generate_ndjson()
+    return StreamingResponse(gzip_chunks(chunks) if gzip else chunks, media_type="application/x-ndjson", headers=headers)
+
+async def process_bible(language_code: str, file_suffix: Optional[str] = None): 
+    output = list(backend.iter_bible_verses(language_code, file_suffix=file_suffix))
     
     # Save output to disk as `data/bible/{language_code}.json`
     if not os.path.exists('data/bible'):
@@ -179,8 +276,10 @@ async def process_bible(language_code: str, file_suffix: Optional[str] = None):
 def get_db_info():
     output = []
     
-    db = lancedb.connect("./lancedb")
-    table = db.open_table('verses').to_pandas()
+    table = backend.get_table_from_database('verses')
+    if table is None:
+        return output
+    table = table.to_pandas()
     
     # Get unique languages in the table
     languages = table['language'].unique()
@@ -194,6 +293,11 @@ def get_db_info():
     
     return output
 
+# endpoint to see which corpora are currently loaded in memory
+@app.get("/api/corpus_info")
+def get_corpus_info():
+    return backend.corpus_store.info()
+
 @app.get("/api/populate_db")
 def populate_db(target_language_code: str, file_suffix: str, background_tasks: BackgroundTasks):
     """
@@ -202,16 +306,15 @@ def populate_db(target_language_code: str, file_suffix: str, background_tasks: B
     """
     
     # Check if db exists
-    if os.path.exists('./lancedb'):
-        db = lancedb.connect("./lancedb")
+    if os.path.exists(backend.DATABASE_PATH):
         try:
-            table = db.open_table('verses').to_pandas()
+            table = backend.get_table_from_database('verses').to_pandas()
             if target_language_code in table['language'].unique():
                 return {"status": "Language already exists in the database. Please delete the language data and try again."}
         except:
             if target_language_code.startswith('init'): # To initialize databases
                 logger.info('Initializing Greek/Hebrew and English vectorstores...')
-                background_tasks.add_task(backend.create_lancedb_table_from_df, bsb_bible_df, 'verses') # load_database loads up the macula and bsb tables by default if they don't exist... Probably should make this less magical in the future
+                background_tasks.add_task(backend.create_lancedb_table_from_df, backend.get_dataframes()[0], 'verses') # load_database loads up the macula and bsb tables by default if they don't exist... Probably should make this less magical in the future
                 return {"status": f"Database initialization started for {target_language_code + file_suffix}... takes about 45 seconds for 10 lines of text and ~300 seconds for the whole Bible, so be patient!"}
     
     logger.info('Populating database...')
@@ -219,19 +322,60 @@ def populate_db(target_language_code: str, file_suffix: str, background_tasks: B
     return {"status": "Database population started... takes about 45 seconds for 10 lines of text and ~300 seconds for the whole Bible, so be patient!"}
 
 
+# ANN index status for a table, and a recall-vs-latency report against exact search
+@app.get("/api/vector_index/{table_name}")
+def get_vector_index_report(table_name: str, num_queries: int = 50, k: int = 10):
+    return backend.get_vector_index_report(table_name, num_queries=num_queries, k=k)
+
+@app.post("/api/vector_index/{table_name}")
+def build_vector_index(table_name: str, background_tasks: BackgroundTasks, force: bool = False):
+    background_tasks.add_task(backend.build_vector_index, table_name, force)
+    return {"status": f"Building vector index for {table_name}. Check /api/vector_index/{table_name} for progress."}
+
 @app.get("/api/query/{language_code}/{query}&limit={limit}")
 def call_query_endpoint(language_code: str, query: str, limit: str = '10'):
     return backend.query_lancedb_table(language_code, query, limit=limit)
 
+class BatchQueryRequest(BaseModel):
+    language_code: str
+    queries: List[str] = Field(default_factory=list)
+    vrefs: List[str] = Field(default_factory=list)
+    limit: int = 10
+    exclude_self: bool = True
+    target_language_code: Optional[str] = None
+    drop_empty_targets: bool = False
+
+# Similar verses for many query texts and/or vrefs at once (e.g., a whole chapter)
+@app.post("/api/query_batch")
+def call_query_batch_endpoint(request: BatchQueryRequest):
+    return backend.query_lancedb_table_batch(
+        request.language_code, 
+        queries=request.queries, 
+        vrefs=request.vrefs, 
+        limit=request.limit, 
+        exclude_self=request.exclude_self, 
+        target_language_code=request.target_language_code, 
+        drop_empty_targets=request.drop_empty_targets)
+
 # User should be able to submit vref + source language + target language to a /api/translation-prompt-builder/ endpoint
 @app.get("/api/translation-prompt-builder")
-def get_translation_prompt(vref: str, target_language_code: str, source_language_code: str='', bsb_bible_df=None, macula_df=None, number_of_examples: int = 3):
-    """Get a forward-translation few-shot prompt for a given vref, source, and target language code."""
+def get_translation_prompt(vref: str, target_language_code: str, source_language_code: str='', bsb_bible_df=None, macula_df=None, number_of_examples: int = 3, token_counts: bool = False):
+    """
+    Get a forward-translation few-shot prompt for a given vref, source, and target language code.
+    With token_counts=true, returns {'prompt': ..., 'token_counts': ...}, where the counts show how the prompt fits
+    the model's context (prompt size, the max_tokens left for the translation, tokens per example, examples skipped).
+    """
     
     # Decode URI vref
     vref = urllib.parse.unquote(vref)
     print(f'vref: {vref}')
-    return backend.build_translation_prompt(vref, target_language_code, source_language_code=source_language_code, bsb_bible_df=bsb_bible_df, macula_df=macula_df, number_of_examples=number_of_examples)
+    try:
+        context = backend.TranslationContext(vref, target_language_code, source_language_code, number_of_examples)
+    except ValueError as e: # the verse alone overflows the context
+        return {'error': str(e)}
+    if token_counts:
+        return {'prompt': context.prompt, 'token_counts': context.get_token_counts()}
+    return context.prompt
 
 @app.get("/api/vrefs/?book={book}")
 def get_vrefs(book: str):
@@ -244,10 +388,20 @@ def get_vrefs():
     return backend.get_vref_list()
 
 @app.get("/api/unique_tokens")
-def get_unique_tokens(language_code: str):
+def get_unique_tokens(language_code: str, offset: int = 0, limit: int = 100, prefix: Optional[str] = None, subset: Optional[str] = None, all: bool = False):
     print(f'language_code: {language_code}')
-    """Get a list of unique tokens from the ebible corpus texts by language code."""
-    return backend.get_unique_tokens_for_language(language_code)
+    """
+    Get a page of unique tokens from the ebible corpus texts by language code.
+    Pass offset/limit to page through tokens by frequency, prefix to look tokens up,
+    or subset=hapax|oov_bsb|oov_macula for tokens that occur once or are missing from BSB/Macula.
+    Pass all=true for the whole vocabulary as {token: count}.
+    """
+    return backend.get_unique_tokens_for_language(language_code, offset=offset, limit=limit, prefix=prefix, subset=subset, all=all)
+
+@app.get("/api/vocabulary_stats")
+def get_vocabulary_stats(language_code: str):
+    """Token, hapax and out-of-vocabulary counts for a language"""
+    return backend.get_vocabulary_stats(language_code)
 
 
 '''
@@ -295,7 +449,7 @@ class EvaluateTranslationRequest(BaseModel):
     hypothesis_vref: str
 
 @app.post("/api/evaluate")
-def evaluate_translation_prompt(request: EvaluateTranslationRequest):
+async def evaluate_translation_prompt(request: EvaluateTranslationRequest, use_cache: Optional[bool] = None):
     verse_triplets = request.verse_triplets
     hypothesis_vref = request.hypothesis_vref
 
@@ -305,16 +459,16 @@ def evaluate_translation_prompt(request: EvaluateTranslationRequest):
     if hypothesis_vref not in valid_vrefs:
         return {"status": f"You submitted vref {hypothesis_vref}, but this vref is not in the ebible corpus. See https://raw.githubusercontent.com/BibleNLP/ebible/main/metadata/vref.txt for valid vrefs."}
     
-    prediction = backend.execute_discriminator_evaluation(verse_triplets, hypothesis_vref=hypothesis_vref)
+    prediction = await backend.execute_discriminator_evaluation_async(verse_triplets, hypothesis_vref=hypothesis_vref, use_cache=use_cache)
     
     return {"input_received": verse_triplets, "hypothesis_vref": hypothesis_vref, "prediction": prediction}
 
 @app.get("/api/evaluate_test")
-def evaluate_translation_prompt_test():
+async def evaluate_translation_prompt_test():
     verse_triplets = {"ACT 13:47":{"Greek/Hebrew Source":"οὕτως γὰρ ἐντέταλται ἡμῖν ὁ Κύριος Τέθεικά σε εἰς φῶς ἐθνῶν τοῦ εἶναί σε εἰς σωτηρίαν ἕως ἐσχάτου τῆς γῆς.","English Reference":"For this is what the Lord has commanded us: ‘I have made you a light for the Gentiles, to bring salvation to the ends of the earth.’”","Target":"Anayabin Regah ana obaiyunen tur biti iti na’atube eo, ‘Ayu kwa ayasairi Ufun Sabuw hai marakaw isan, saise kwa i boro yawas kwanab kwanatit kwanan tafaram yomanin kwanatit.’"},"ACT 3:20":{"Greek/Hebrew Source":"ὅπως ἂν ἔλθωσιν καιροὶ ἀναψύξεως ἀπὸ προσώπου τοῦ Κυρίου καὶ ἀποστείλῃ τὸν προκεχειρισμένον ὑμῖν Χριστὸν Ἰησοῦν,","English Reference":"that times of refreshing may come from the presence of the Lord, and that He may send Jesus, the Christ, who has been appointed for you.","Target":"Nati namamatar ana veya, imaibo ayub ana fair bain baiboubun isan boro Regah wanawananamaim nan biya natit. Jesu, i ana Roubinineyan orot marasika kwa isa rurubin boro niyafar."},"LAM 2:13":{"Greek/Hebrew Source":"מָ֣ה אֲדַמֶּה־ לָּ֗ךְ הַבַּת֙ יְר֣וּשָׁלִַ֔ם מָ֤ה אַשְׁוֶה־ לָּךְ֙ וַאֲנַֽחֲמֵ֔ךְ בְּתוּלַ֖ת בַּת־ צִיּ֑וֹן כִּֽי־ גָד֥וֹל כַּיָּ֛ם שִׁבְרֵ֖ךְ מִ֥י יִרְפָּא־ לָֽךְ׃ס","English Reference":"What can I say for you? To what can I compare you, O Daughter of Jerusalem? To what can I liken you, that I may console you, O Virgin Daughter of Zion? For your wound is as deep as the sea. Who can ever heal you?","Target":""},"ROM 1:8":{"Greek/Hebrew Source":"Πρῶτον μὲν εὐχαριστῶ τῷ Θεῷ μου διὰ Ἰησοῦ Χριστοῦ περὶ πάντων ὑμῶν, ὅτι ἡ πίστις ὑμῶν καταγγέλλεται ἐν ὅλῳ τῷ κόσμῳ.","English Reference":"First, I thank my God through Jesus Christ for all of you, because your faith is being proclaimed all over the world.","Target":"This is the hypothesized verse translation."}}
     verse_triplets: dict[str, TranslationTriplet] = { k: TranslationTriplet(**v) for k, v in verse_triplets.items() }
     # return {"status": "Evaluation prompted", "input_received": verse_triplets, "hypothesis_vref": None, "hypothesis_key": None}
-    return backend.execute_discriminator_evaluation(verse_triplets, hypothesis_vref='ROM 1:8')
+    return await backend.execute_discriminator_evaluation_async(verse_triplets, hypothesis_vref='ROM 1:8')
   
 # @app.websocket("/api/test_feedback_loop")
 # async def test_feedback_loop(websocket: WebSocket, vref: str = Query(...), target_language_code: str = Query(...), source_language_code: str = Query(None)):
@@ -328,11 +482,83 @@ def evaluate_translation_prompt_test():
 #         await websocket.send_json(result)
 #     await websocket.close()
 
+async def stream_translation_events(translation: backend.Translation, request: Request):
+    events = translation.stream_async()
+    try:
+        async for event, data in events:
+            if await request.is_disconnected():
+                logger.info(f'Client disconnected, stopping the translation of {translation.vref}')
+                return
+            yield format_sse(event, data)
+    except Exception as e:
+        logger.error(f'Streaming translation of {translation.vref} failed: {e}')
+        yield format_sse('error', {'error': str(e)})
+    finally:
+        await events.aclose() # closes the upstream LLM stream and frees its slot
+    yield format_sse('done', {})
+
 @app.get('/api/translate')
-def forward_translation_request(vref: str, target_language_code: str):
-    translation = backend.Translation(vref, target_language_code=target_language_code)
+async def forward_translation_request(request: Request, vref: str, target_language_code: str, stream: bool = False, use_cache: Optional[bool] = None):
+    """
+    Translate a verse and evaluate the result.
+    With stream=true, the response is a server-sent event stream: 'token' events as the translation
+    is generated, then 'hypothesis', 'feedback' and finally 'done' (or 'error').
+    Translations are sampled, so each call gets a fresh one; pass use_cache=true to reuse the cached response for the same prompt.
+    """
+    translation = backend.Translation(vref, target_language_code=target_language_code, run=False, use_cache=use_cache)
+    if stream:
+        events = stream_translation_events(translation, request)
+        return StreamingResponse(
+            events,
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, # don't let proxies buffer the events
+            background=BackgroundTask(events.aclose), # a disconnect cancels the response mid-send, leaving the generator open
+        )
+    await translation.run_async()
     return str({'hypothesis': translation.get_hypothesis(), 'feedback': translation.get_feedback()})
 
+class DraftRequest(BaseModel):
+    target_language_code: str
+    book: str
+    chapter: Optional[int] = None
+    concurrency: int = drafts.DRAFT_CONCURRENCY
+    restart: bool = False
+
+# Draft a whole book (or chapter) in the background; re-posting the same job resumes it
+@app.post("/api/drafts")
+async def start_draft(request: DraftRequest):
+    job = await drafts.start_draft_job(request.target_language_code, request.book, request.chapter, concurrency=request.concurrency, restart=request.restart)
+    if isinstance(job, dict): # {'error': ...}
+        return JSONResponse(job, status_code=409) if 'job' in job else job
+    return job.progress()
+
+@app.get("/api/drafts")
+def list_drafts():
+    return [job.progress() for job in drafts.draft_jobs.values()]
+
+@app.get("/api/drafts/{job_id}")
+def get_draft_progress(job_id: str):
+    job = drafts.draft_jobs.get(job_id)
+    if job is None:
+        return {'error': f'No draft job {job_id}'}
+    return job.progress()
+
+@app.get("/api/drafts/{job_id}/results")
+def get_draft_results(job_id: str):
+    """The job's results so far, as JSON lines (in completion order)"""
+    path = os.path.join(drafts.DRAFTS_DIR, f'{job_id}.jsonl')
+    if '/' in job_id or '..' in job_id or not os.path.exists(path):
+        return {'error': f'No results for draft job {job_id}'}
+    return FileResponse(path, media_type='application/x-ndjson', filename=f'{job_id}.jsonl')
+
+@app.delete("/api/drafts/{job_id}")
+def cancel_draft(job_id: str):
+    job = drafts.draft_jobs.get(job_id)
+    if job is None:
+        return {'error': f'No draft job {job_id}'}
+    job.cancel()
+    return {"status": f"Cancelling draft job {job_id}. Post it again to resume."}
+
 import random
 @app.get('/api/get_alignment')
 def get_available_alignment(language_code=None, n=10):
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Optional
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_DIR = os.environ.get('LLM_CACHE_DIR', 'data/llm_cache')
+LLM_CACHE_SIZE_MB = int(os.environ.get('LLM_CACHE_SIZE_MB', 512)) # least-recently-used entries are evicted past this
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 30 * 24 * 60 * 60))
+
+# Request fields that don't change what the model generates
+IGNORED_REQUEST_FIELDS = {'stream', 'user', 'api_key'}
+
+
+def normalize_text(text: str) -> str:
+    """Collapse runs of spaces/tabs and strip trailing whitespace, so formatting noise doesn't defeat the cache"""
+    lines = [re.sub(r'[ \t]+', ' ', line).rstrip() for line in text.strip().split('\n')]
+    return '\n'.join(lines)
+
+
+def normalize_request(value: Any) -> Any:
+    if isinstance(value, str):
+        return normalize_text(value)
+    if isinstance(value, dict):
+        return {key: normalize_request(item) for key, item in value.items() if key not in IGNORED_REQUEST_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return [normalize_request(item) for item in value]
+    return value
+
+
+def is_deterministic(request: dict) -> bool:
+    """Whether repeating a request gives the same completion: greedy decoding (temperature 0) or a fixed sampling seed"""
+    return request.get('temperature', 1) == 0 or request.get('seed') is not None # the OpenAI API samples at temperature 1 unless told otherwise
+
+
+def make_cache_key(request: dict) -> str:
+    """
+    Cache key for an LLM request: the normalized prompt/messages plus the model and every sampling param.
+    Anything non-JSON (e.g. a prompt dict of TranslationTriplets) is keyed on its string form.
+    """
+    normalized = json.dumps(normalize_request(request), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(normalized.encode('utf8')).hexdigest()
+
+
+class LLMResponseCache():
+    """
+    Persistent cache of LLM responses (a diskcache.Cache, so it's shared between processes and restarts).
+
+    Entries expire after `ttl_seconds`, and the least-recently-used ones are evicted once the cache
+    grows past `size_limit_mb`. Unseeded sampling (temperature > 0) is not deterministic, so a hit would return
+    the first response generated for that request: `LLMClient` only caches requests that `is_deterministic`
+    unless the caller opts in with `use_cache=True`.
+    """
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, size_limit_mb: int = LLM_CACHE_SIZE_MB, ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.size_limit = size_limit_mb * 1024 * 1024
+        self.ttl_seconds = ttl_seconds
+        self._cache = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _get_cache(self):
+        # Opened on first use, so that importing this module doesn't touch the disk
+        with self._lock:
+            if self._cache is None:
+                import diskcache
+                self._cache = diskcache.Cache(self.directory, size_limit=self.size_limit, eviction_policy='least-recently-used')
+            return self._cache
+
+    def get(self, request: dict) -> Optional[Any]:
+        response = self._get_cache().get(make_cache_key(request))
+        with self._lock: # counted under the lock, since requests come in on several threads
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def set(self, request: dict, response: Any):
+        self._get_cache().set(make_cache_key(request), response, expire=self.ttl_seconds)
+        with self._lock:
+            self.writes += 1
+
+    def delete(self, request: dict):
+        self._get_cache().delete(make_cache_key(request))
+
+    def get_or_create(self, request: dict, create: Callable[[], Any], use_cache: bool = True, validate: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Return the cached response for a request, or call `create()` and cache its result.
+        With `validate`, only responses it accepts are cached (e.g., so an unparseable answer is retried next time).
+        """
+        if use_cache:
+            response = self.get(request)
+            if response is not None:
+                return response
+        response = create()
+        if use_cache and response is not None and (validate is None or validate(response)):
+            self.set(request, response)
+        return response
+
+    def clear(self):
+        self._get_cache().clear()
+
+    def info(self) -> dict:
+        lookups = self.hits + self.misses
+        info = {
+            'directory': self.directory,
+            'size_limit_mb': self.size_limit / 1024 / 1024,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+        if self._cache is not None:
+            info['entries'] = len(self._cache)
+            info['size_mb'] = self._cache.volume() / 1024 / 1024
+        return info
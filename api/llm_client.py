@@ -0,0 +1,340 @@
+import os, time, json, random, asyncio, threading
+from collections import deque
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from .llm_cache import LLMResponseCache, is_deterministic
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Connection pool, concurrency and timeouts for the local (OpenAI-compatible) LLM server
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 16))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 4)) # in-flight requests per process (a local server generates a few at a time)
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', 5))
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', 300)) # a full generation can take minutes
+# Retries on connection errors, timeouts, 429 and 5xx, with jittered exponential backoff
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 3))
+LLM_BACKOFF_SECONDS = float(os.environ.get('LLM_BACKOFF_SECONDS', 0.5))
+LLM_MAX_BACKOFF_SECONDS = float(os.environ.get('LLM_MAX_BACKOFF_SECONDS', 20))
+# Sampling seed sent with the app's requests, so that a repeated prompt gets the same completion (and is served from the response cache)
+LLM_SEED = int(os.environ.get('LLM_SEED', 42))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ConcurrencyLimit():
+    """
+    At most `limit` holders at once, shared by threads (`with limit:`) and event loops (`async with limit:`).
+
+    Waiters are served first come, first served: a released slot is handed straight to the next
+    waiter, so threads and coroutines can't overtake each other.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._lock = threading.Lock()
+        self._waiters: deque = deque() # threading.Event (threads) or asyncio.Future (coroutines)
+
+    def acquire(self):
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait() # the slot is handed over by `release`
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                return
+            future = loop.create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if future in self._waiters: # still waiting, so there's no slot to give back
+                    self._waiters.remove(future)
+                    raise
+            if not future.cancelled(): # the slot arrived just before the cancellation
+                self.release()
+            raise # (a slot handed to a cancelled future is passed on by `_wake`)
+
+    def _wake(self, future: asyncio.Future):
+        if future.done(): # cancelled while the slot was on its way
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                else:
+                    waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+                return
+            self.in_use -= 1
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class LLMClient():
+    """
+    Pooled HTTP client for the LLM server's `/v1/chat/completions` endpoint.
+
+    `chat_completion` is async (for the API handlers); `chat_completion_sync` is the blocking
+    equivalent (for `RevisionLoop`, scripts and threads). Each keeps its own keep-alive connection
+    pool, and both share one cap on how many requests are in flight at once (`max_concurrency`).
+    The async client is bound to the event loop it was first used on, and is recreated if it is
+    used from another loop.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_seconds: float = LLM_BACKOFF_SECONDS,
+        cache: Optional[LLMResponseCache] = None,
+    ):
+        self.base_url = base_url
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+        self._lock = threading.Lock()
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_loop = None
+        self._sync_client: Optional[httpx.Client] = None
+        self.concurrency_limit = ConcurrencyLimit(max_concurrency)
+
+        self._stats_lock = threading.Lock() # counters are updated from threads and the event loop
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.in_flight = 0
+
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._async_client is None or self._async_loop is not loop:
+                # NOTE: the old client belongs to a loop that's gone (e.g. between tests), so it's simply dropped
+                self._async_client = httpx.AsyncClient(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+                self._async_loop = loop
+            return self._async_client
+
+    def _get_sync_client(self) -> httpx.Client:
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+            return self._sync_client
+
+    def _count(self, name: str, delta: int = 1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def get_backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Seconds to wait before retry number `attempt` (0-based): Retry-After if the server sent one, else jittered exponential backoff"""
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            if retry_after is not None:
+                try:
+                    return min(float(retry_after), LLM_MAX_BACKOFF_SECONDS)
+                except ValueError:
+                    pass
+        backoff = min(self.backoff_seconds * (2 ** attempt), LLM_MAX_BACKOFF_SECONDS)
+        return backoff * random.uniform(0.5, 1.5)
+
+    def _should_retry(self, attempt: int, response: Optional[httpx.Response]) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        return response is None or response.status_code in RETRY_STATUS_CODES
+
+    def _get_cache_request(self, payload: dict, path: str) -> dict:
+        return {**payload, 'base_url': self.base_url, 'path': path} # the server stands in for the model if the payload doesn't name one
+
+    def _should_use_cache(self, payload: dict, use_cache: Optional[bool]) -> bool:
+        """By default only deterministic (temperature 0 or seeded) requests are cached, so unseeded samples stay samples; `use_cache` overrides that"""
+        if self.cache is None:
+            return False
+        if use_cache is None:
+            return is_deterministic(payload)
+        return use_cache
+
+    async def chat_completion(self, payload: dict, path: str = '/v1/chat/completions', use_cache: Optional[bool] = None) -> dict:
+        """POST a chat completion request and return the parsed JSON response (from the response cache, see `_should_use_cache`)"""
+        if not self._should_use_cache(payload, use_cache):
+            return await self._post(payload, path)
+        cache_request = self._get_cache_request(payload, path)
+        # NOTE: diskcache reads and writes SQLite and files, so they run in a worker thread rather than on the event loop
+        response = await asyncio.to_thread(self.cache.get, cache_request)
+        if response is None:
+            response = await self._post(payload, path)
+            await asyncio.to_thread(self.cache.set, cache_request, response)
+        return response
+
+    async def _post(self, payload: dict, path: str) -> dict:
+        client = self._get_async_client()
+        attempt = 0
+        async with self.concurrency_limit:
+            self._count('in_flight')
+            try:
+                while True:
+                    self._count('requests')
+                    response, error = None, None
+                    try:
+                        response = await client.post(path, json=payload)
+                        if response.status_code not in RETRY_STATUS_CODES:
+                            if response.is_error:
+                                self._count('failures')
+                            response.raise_for_status()
+                            return response.json()
+                    except httpx.TransportError as e:
+                        error = e
+                    if not self._should_retry(attempt, response):
+                        self._count('failures')
+                        if response is not None:
+                            response.raise_for_status()
+                        raise error
+                    backoff = self.get_backoff(attempt, response)
+                    logger.warning(f'LLM request failed ({error or response.status_code}), retrying in {backoff:.2f} seconds')
+                    self._count('retries')
+                    attempt += 1
+                    await asyncio.sleep(backoff)
+            finally:
+                self._count('in_flight', -1)
+
+    async def stream_chat_completion(self, payload: dict, path: str = '/v1/chat/completions') -> AsyncIterator[dict]:
+        """
+        POST a chat completion request with `stream: true` and yield the parsed server-sent chunks
+        (OpenAI format: `{'choices': [{'delta': {'content': ...}}], ...}`) as they arrive.
+        Failures are only retried before the first chunk; after that the error is raised to the caller.
+        Streamed responses don't go through the response cache.
+        """
+        client = self._get_async_client()
+        payload = {**payload, 'stream': True}
+        attempt = 0
+        # NOTE: the slot is held until the caller finishes (or `aclose`s) the generator, so release it and close the upstream response in `finally`
+        await self.concurrency_limit.acquire_async()
+        self._count('in_flight')
+        try:
+            while True:
+                self._count('requests')
+                response, error, started = None, None, False
+                try:
+                    response = await client.send(client.build_request('POST', path, json=payload), stream=True)
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        if response.is_error:
+                            self._count('failures')
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if not line.startswith('data:'):
+                                continue
+                            data = line[len('data:'):].strip()
+                            if data == '[DONE]':
+                                return
+                            started = True
+                            yield json.loads(data)
+                        return
+                except httpx.TransportError as e:
+                    if started: # can't retry without repeating tokens the caller already has
+                        self._count('failures')
+                        raise
+                    error = e
+                finally:
+                    if response is not None:
+                        await response.aclose()
+                if not self._should_retry(attempt, response):
+                    self._count('failures')
+                    if response is not None:
+                        response.raise_for_status()
+                    raise error
+                backoff = self.get_backoff(attempt, response)
+                logger.warning(f'LLM request failed ({error or response.status_code}), retrying in {backoff:.2f} seconds')
+                self._count('retries')
+                attempt += 1
+                await asyncio.sleep(backoff)
+        finally:
+            self._count('in_flight', -1)
+            self.concurrency_limit.release()
+
+    def chat_completion_sync(self, payload: dict, path: str = '/v1/chat/completions', use_cache: Optional[bool] = None) -> dict:
+        """Blocking version of `chat_completion`"""
+        if not self._should_use_cache(payload, use_cache):
+            return self._post_sync(payload, path)
+        return self.cache.get_or_create(self._get_cache_request(payload, path), lambda: self._post_sync(payload, path))
+
+    def _post_sync(self, payload: dict, path: str) -> dict:
+        client = self._get_sync_client()
+        attempt = 0
+        with self.concurrency_limit:
+            self._count('in_flight')
+            try:
+                while True:
+                    self._count('requests')
+                    response, error = None, None
+                    try:
+                        response = client.post(path, json=payload)
+                        if response.status_code not in RETRY_STATUS_CODES:
+                            if response.is_error:
+                                self._count('failures')
+                            response.raise_for_status()
+                            return response.json()
+                    except httpx.TransportError as e:
+                        error = e
+                    if not self._should_retry(attempt, response):
+                        self._count('failures')
+                        if response is not None:
+                            response.raise_for_status()
+                        raise error
+                    backoff = self.get_backoff(attempt, response)
+                    logger.warning(f'LLM request failed ({error or response.status_code}), retrying in {backoff:.2f} seconds')
+                    self._count('retries')
+                    attempt += 1
+                    time.sleep(backoff)
+            finally:
+                self._count('in_flight', -1)
+
+    async def aclose(self):
+        with self._lock:
+            async_client, self._async_client = self._async_client, None
+            sync_client, self._sync_client = self._sync_client, None
+        if async_client is not None:
+            await async_client.aclose()
+        if sync_client is not None:
+            sync_client.close()
+
+    def info(self) -> dict:
+        return {
+            'base_url': self.base_url,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'cache': self.cache.info() if self.cache is not None else None,
+        }
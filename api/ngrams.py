@@ -0,0 +1,163 @@
+import threading
+from typing import Any, Iterable, Optional
+
+TOKEN_ID_BITS = 21 # up to ~2M distinct tokens per language
+TOKEN_ID_MASK = (1 << TOKEN_ID_BITS) - 1
+MAX_NGRAM_SIZE = 10
+
+
+def tokenize(content: Any) -> list[str]:
+    """Whitespace tokens of a verse, as used for the n-gram and token counts"""
+    if not isinstance(content, str):
+        return []
+    return [token for token in content.split(' ') if token != '']
+
+
+class NgramIndex():
+    """
+    N-gram counts for one corpus, kept in memory and updated verse by verse.
+
+    Tokens are interned to integer ids, and each n-gram is packed into a single int key
+    (TOKEN_ID_BITS per token), so counts are plain int -> int dicts. Counts for a given size
+    (and all smaller sizes) are built the first time that size is requested, and are then kept
+    up to date by `update_verse`, which only recounts the verses whose content actually changed.
+
+    Verses are keyed by their row position in the corpus, not by vref, so that duplicate vref rows
+    (e.g., from versification differences) are each counted, as a full rebuild would.
+
+    NOTE: n-grams don't cross verse boundaries.
+    """
+
+    def __init__(self):
+        self.token_ids: dict[str, int] = {}
+        self.tokens: list[str] = []
+        self.verse_contents: dict[int, Any] = {} # row position -> content
+        self.verse_token_ids: dict[int, list[int]] = {}
+        self.counts: dict[int, dict[int, int]] = {} # size -> packed n-gram -> count
+        self._most_common: dict[int, list[tuple[int, int]]] = {} # size -> counts sorted by frequency, reset on change
+        self.source: Any = None # the corpus object we last synced from (see `sync`)
+        self.version = 0 # bumped on every change, so that derived data (e.g., vocabularies) knows when to rebuild
+        self.num_ngrams = 0 # running totals for `nbytes`, so that sizing the index doesn't walk it
+        self.num_token_ids = 0
+        self.lock = threading.RLock()
+
+    def intern(self, token: str) -> int:
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.token_ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    @staticmethod
+    def pack(token_ids) -> int:
+        key = 0
+        for i, token_id in enumerate(token_ids):
+            key |= token_id << (TOKEN_ID_BITS * i)
+        return key
+
+    def unpack(self, key: int, size: int) -> tuple[str, ...]:
+        return tuple(self.tokens[(key >> (TOKEN_ID_BITS * i)) & TOKEN_ID_MASK] for i in range(size))
+
+    def _count_verse(self, token_ids: list[int], size: int, delta: int):
+        counts = self.counts[size]
+        for start in range(len(token_ids) - size + 1):
+            key = self.pack(token_ids[start:start + size])
+            old_count = counts.get(key, 0)
+            count = old_count + delta
+            if count > 0:
+                counts[key] = count
+                if old_count == 0:
+                    self.num_ngrams += 1
+            elif old_count:
+                del counts[key]
+                self.num_ngrams -= 1
+
+    def _build_size(self, size: int):
+        for smaller_size in range(1, size + 1):
+            if smaller_size not in self.counts:
+                self.counts[smaller_size] = {}
+                for token_ids in self.verse_token_ids.values():
+                    self._count_verse(token_ids, smaller_size, 1)
+
+    def update_verse(self, position: int, content: Any):
+        """Set the content of the verse at a row position, updating the counts of every size built so far"""
+        with self.lock:
+            if position in self.verse_contents and self.verse_contents[position] == content:
+                return
+            old_token_ids = self.verse_token_ids.get(position, [])
+            new_token_ids = [self.intern(token) for token in tokenize(content)]
+            for size in self.counts:
+                self._count_verse(old_token_ids, size, -1)
+                self._count_verse(new_token_ids, size, 1)
+            self.verse_contents[position] = content
+            self.verse_token_ids[position] = new_token_ids
+            self.num_token_ids += len(new_token_ids) - len(old_token_ids)
+            self._most_common.clear()
+            self.version += 1
+
+    def remove_verse(self, position: int):
+        with self.lock:
+            if position in self.verse_contents:
+                self.update_verse(position, '')
+                del self.verse_contents[position]
+                del self.verse_token_ids[position]
+
+    def sync(self, contents: Iterable[Any], source: Any = None):
+        """
+        Bring the index in line with a corpus given as its verse contents, in row order.
+        Only verses that changed are recounted; `source` lets repeat calls with the same corpus object skip the diff.
+        """
+        with self.lock:
+            if source is not None and source is self.source:
+                return
+            num_rows = 0
+            for position, content in enumerate(contents):
+                self.update_verse(position, content)
+                num_rows = position + 1
+            for position in [position for position in self.verse_contents if position >= num_rows]:
+                self.remove_verse(position)
+            self.source = source
+
+    def most_common(self, size: int, n: int = 100, string_filter: Optional[list[str]] = None) -> list[tuple[tuple[str, ...], int]]:
+        """
+        Top n n-grams of a size, with their counts.
+        With a string_filter, only n-grams made up entirely of tokens in string_filter are considered.
+        """
+        if not 1 <= size <= MAX_NGRAM_SIZE:
+            raise ValueError(f'N-gram size must be between 1 and {MAX_NGRAM_SIZE}')
+        with self.lock:
+            self._build_size(size)
+            if string_filter:
+                ranked = self._filtered(size, string_filter)
+            else:
+                if size not in self._most_common:
+                    self._most_common[size] = sorted(self.counts[size].items(), key=lambda item: -item[1])
+                ranked = self._most_common[size]
+            return [(self.unpack(key, size), count) for key, count in ranked[:n]]
+
+    def _filtered(self, size: int, string_filter: list[str]) -> list[tuple[int, int]]:
+        # Grow n-grams one allowed token at a time; an n-gram can only exist if its prefix does
+        allowed = {self.token_ids[token] for token in string_filter if token in self.token_ids}
+        prefixes = [[token_id] for token_id in allowed if self.pack([token_id]) in self.counts[1]]
+        for prefix_size in range(2, size + 1):
+            counts = self.counts[prefix_size]
+            prefixes = [prefix + [token_id] for prefix in prefixes for token_id in allowed if self.pack(prefix + [token_id]) in counts]
+        counts = self.counts[size]
+        return sorted(((self.pack(ngram), counts[self.pack(ngram)]) for ngram in prefixes), key=lambda item: -item[1])
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Rough in-memory size (Python dicts and lists of ints, ~100 bytes per entry), for the corpus memory budget.
+        Read from running totals without taking the lock, since the corpus store sizes entries under its own lock.
+        """
+        return 100 * (len(self.tokens) + len(self.verse_contents) + self.num_ngrams) + 40 * self.num_token_ids
+
+    def info(self) -> dict:
+        with self.lock:
+            return {
+                'verses': len(self.verse_contents),
+                'tokens': len(self.tokens),
+                'ngrams': {size: len(counts) for size, counts in self.counts.items()},
+            }
@@ -0,0 +1,68 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from api.corpus import CorpusStore
+
+
+class TestCorpusStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.loads = []
+
+    def write(self, name: str, text: str, mtime: float) -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def load(self, path: str):
+        def loader():
+            self.loads.append(path)
+            with open(path) as f:
+                return f.read()
+        return loader
+
+    def test_reloads_when_the_file_changes(self):
+        store = CorpusStore()
+        path = self.write('aai.txt', 'first', 1000)
+        self.assertEqual(store.get('aai', [path], self.load(path)), 'first')
+        self.assertEqual(store.get('aai', [path], self.load(path)), 'first')
+        self.assertEqual(len(self.loads), 1)
+
+        store.set_attachment('aai', 'ngrams', 'index')
+        self.write('aai.txt', 'second', 2000)
+        self.assertEqual(store.get('aai', [path], self.load(path)), 'second')
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(store.get_attachment('aai', 'ngrams'), 'index') # handed over, to be updated incrementally
+        self.assertEqual((store.hits, store.misses), (1, 2))
+
+    def test_evicts_least_recently_used_over_budget(self):
+        store = CorpusStore()
+        store.memory_budget = 350
+        arrays = {name: np.zeros(100, dtype=np.uint8) for name in ['bsb', 'aai', 'abt', 'acr']}
+        store.get('bsb', [], lambda: arrays['bsb'], pinned=True)
+        store.get('aai', [], lambda: arrays['aai'])
+        store.get('abt', [], lambda: arrays['abt'])
+        store.get('aai', [], lambda: arrays['aai']) # now more recently used than abt
+        store.get('acr', [], lambda: arrays['acr'])
+        self.assertEqual([entry['key'] for entry in store.info()['entries']], ['bsb', 'aai', 'acr'])
+
+    def test_attachments_count_towards_the_budget(self):
+        store = CorpusStore()
+        store.memory_budget = 250
+        store.get('aai', [], lambda: np.zeros(100, dtype=np.uint8))
+        store.get('abt', [], lambda: np.zeros(100, dtype=np.uint8))
+        store.get('aai', [], lambda: np.zeros(100, dtype=np.uint8))
+        self.assertTrue(store.set_attachment('aai', 'ngrams', np.zeros(100, dtype=np.uint8)))
+        self.assertEqual([entry['key'] for entry in store.info()['entries']], ['aai']) # abt was the least recently used
+        self.assertFalse(store.set_attachment('abt', 'ngrams', np.zeros(1, dtype=np.uint8))) # evicted, so nothing to attach to
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+from api import drafts
+
+
+class TestDrafts(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(drafts.backend, 'get_vref_list', return_value=['GEN', 'EXO', 'MAT'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = mock.patch.object(drafts, 'DRAFTS_DIR', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(drafts.draft_jobs.clear)
+
+    def test_validation_errors(self):
+        self.assertIsNone(drafts.validate_draft_job('aai', 'GEN', 1))
+        self.assertIn('language code', drafts.validate_draft_job('aa', 'GEN'))
+        self.assertIn('language code', drafts.validate_draft_job('../', 'GEN'))
+        self.assertIn('Unknown book', drafts.validate_draft_job('aai', '../etc'))
+        self.assertIn('Invalid chapter', drafts.validate_draft_job('aai', 'GEN', 0))
+        self.assertIn('Invalid concurrency', drafts.validate_draft_job('aai', 'GEN', concurrency=0))
+
+    def test_invalid_requests_start_nothing(self):
+        result = asyncio.run(drafts.start_draft_job('aai', 'XYZ'))
+        self.assertEqual(result, {'error': 'Unknown book XYZ. Please use a 3-letter USFM book code, e.g. GEN.'})
+        self.assertEqual(drafts.draft_jobs, {})
+
+    def test_restarting_a_running_job_is_refused(self):
+        async def run(job):
+            await asyncio.sleep(10)
+
+        async def start_twice():
+            with mock.patch.object(drafts.DraftJob, 'run', run):
+                job = await drafts.start_draft_job('aai', 'GEN', 1)
+                self.assertIs(await drafts.start_draft_job('aai', 'GEN', 1), job) # resubmitting returns the running job
+                with open(job.path, 'w') as f:
+                    f.write('{"vref": "GEN 1:1"}\n')
+                conflict = await drafts.start_draft_job('aai', 'GEN', 1, restart=True)
+                job.cancel()
+                return job, conflict
+
+        job, conflict = asyncio.run(start_twice())
+        self.assertIn('already running', conflict['error'])
+        self.assertEqual(conflict['job']['job_id'], 'aai-GEN-1')
+        self.assertTrue(os.path.exists(job.path)) # the running job's results were kept
+
+
+if __name__ == '__main__':
+    unittest.main()
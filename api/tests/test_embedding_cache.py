@@ -0,0 +1,69 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from api.embedding_cache import EmbeddingCache, hash_text
+
+DIMENSION = 4
+
+
+def get_vectors(texts):
+    return np.array([[len(text), ord(text[0]), 1, 2] for text in texts], dtype=np.float32)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def get_cache(self):
+        return EmbeddingCache('test/model', DIMENSION, directory=self.directory.name)
+
+    def test_round_trip_between_instances(self):
+        cache = self.get_cache()
+        texts = ['in the beginning', 'and God said', 'in the beginning']
+        keys, _, missing = cache.get_many(texts)
+        self.assertEqual(missing, [0, 1, 2])
+        vectors = get_vectors(texts)
+        cache.put_many([keys[i] for i in missing], vectors[missing])
+        self.assertEqual(cache.info()['entries'], 2) # duplicates within a batch are stored once
+
+        other = self.get_cache() # e.g. another process, or after a restart
+        _, cached, missing = other.get_many(['and God said', 'in the beginning', 'new text'])
+        self.assertEqual(missing, [2])
+        np.testing.assert_array_equal(cached[:2], vectors[[1, 0]])
+        self.assertEqual((other.hits, other.misses), (2, 1))
+
+    def test_recovers_after_a_crash(self):
+        cache = self.get_cache()
+        keys, _, _ = cache.get_many(['a', 'b'])
+        cache.put_many(keys, get_vectors(['a', 'b']))
+
+        # A writer died after appending its vectors, and halfway through writing their keys
+        with open(cache.vectors_path, 'ab') as f:
+            f.write(np.ones((2, DIMENSION), dtype=np.float32).tobytes())
+        with open(cache.keys_path, 'a') as f:
+            f.write(hash_text('c')[:10])
+
+        recovered = self.get_cache()
+        self.assertEqual(recovered.info()['entries'], 2)
+        keys, _, missing = recovered.get_many(['c', 'd', 'a'])
+        self.assertEqual(missing, [0, 1])
+        new_vectors = np.array([[3, 3, 3, 3], [4, 4, 4, 4]], dtype=np.float32)
+        recovered.put_many([keys[i] for i in missing], new_vectors)
+
+        # The leftovers were dropped, so rows still line up with their keys
+        self.assertEqual(os.path.getsize(recovered.vectors_path), 4 * DIMENSION * 4)
+        with open(recovered.keys_path) as f:
+            self.assertEqual(f.read().splitlines(), [hash_text(text) for text in ['a', 'b', 'c', 'd']])
+        _, vectors, missing = self.get_cache().get_many(['a', 'b', 'c', 'd'])
+        self.assertEqual(missing, [])
+        np.testing.assert_array_equal(vectors[:2], get_vectors(['a', 'b']))
+        np.testing.assert_array_equal(vectors[2:], new_vectors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import unittest
+import asyncio
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from api.llm_cache import LLMResponseCache
+from api.llm_client import LLMClient
+from api.backend import build_fewshot_payload
+
+COMPLETION = {'choices': [{'message': {'content': 'ok'}}]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the LLM server. The path picks the behaviour:
+    `/flaky/<n>` fails with 503 for the first n requests, `/retry-after/<seconds>` fails once with a Retry-After header,
+    `/status/<code>` always answers with that status, `/slow/<seconds>` sleeps before answering,
+    `/stream/<n>` streams n chunks as server-sent events.
+    """
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        with server.lock:
+            server.requests.append((self.path, time.monotonic()))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            count = sum(1 for path, _ in server.requests if path == self.path)
+        kind, _, value = self.path.strip('/').partition('/')
+        status, headers = 200, {}
+        if kind == 'flaky' and count <= int(value):
+            status = 503
+        elif kind == 'retry-after' and count == 1:
+            status, headers = 503, {'Retry-After': value}
+        elif kind == 'status':
+            status = int(value)
+        elif kind == 'slow':
+            time.sleep(float(value))
+        elif kind == 'stream':
+            return self.stream(int(value))
+        with server.lock: # before replying, as the client may send its next request as soon as it has the reply
+            server.in_flight -= 1
+        self.reply(status, headers, COMPLETION if status == 200 else None)
+
+    def reply(self, status, headers={}, body=None):
+        data = json.dumps(body or {}).encode('utf8')
+        self.send_response(status)
+        for name, value in {'Content-Type': 'application/json', 'Content-Length': str(len(data)), **headers}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError): # the client timed out
+            pass
+
+    def stream(self, chunks):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for i in range(chunks):
+                self.wfile.write(f'data: {json.dumps({"choices": [{"delta": {"content": str(i)}}]})}\n\n'.encode('utf8'))
+                self.wfile.flush()
+                time.sleep(0.01)
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError): # the client stopped reading
+            pass
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLLMClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        cls.server.lock = threading.Lock()
+        cls.server.in_flight = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        deadline = time.monotonic() + 5
+        while self.server.in_flight and time.monotonic() < deadline: # e.g. a stream the last test walked away from
+            time.sleep(0.01)
+        self.server.requests = []
+        self.server.max_in_flight = 0
+
+    def get_client(self, **kwargs):
+        return LLMClient(self.base_url, **{'max_retries': 3, 'backoff_seconds': 0.01, **kwargs})
+
+    def test_retries_then_succeeds(self):
+        client = self.get_client()
+        self.assertEqual(client.chat_completion_sync({}, path='/flaky/2'), COMPLETION)
+        self.assertEqual(asyncio.run(client.chat_completion({}, path='/flaky/3')), COMPLETION)
+        self.assertEqual((client.requests, client.retries, client.failures, client.in_flight), (7, 5, 0, 0))
+
+    def test_gives_up_after_max_retries(self):
+        client = self.get_client(max_retries=2)
+        with self.assertRaises(httpx.HTTPStatusError) as context:
+            client.chat_completion_sync({}, path='/status/503')
+        self.assertEqual(context.exception.response.status_code, 503)
+        self.assertEqual((client.requests, client.retries, client.failures), (3, 2, 1))
+
+    def test_client_errors_are_not_retried(self):
+        client = self.get_client()
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(client.chat_completion({}, path='/status/400'))
+        self.assertEqual((client.requests, client.retries, client.failures), (1, 0, 1))
+
+    def test_honours_retry_after(self):
+        client = self.get_client()
+        client.chat_completion_sync({}, path='/retry-after/0.3')
+        (_, first), (_, second) = self.server.requests
+        self.assertGreaterEqual(second - first, 0.3)
+
+    def test_backoff(self):
+        client = self.get_client(backoff_seconds=0.1)
+        for attempt in range(4):
+            for _ in range(20):
+                self.assertTrue(0.05 * 2 ** attempt <= client.get_backoff(attempt) <= 0.15 * 2 ** attempt)
+        response = httpx.Response(503, headers={'Retry-After': '2'})
+        self.assertEqual(client.get_backoff(0, response), 2.0)
+        response = httpx.Response(503, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) # not seconds: fall back
+        self.assertLessEqual(client.get_backoff(0, response), 0.15)
+
+    def test_read_timeout(self):
+        client = self.get_client(read_timeout=0.1, max_retries=1)
+        with self.assertRaises(httpx.ReadTimeout):
+            client.chat_completion_sync({}, path='/slow/1')
+        self.assertEqual((client.requests, client.retries, client.failures, client.in_flight), (2, 1, 1, 0))
+
+    def test_concurrency_limit_is_shared(self):
+        client = self.get_client(max_concurrency=2)
+
+        async def run_async():
+            await asyncio.gather(*[client.chat_completion({}, path='/slow/0.1') for _ in range(4)])
+
+        threads = [threading.Thread(target=client.chat_completion_sync, args=({}, '/slow/0.1')) for _ in range(4)]
+        threads.append(threading.Thread(target=asyncio.run, args=(run_async(),)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual((client.requests, client.in_flight, client.concurrency_limit.in_use), (8, 0, 0))
+
+    def test_stream(self):
+        client = self.get_client(max_concurrency=1)
+
+        async def run():
+            chunks = [chunk async for chunk in client.stream_chat_completion({}, path='/stream/3')]
+            return [chunk['choices'][0]['delta']['content'] for chunk in chunks]
+
+        self.assertEqual(asyncio.run(run()), ['0', '1', '2'])
+        self.assertEqual((client.requests, client.in_flight, client.concurrency_limit.in_use), (1, 0, 0))
+
+    def test_closing_a_stream_early_frees_its_slot(self):
+        client = self.get_client(max_concurrency=1)
+
+        async def run():
+            chunks = client.stream_chat_completion({}, path='/stream/100')
+            await chunks.__anext__()
+            await chunks.aclose()
+            self.assertEqual((client.in_flight, client.concurrency_limit.in_use), (0, 0))
+            return await asyncio.wait_for(client.chat_completion({}, path='/slow/0'), timeout=1)
+
+        self.assertEqual(asyncio.run(run()), COMPLETION)
+
+    def test_only_deterministic_requests_are_cached_by_default(self):
+        with tempfile.TemporaryDirectory() as directory:
+            client = self.get_client(cache=LLMResponseCache(directory))
+            sampled, deterministic = {'temperature': 0.7}, {'temperature': 0}
+            for _ in range(2):
+                client.chat_completion_sync(sampled, path='/slow/0')
+                asyncio.run(client.chat_completion(sampled, path='/slow/0'))
+            self.assertEqual(len(self.server.requests), 4)
+            for _ in range(2):
+                client.chat_completion_sync(deterministic, path='/slow/0')
+                asyncio.run(client.chat_completion(deterministic, path='/slow/0'))
+            self.assertEqual(len(self.server.requests), 5)
+            for _ in range(2): # opting in (or out) overrides the default
+                asyncio.run(client.chat_completion(sampled, path='/slow/0', use_cache=True))
+                client.chat_completion_sync(deterministic, path='/slow/0', use_cache=False)
+            self.assertEqual(len(self.server.requests), 8)
+            client.cache._get_cache().close()
+
+    def test_default_requests_are_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            client = self.get_client(cache=LLMResponseCache(directory))
+            payload = build_fewshot_payload('Translate: In the beginning', max_tokens=10) # sampled, but seeded
+            self.assertEqual(client.chat_completion_sync(payload, path='/slow/0'), COMPLETION)
+            self.assertEqual(asyncio.run(client.chat_completion(payload, path='/slow/0')), COMPLETION)
+            self.assertEqual(len(self.server.requests), 1)
+            self.assertEqual((client.cache.hits, client.cache.misses, client.cache.writes), (1, 1, 1))
+            client.cache._get_cache().close()
+
+    def test_cache_stats_are_thread_safe(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = LLMResponseCache(directory)
+            cache.set({'prompt': 'cached'}, 'response')
+
+            def look_up():
+                for i in range(50):
+                    cache.get({'prompt': 'cached' if i % 2 else f'missing {i}'})
+
+            threads = [threading.Thread(target=look_up) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual((cache.hits, cache.misses, cache.writes), (200, 200, 1))
+            cache._get_cache().close()
+
+    def test_cancelled_waiter_gives_back_its_place(self):
+        client = self.get_client(max_concurrency=1)
+
+        async def run():
+            slow = asyncio.create_task(client.chat_completion({}, path='/slow/0.2'))
+            await asyncio.sleep(0.05)
+            waiting = asyncio.create_task(client.chat_completion({}, path='/slow/0'))
+            await asyncio.sleep(0.05)
+            waiting.cancel()
+            await slow
+            return await client.chat_completion({}, path='/slow/0')
+
+        self.assertEqual(asyncio.run(run()), COMPLETION)
+        self.assertEqual(client.concurrency_limit.in_use, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
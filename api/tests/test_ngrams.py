@@ -0,0 +1,68 @@
+import unittest
+import random
+from collections import Counter
+
+from api.ngrams import NgramIndex, tokenize
+
+WORDS = ['a', 'b', 'c', 'd', 'e']
+
+
+def count_ngrams(contents, size: int) -> Counter:
+    counts = Counter()
+    for content in contents:
+        tokens = tokenize(content)
+        counts.update(tuple(tokens[start:start + size]) for start in range(len(tokens) - size + 1))
+    return counts
+
+
+def random_verse(rng: random.Random):
+    if rng.random() < 0.1:
+        return None # missing verse
+    return '  '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 8)))
+
+
+class TestNgramIndex(unittest.TestCase):
+
+    def assert_matches(self, index: NgramIndex, contents):
+        for size in range(1, 4):
+            expected = count_ngrams(contents, size)
+            self.assertEqual(dict(index.most_common(size, n=len(expected) + 1)), dict(expected))
+            self.assertEqual(len(index.counts[size]), len(expected))
+        self.assertEqual(index.num_ngrams, sum(len(counts) for counts in index.counts.values()))
+        self.assertEqual(index.num_token_ids, sum(len(token_ids) for token_ids in index.verse_token_ids.values()))
+
+    def test_incremental_sync_matches_a_full_count(self):
+        rng = random.Random(0)
+        index = NgramIndex()
+        contents = [random_verse(rng) for _ in range(50)]
+        index.sync(contents)
+        self.assert_matches(index, contents)
+        for _ in range(20):
+            contents = list(contents)
+            for _ in range(rng.randint(1, 5)):
+                contents[rng.randrange(len(contents))] = random_verse(rng)
+            if rng.random() < 0.3: # the corpus shrinks or grows
+                contents = contents[:rng.randint(30, 50)] + [random_verse(rng) for _ in range(rng.randint(0, 10))]
+            version = index.version
+            index.sync(contents)
+            self.assertGreaterEqual(index.version, version)
+            self.assert_matches(index, contents)
+            self.assertEqual(index.num_ngrams, sum(len(count_ngrams(contents, size)) for size in range(1, 4)))
+
+    def test_same_source_is_not_diffed(self):
+        index = NgramIndex()
+        source = object()
+        index.sync(['a b'], source=source)
+        index.sync(['c d'], source=source)
+        self.assertEqual(index.most_common(1), [(('a',), 1), (('b',), 1)])
+
+    def test_string_filter(self):
+        contents = ['a b c a b', 'b a b d']
+        index = NgramIndex()
+        index.sync(contents)
+        expected = {ngram: count for ngram, count in count_ngrams(contents, 2).items() if set(ngram) <= {'a', 'b'}}
+        self.assertEqual(dict(index.most_common(2, string_filter=['a', 'b', 'x'])), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
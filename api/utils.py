@@ -1,22 +1,159 @@
+import os, time, json, threading
+import numpy as np
 import logging
 
 logger = logging.getLogger('uvicorn')
 
-from sentence_transformers import SentenceTransformer
+from .embedding_cache import EmbeddingCache
+
+
+class LazyResource():
+    """
+    A heavy resource (model, database connection, ...) that is created on first use.
+    
+    Creation is thread-safe and happens at most once, either on first `get()` or ahead of
+    time through `warm_up()`. `status()` reports whether the resource is ready for the readiness endpoint.
+    """
+    
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.ready = False
+        self.error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+        lazy_resources[name] = self
+    
+    def get(self):
+        if self.ready:
+            return self.value
+        with self._lock:
+            if not self.ready:
+                logger.info(f'Loading {self.name}...')
+                start_time = time.time()
+                try:
+                    self.value = self.factory()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.load_seconds = time.time() - start_time
+                self.error = None
+                self.ready = True
+                logger.info(f'Loaded {self.name} in {self.load_seconds:.2f} seconds')
+        return self.value
+    
+    def warm_up(self):
+        try:
+            self.get()
+        except Exception as e:
+            logger.error(f'Failed to load {self.name}: {e}')
+    
+    def status(self) -> dict:
+        return {'ready': self.ready, 'load_seconds': self.load_seconds, 'error': self.error}
+
+lazy_resources: dict[str, LazyResource] = {}
+
+
+def load_embedding_model():
+    from sentence_transformers import SentenceTransformer # imports torch, so keep it off the import path
+    return SentenceTransformer(name)
 
 name="paraphrase-albert-small-v2"
-model = SentenceTransformer(name)
+embedding_model = LazyResource('embedding_model', load_embedding_model)
+embedding_cache = LazyResource('embedding_cache', lambda: EmbeddingCache(name, embedding_model.get().get_sentence_embedding_dimension()))
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+
+# Running totals, so that embedding throughput can be reported across calls (see `get_embedding_stats`)
+embedding_stats = {'sentences': 0, 'encoded': 0, 'seconds': 0.0}
+embedding_stats_lock = threading.Lock()
+
+def encode_sentences(sentences: list[str], batch_size=EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    """
+    Run the model over a list of sentences, returning a contiguous float32 matrix with one row per sentence.
+    
+    Each distinct sentence is only encoded once (verses repeat, e.g. formulaic ones), and its vector is
+    copied to every row it appears in. The model sorts its inputs by length itself, so they're passed in order.
+    """
+    model = embedding_model.get()
+    if not sentences:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    start_time = time.time()
+    unique_sentences = list(dict.fromkeys(sentences))
+    rows = {sentence: i for i, sentence in enumerate(unique_sentences)}
+    unique_embeddings = np.asarray(model.encode(
+        unique_sentences,
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    ), dtype=np.float32)
+    embeddings = np.ascontiguousarray(unique_embeddings[[rows[sentence] for sentence in sentences]])
+    
+    elapsed = time.time() - start_time
+    with embedding_stats_lock:
+        embedding_stats['sentences'] += len(sentences)
+        embedding_stats['encoded'] += len(unique_sentences)
+        embedding_stats['seconds'] += elapsed
+    logger.info(f'Embedded {len(sentences)} sentences ({len(unique_sentences)} distinct) in {elapsed:.2f} seconds ({len(sentences) / max(elapsed, 1e-9):.1f} sentences/s)')
+    return embeddings
 
 # used for both training and querying
-def embed_batch(batch):
+def embed_batch(batch, batch_size=EMBEDDING_BATCH_SIZE, use_cache=True):
+    """
+    Embed a list of sentences, returning a contiguous float32 matrix with one row per sentence.
+    
+    Vectors for texts that have been embedded before (by any table build or query, in this or
+    an earlier process) are read from `embedding_cache` and only the rest are run through the model.
+    """
     logger.info(f'Embedding batch of size {len(batch)}')
     try:
-        return [model.encode(sentence) for sentence in batch]
+        sentences = [str(sentence) for sentence in batch]
+        if not use_cache:
+            return encode_sentences(sentences, batch_size=batch_size)
+        
+        keys, embeddings, missing = embedding_cache.get().get_many(sentences)
+        if missing:
+            missing_embeddings = encode_sentences([sentences[i] for i in missing], batch_size=batch_size)
+            embeddings[missing] = missing_embeddings
+            embedding_cache.get().put_many([keys[i] for i in missing], missing_embeddings)
+        logger.info(f'Embedding cache: {len(sentences) - len(missing)} hits, {len(missing)} misses')
+        return embeddings
     except Exception as e:
         print('Error:', e)
         return []
 
 
+def get_embedding_stats() -> dict:
+    """Sentences embedded by the model so far (and how many were distinct), with the average throughput in sentences per second"""
+    with embedding_stats_lock:
+        stats = dict(embedding_stats)
+    stats['sentences_per_second'] = stats['sentences'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+# tiktoken encoding used to count prompt tokens (an approximation of the local model's own tokenizer)
+PROMPT_TOKENIZER = os.environ.get('PROMPT_TOKENIZER', 'cl100k_base')
+
+def load_prompt_tokenizer():
+    # NOTE: tiktoken downloads its encoding files on first use; without them, fall back to estimating (see `count_tokens`)
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(PROMPT_TOKENIZER)
+    except Exception as e:
+        logger.warning(f'Could not load the {PROMPT_TOKENIZER} tokenizer ({e}), estimating token counts from text length')
+        return None
+
+prompt_tokenizer = LazyResource('prompt_tokenizer', load_prompt_tokenizer)
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in a text, as the LLM will (roughly) see it"""
+    encoding = prompt_tokenizer.get()
+    if encoding is None:
+        return len(text) // 4 + 1 # ~4 characters per token for English-heavy prompts
+    return len(encoding.encode(text, disallowed_special=()))
+
+
 # Long book names to USFM (3 uppercase letters) format
 book_name_mapping = {
     "Genesis": "GEN",
@@ -125,4 +262,57 @@ def get_train_test_split_from_verse_list(verse_refs: list):
     """Split Bible verse references into train and test sets"""
     from sklearn.model_selection import train_test_split
     train_list, test_list = train_test_split(verse_refs, test_size=0.2)
-    return train_list, test_list
\ No newline at end of file
+    return train_list, test_list
+
+
+### Streaming helpers ###
+
+def gzip_chunks(chunks, compresslevel=6):
+    """Gzip-compress an iterable of str/bytes chunks on the fly"""
+    import zlib
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16) # | 16 -> gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf8') if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def format_sse(event: str, data) -> str:
+    """One server-sent event, with the data as JSON"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def parse_byte_range(range_header: str, file_size: int):
+    """
+    Parse an HTTP `Range: bytes=start-end` header into an inclusive (start, end) tuple.
+    Returns None if there is no usable range, and raises ValueError if the range can't be satisfied.
+    Only single ranges are supported.
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start, _, end = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if start == '': # suffix range, e.g. bytes=-500 (the last 500 bytes)
+            start, end = max(file_size - int(end), 0), file_size - 1
+        else:
+            start, end = int(start), min(int(end), file_size - 1) if end else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or start > end:
+        raise ValueError(f'Range {range_header} not satisfiable for {file_size} bytes')
+    return start, end
+
+
+def iter_file_range(path: str, start: int = 0, end: int = None, chunk_size=64 * 1024):
+    """Yield the bytes of a file between start and end (inclusive) in chunks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = (end - start + 1) if end is not None else None
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
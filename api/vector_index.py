@@ -0,0 +1,216 @@
+import os, time, threading
+import numpy as np
+from typing import Any, Callable, Optional
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Tables smaller than this are searched brute force (fast enough, and IVF-PQ needs enough rows to train on)
+VECTOR_INDEX_MIN_ROWS = int(os.environ.get('VECTOR_INDEX_MIN_ROWS', 5000))
+# Rows appended since the last build before the index is rebuilt in the background
+VECTOR_INDEX_REBUILD_ROWS = int(os.environ.get('VECTOR_INDEX_REBUILD_ROWS', 5000))
+# Search-time knobs: IVF partitions probed per query, and how many extra candidates get re-ranked with exact distances
+VECTOR_INDEX_NPROBES = int(os.environ.get('VECTOR_INDEX_NPROBES', 20))
+VECTOR_INDEX_REFINE_FACTOR = int(os.environ.get('VECTOR_INDEX_REFINE_FACTOR', 10))
+
+
+class VectorIndexState():
+    def __init__(self):
+        self.indexed = False
+        self.indexed_rows = 0
+        self.rows_since_build = 0
+        self.building = False
+        self.last_build_seconds = None
+        self.params: dict[str, Any] = {}
+        self.error = None
+
+    def to_dict(self) -> dict:
+        return {
+            'indexed': self.indexed,
+            'indexed_rows': self.indexed_rows,
+            'rows_since_build': self.rows_since_build,
+            'building': self.building,
+            'last_build_seconds': self.last_build_seconds,
+            'params': self.params,
+            'error': self.error,
+            'nprobes': VECTOR_INDEX_NPROBES,
+            'refine_factor': VECTOR_INDEX_REFINE_FACTOR,
+        }
+
+index_states: dict[str, VectorIndexState] = {}
+index_states_lock = threading.Lock()
+
+
+def get_index_state(table_name: str, table=None) -> VectorIndexState:
+    with index_states_lock:
+        if table_name not in index_states:
+            state = VectorIndexState()
+            # Pick up an index built by an earlier process
+            if table is not None and has_vector_index(table):
+                state.indexed = True
+                state.indexed_rows = len(table)
+            index_states[table_name] = state
+        return index_states[table_name]
+
+
+def has_vector_index(table) -> bool:
+    try:
+        return len(table.to_lance().list_indices()) > 0
+    except Exception:
+        return False
+
+
+def get_vector_dimension(table) -> int:
+    return table.schema.field('vector').type.list_size
+
+
+def get_index_params(num_rows: int, dimension: int) -> dict:
+    """IVF-PQ parameters scaled to the table: ~sqrt(n) partitions, and sub-vectors of 8 dimensions where possible"""
+    num_partitions = max(1, min(256, int(np.sqrt(num_rows))))
+    num_sub_vectors = next((n for n in [dimension // 8, 96, 64, 48, 32, 16, 8, 4, 2, 1] if n and dimension % n == 0), 1)
+    return {'metric': 'L2', 'num_partitions': num_partitions, 'num_sub_vectors': num_sub_vectors}
+
+
+def build_vector_index(table_name: str, table, force=False) -> dict:
+    """Build (or rebuild) the IVF-PQ index for a table, if it is big enough to need one"""
+    state = get_index_state(table_name, table)
+    num_rows = len(table)
+    if num_rows < VECTOR_INDEX_MIN_ROWS and not force:
+        logger.info(f'Skipping vector index for {table_name}: {num_rows} rows is below VECTOR_INDEX_MIN_ROWS ({VECTOR_INDEX_MIN_ROWS})')
+        return state.to_dict()
+
+    params = get_index_params(num_rows, get_vector_dimension(table))
+    logger.info(f'Building vector index for {table_name} ({num_rows} rows): {params}')
+    start_time = time.time()
+    state.building = True
+    try:
+        table.create_index(**params)
+        state.indexed = True
+        state.indexed_rows = num_rows
+        state.rows_since_build = 0
+        state.params = params
+        state.error = None
+    except Exception as e:
+        logger.error(f'Failed to build vector index for {table_name}: {e}')
+        state.error = str(e)
+    finally:
+        state.building = False
+        state.last_build_seconds = time.time() - start_time
+    logger.info(f'Vector index for {table_name} built in {state.last_build_seconds:.2f} seconds')
+    return state.to_dict()
+
+
+def record_append(table_name: str, table, appended_rows: int, get_table: Callable[[], Any]):
+    """
+    Track rows appended to an indexed table, and rebuild the index in the background
+    once VECTOR_INDEX_REBUILD_ROWS new rows have been added since the last build.
+    Appended rows are still searchable before the rebuild (LanceDB scans unindexed rows).
+    """
+    state = get_index_state(table_name, table)
+    state.rows_since_build += appended_rows
+    if state.building or state.rows_since_build < VECTOR_INDEX_REBUILD_ROWS:
+        return
+    if not state.indexed and len(table) < VECTOR_INDEX_MIN_ROWS:
+        return
+    state.building = True # set now, so that appends before the thread starts don't start another build
+
+    def rebuild():
+        try:
+            table = get_table()
+            if table is None:
+                logger.warning(f'Not rebuilding vector index for {table_name}: table not found')
+                return
+            build_vector_index(table_name, table)
+        except Exception as e:
+            logger.error(f'Failed to rebuild vector index for {table_name}: {e}')
+            state.error = str(e)
+        finally:
+            state.building = False
+
+    threading.Thread(target=rebuild, daemon=True).start()
+
+
+def apply_search_params(table_name: str, query):
+    """Set nprobes/refine_factor on a LanceDB query if the table is indexed"""
+    state = index_states.get(table_name)
+    if state is not None and state.indexed:
+        query = query.nprobes(VECTOR_INDEX_NPROBES).refine_factor(VECTOR_INDEX_REFINE_FACTOR)
+    return query
+
+
+def get_table_vectors(arrow_table) -> np.ndarray:
+    """All vectors of a table (read with `table.to_arrow()`) as a float32 matrix"""
+    column = arrow_table['vector'].combine_chunks()
+    return np.asarray(column.flatten(), dtype=np.float32).reshape(len(column), -1)
+
+
+def search_exact(table_name: str, table, query, k: int):
+    """
+    Exact top-k search through LanceDB: without an index this is already a full scan; with one, every partition
+    is probed and every candidate re-ranked with exact distances, so the ANN index doesn't change the result.
+    """
+    query_builder = table.search(query)
+    state = index_states.get(table_name)
+    if state is not None and state.indexed:
+        num_partitions = state.params.get('num_partitions') or get_index_params(len(table), len(query))['num_partitions']
+        query_builder = query_builder.nprobes(num_partitions).refine_factor(int(np.ceil(len(table) / k)))
+    return query_builder.limit(k).select(['vref']).to_arrow()
+
+
+def evaluate_vector_index(table_name: str, table, num_queries=50, k=10, nprobes_values=(1, 5, 10, 20, 50)) -> dict:
+    """
+    Recall-vs-latency report for the ANN index against exact search.
+    Queries are random rows of the table; recall@k is the share of the exact top-k vrefs that the ANN search also returns.
+    Both latencies are per query through LanceDB (see `search_exact`), so they're comparable.
+    """
+    state = get_index_state(table_name, table)
+    arrow_table = table.to_arrow()
+    vectors = get_table_vectors(arrow_table)
+    vrefs = arrow_table['vref'].to_pylist()
+    rng = np.random.default_rng(0)
+    query_rows = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = vectors[query_rows]
+
+    # Ground truth from numpy, so recall doesn't depend on LanceDB's exact path being exact
+    squared_norms = (vectors ** 2).sum(axis=1)
+    distances = squared_norms[None, :] - 2 * queries @ vectors.T
+    exact_rows = np.argsort(distances, axis=1)[:, :k]
+    exact_vrefs = [set(vrefs[row] for row in rows) for rows in exact_rows]
+
+    exact_latencies = []
+    for query in queries:
+        start_time = time.time()
+        search_exact(table_name, table, query, k)
+        exact_latencies.append(time.time() - start_time)
+    exact_latency_ms = float(np.mean(exact_latencies) * 1000)
+
+    report = {
+        'table': table_name,
+        'rows': len(vectors),
+        'k': k,
+        'num_queries': len(queries),
+        'index': state.to_dict(),
+        'exact_latency_ms': exact_latency_ms,
+        'exact_p95_latency_ms': float(np.percentile(exact_latencies, 95) * 1000),
+        'results': [],
+    }
+    if not state.indexed:
+        return report
+
+    for nprobes in nprobes_values:
+        latencies, recalls = [], []
+        for query, expected in zip(queries, exact_vrefs):
+            start_time = time.time()
+            result = table.search(query).nprobes(nprobes).refine_factor(VECTOR_INDEX_REFINE_FACTOR).limit(k).select(['vref']).to_arrow()
+            latencies.append(time.time() - start_time)
+            recalls.append(len(expected & set(result['vref'].to_pylist())) / len(expected))
+        mean_latency_ms = float(np.mean(latencies) * 1000)
+        report['results'].append({
+            'nprobes': nprobes,
+            'refine_factor': VECTOR_INDEX_REFINE_FACTOR,
+            'recall': float(np.mean(recalls)),
+            'mean_latency_ms': mean_latency_ms,
+            'p95_latency_ms': float(np.percentile(latencies, 95) * 1000),
+            'speedup': exact_latency_ms / mean_latency_ms if mean_latency_ms > 0 else None,
+        })
+    return report
@@ -0,0 +1,92 @@
+import bisect
+import numpy as np
+from typing import Optional
+
+from .ngrams import NgramIndex
+
+
+class Vocabulary():
+    """
+    Token frequencies for one corpus, as interned token ids with a NumPy count array.
+
+    Built from a snapshot of an `NgramIndex` (which owns the token interning), and rebuilt
+    whenever that index's version changes. Supports frequency-ranked pagination, prefix lookup
+    and hapax/out-of-vocabulary subsets.
+    """
+
+    def __init__(self, ngram_index: NgramIndex):
+        with ngram_index.lock:
+            self.version = ngram_index.version
+            all_tokens = list(ngram_index.tokens)
+            token_ids = [token_ids for token_ids in ngram_index.verse_token_ids.values() if token_ids]
+            all_counts = np.bincount(np.concatenate(token_ids), minlength=len(all_tokens)) if token_ids else np.zeros(len(all_tokens), dtype=np.int64)
+
+        # Tokens that no longer occur anywhere (after verse updates) are dropped
+        kept_ids = np.flatnonzero(all_counts > 0)
+        self.tokens: list[str] = [all_tokens[token_id] for token_id in kept_ids]
+        self.counts = all_counts[kept_ids].astype(np.int64)
+        self.token_ids: dict[str, int] = {token: i for i, token in enumerate(self.tokens)}
+
+        self.by_frequency = np.argsort(-self.counts, kind='stable')
+        self.sorted_tokens = sorted(self.tokens)
+        self.hapax_ids = np.flatnonzero(self.counts == 1)
+        self._oov: dict[str, tuple[int, np.ndarray]] = {} # other vocabulary name -> (its version, ids not in it)
+
+    @property
+    def nbytes(self) -> int:
+        """Rough in-memory size: the arrays, plus ~150 bytes per token for the token list, sorted list and id dict"""
+        return self.counts.nbytes + self.by_frequency.nbytes + self.hapax_ids.nbytes + 150 * len(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def get_count(self, token: str) -> int:
+        token_id = self.token_ids.get(token)
+        return int(self.counts[token_id]) if token_id is not None else 0
+
+    def _entries(self, ids) -> list[tuple[str, int]]:
+        return [(self.tokens[token_id], int(self.counts[token_id])) for token_id in ids]
+
+    def to_dict(self) -> dict[str, int]:
+        return dict(self._entries(range(len(self.tokens))))
+
+    def top_k(self, k: int, offset: int = 0) -> list[tuple[str, int]]:
+        """Most frequent tokens, `offset` onwards (for pagination)"""
+        return self._entries(self.by_frequency[offset:offset + k])
+
+    def with_prefix(self, prefix: str, limit: int = 100, offset: int = 0) -> list[tuple[str, int]]:
+        """Tokens starting with `prefix`, in alphabetical order"""
+        start = bisect.bisect_left(self.sorted_tokens, prefix)
+        matches = []
+        for token in self.sorted_tokens[start + offset:]:
+            if not token.startswith(prefix) or len(matches) >= limit:
+                break
+            matches.append((token, self.get_count(token)))
+        return matches
+
+    def hapax(self, limit: int = 100, offset: int = 0) -> list[tuple[str, int]]:
+        """Tokens that occur exactly once"""
+        return self._entries(self.hapax_ids[offset:offset + limit])
+
+    def get_oov_ids(self, name: str, other: 'Vocabulary') -> np.ndarray:
+        """Ids of tokens that don't occur in another vocabulary (cached until either side changes)"""
+        cached = self._oov.get(name)
+        if cached is None or cached[0] != other.version:
+            ids = np.array([i for i, token in enumerate(self.tokens) if token not in other.token_ids], dtype=np.int64)
+            ids = ids[np.argsort(-self.counts[ids], kind='stable')] if len(ids) else ids # most frequent first
+            cached = (other.version, ids)
+            self._oov[name] = cached
+        return cached[1]
+
+    def oov(self, name: str, other: 'Vocabulary', limit: int = 100, offset: int = 0) -> list[tuple[str, int]]:
+        return self._entries(self.get_oov_ids(name, other)[offset:offset + limit])
+
+    def stats(self, others: Optional[dict[str, 'Vocabulary']] = None) -> dict:
+        stats = {
+            'unique_tokens': len(self.tokens),
+            'total_tokens': int(self.counts.sum()),
+            'hapax': len(self.hapax_ids),
+        }
+        for name, other in (others or {}).items():
+            stats[f'oov_{name}'] = len(self.get_oov_ids(name, other))
+        return stats
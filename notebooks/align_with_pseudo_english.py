@@ -3,6 +3,7 @@ import os
 import json
 import random
 import time
+from alignment_utils import cached_completion, add_cache_arguments, get_use_cache, is_json, AlignmentCheckpoint, get_output_file_path
 from pydantic import BaseModel
 from typing import Optional, List
 
@@ -34,6 +35,8 @@ parser.add_argument('--n', type=int, default=0, help='Number of verses to sample
 parser.add_argument('--randomize', action='store_true', help='Randomize the order of the verses')
 parser.add_argument('--pseudo_english_only', action='store_true', help='Only generate pseudo-english translations')
 parser.add_argument('--ids_file_path', type=str, default=None, help='Path to the txt file containing vref ids')
+add_cache_arguments(parser)
+parser.add_argument('--resume', type=str, nargs='?', const='latest', default=None, help='Continue an earlier run: path to its output file, or no value for the latest output of this run (skips aligned verses, retries failed ones)')
 
 # Parse the arguments
 args = parser.parse_args()
@@ -270,7 +273,7 @@ def generate_broad_alignment_prompt(data_element):
     else:
         return generate_broad_greek_alignment_prompt(data_element)
 
-def align(prompt):
+def align(prompt, validate=is_json):
     system_prompt = "You are LangAlignerGPT. Analyze the user-supplied samples below and follow any instructions the user gives. Always respond with perfect JSON.\n"
     
     if not args.model == 'gpt-4':
@@ -278,15 +281,15 @@ def align(prompt):
         formatted_prompt = (f'{system_prompt}'
                             f'{prompt}')
         
+        request = dict(
+            model=args.model,
+            prompt=formatted_prompt,
+            temperature=0.1,
+            max_tokens=1200,
+        )
         for i in range(MAX_RETRIES):
             try:
-                response = openai.Completion.create(
-                model=args.model,
-                prompt=formatted_prompt,
-                temperature=0.1,
-                max_tokens=1200,
-                )
-                return response['choices'][0]['text']
+                return cached_completion(request, lambda: openai.Completion.create(**request)['choices'][0]['text'], use_cache=get_use_cache(args), validate=validate)
             except (openai.error.APIConnectionError, openai.error.APIError) as e:
                 print('Error in alignment:', e)
                 if i < MAX_RETRIES - 1:  # i is zero indexed
@@ -299,17 +302,20 @@ def align(prompt):
             {"role": 'system', "content": system_prompt},
             {"role": 'user', 'content': prompt}
         ]
+        request = dict(
+            model=args.model,
+            messages=messages,
+            temperature=0.1,
+        )
+        def create():
+            response = openai.ChatCompletion.create(**request)
+            generated_texts = [
+                choice.message["content"] for choice in response["choices"]
+            ]
+            return generated_texts[0]
         for i in range(MAX_RETRIES):
             try:
-                response = openai.ChatCompletion.create(
-                    model=args.model,
-                    messages=messages,
-                    temperature=0.1,
-                )
-                generated_texts = [
-                    choice.message["content"] for choice in response["choices"]
-                ]
-                return generated_texts[0]
+                return cached_completion(request, create, use_cache=get_use_cache(args), validate=validate)
             except (openai.error.APIConnectionError, openai.error.APIError) as e:
                 print('Error in alignment:', e)
                 if i < MAX_RETRIES - 1:  # i is zero indexed
@@ -343,11 +349,14 @@ if specified_ids:
 
 ### ALIGN ###
 
-output_file_path = f'{output_dir}/alignments_{os.path.basename(args.data_path)}_{args.run_name}_{args.model}_{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.jsonl'
+output_file_path = get_output_file_path(output_dir, f'alignments_{os.path.basename(args.data_path)}_{args.run_name}_{args.model}', datetime.datetime.now().strftime("%Y%m%d-%H%M"), resume=args.resume)
+checkpoint = AlignmentCheckpoint(output_file_path)
+if args.resume:
+    json_data = checkpoint.get_remaining(json_data)
 
 for verse in json_data:
     pseudo_english_prompt = generate_pseudo_english_prompt(verse)
-    pseudo_english_text = align(pseudo_english_prompt)
+    pseudo_english_text = align(pseudo_english_prompt, validate=lambda text: isinstance(text, str)) # free text, not JSON
     verse['alt'] = pseudo_english_text
     print('pseudo-english:', pseudo_english_text)
     prompt = generate_broad_alignment_prompt(verse)
@@ -365,6 +374,6 @@ for verse in json_data:
             print('Error on alignment.', e)
             verse['alignment'] = f'Error: {e}'
             verse['error'] = 'true'
-    with open(output_file_path, 'a') as f:
-        f.write(json.dumps(verse, ensure_ascii=False))
-        f.write('\n')
+    checkpoint.write(verse)
+
+checkpoint.finish(compact=args.resume is not None) # resumed outputs have a row per attempt, keep only the latest
@@ -0,0 +1,342 @@
+"""Helpers shared by the alignment scripts (run_align.py, instruct_align.py, align_with_pseudo_english.py)"""
+import os
+import re
+import sys
+import json
+import time
+import glob
+import threading
+from functools import lru_cache
+
+# Let the scripts use the api package (they're run as `python notebooks/<script>.py` from the repo root)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.llm_cache import LLMResponseCache, is_deterministic
+
+# Shares data/llm_cache with the API, so a prompt is only ever sent once
+alignment_cache = LLMResponseCache()
+
+
+def is_json(text) -> bool:
+    if not isinstance(text, str):
+        return False
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def cached_completion(request: dict, create, use_cache=None, validate=is_json):
+    """
+    Return the cached response text for an OpenAI request (model, prompt/messages and sampling params),
+    or call `create()` and cache what it returns. Only responses that pass `validate` (by default: valid JSON)
+    are cached, so failed or unparseable alignments are retried on the next run.
+
+    As in the API (see `LLMClient`), only deterministic requests (temperature 0 or seeded) are cached by default;
+    pass use_cache=True to cache sampled ones too (see `get_use_cache`), or False to always call the model.
+    """
+    if use_cache is None:
+        use_cache = is_deterministic(request)
+    return alignment_cache.get_or_create(request, create, use_cache=use_cache, validate=validate)
+
+
+def add_cache_arguments(parser):
+    """The --cache/--no_cache flags shared by the alignment scripts"""
+    parser.add_argument('--cache', action='store_true', help='Also cache sampled (temperature > 0) completions, and reuse them on later runs')
+    parser.add_argument('--no_cache', action='store_true', help='Always call the model, even for prompts with a cached response')
+
+
+def get_use_cache(args):
+    """`use_cache` for `cached_completion` from the --cache/--no_cache flags (None: only deterministic requests)"""
+    if args.no_cache:
+        return False
+    return True if args.cache else None
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """tiktoken encoding for a model, or None if tiktoken (or its encoding files) isn't available"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f'tiktoken unavailable ({e}), estimating token counts from text length')
+        return None
+
+
+def count_tokens(text: str, model: str = 'gpt-3.5-turbo-instruct') -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1 # ~4 characters per token for English-heavy prompts
+    return len(encoding.encode(text))
+
+
+class RateLimiter():
+    """
+    Thread-safe requests-per-minute and tokens-per-minute limiter (two token buckets that refill continuously).
+    A limit of 0 means no limit.
+
+    NOTE: we don't use the pinned `ratelimiter` package: it only limits calls (not tokens),
+    and it fails to import on Python 3.11+ (it uses the removed `asyncio.coroutine`).
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int = 0):
+        """Block until one more request of `tokens` tokens fits in both budgets"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute) # a request bigger than the whole budget would otherwise wait forever
+        while True:
+            with self.lock:
+                self._refill()
+                requests_ok = not self.requests_per_minute or self.request_allowance >= 1
+                tokens_ok = not self.tokens_per_minute or self.token_allowance >= tokens
+                if requests_ok and tokens_ok:
+                    if self.requests_per_minute:
+                        self.request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self.token_allowance -= tokens
+                    return
+                wait = max(
+                    0 if requests_ok else (1 - self.request_allowance) * 60 / self.requests_per_minute,
+                    0 if tokens_ok else (tokens - self.token_allowance) * 60 / self.tokens_per_minute,
+                )
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+
+def get_batch_alignment_instruction(granular: bool = False) -> str:
+    """The batched form of the scripts' per-verse instructions (run_align.py also asks for a fairly granular alignment)"""
+    return (
+        'Please also align each of the following sentences in the same way. Avoid including multiple phrases in a single alignment unit. '
+        'You may need to break phrases on commas or other major punctuation, including enclosing quotation marks. '
+        'But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. '
+        + ('Try to align in a fairly granular manner. ' if granular else '')
+        + 'Always respond with perfect JSON: a single array with one object per sentence, in the order given, '
+        'where each object has the sentence\'s "vref" and its "alignment" (a list of alignment units like the one above):'
+    )
+
+BATCH_ALIGNMENT_INSTRUCTION = get_batch_alignment_instruction()
+
+
+def generate_batch_alignment_prompt(verses: list[dict], preamble: str, generate_verse_block, instruction: str = BATCH_ALIGNMENT_INSTRUCTION) -> str:
+    """One prompt for several verses: the shared few-shot preamble once, then each verse tagged with its vref"""
+    blocks = ''.join(f'\nvref: {verse["vref"]}\n{generate_verse_block(verse)}' for verse in verses)
+    return f'{preamble}{instruction}\n{blocks}'
+
+
+def estimate_alignment_tokens(verse_block: str, model: str) -> int:
+    """Rough completion size for one verse: the alignment repeats all three texts, plus JSON keys for every unit"""
+    return 3 * count_tokens(verse_block, model) + 100
+
+
+def pack_alignment_batches(verses: list[dict], get_preamble, generate_verse_block, batch_size: int, token_budget: int, model: str, instruction: str = BATCH_ALIGNMENT_INSTRUCTION):
+    """
+    Group verses into batches of up to `batch_size` that share a preamble (see `get_preamble(verse)`), splitting
+    a batch early once its prompt plus the expected completion would go over `token_budget` (the model's context).
+    Each prompt is the preamble, then `instruction`, then the verses.
+    Yields (verses, prompt, max_tokens) tuples; a verse that doesn't fit a batch on its own still gets a batch of one.
+    """
+    preamble_tokens = {}
+    batch, batch_preamble, batch_tokens, completion_tokens = [], None, 0, 0
+
+    def flush():
+        prompt = generate_batch_alignment_prompt(batch, batch_preamble, generate_verse_block, instruction)
+        prompt_tokens = count_tokens(prompt, model)
+        # Let the completion use whatever context is left (the estimate is only used to decide where to split)
+        max_tokens = token_budget - prompt_tokens if token_budget and token_budget > prompt_tokens else completion_tokens
+        return list(batch), prompt, max_tokens
+
+    for verse in verses:
+        preamble = get_preamble(verse)
+        if preamble not in preamble_tokens:
+            preamble_tokens[preamble] = count_tokens(preamble + instruction, model)
+        block = f'\nvref: {verse["vref"]}\n{generate_verse_block(verse)}'
+        verse_tokens = count_tokens(block, model)
+        verse_completion_tokens = estimate_alignment_tokens(block, model)
+
+        fits = (
+            preamble == batch_preamble
+            and len(batch) < batch_size
+            and (not token_budget or batch_tokens + verse_tokens + completion_tokens + verse_completion_tokens <= token_budget)
+        )
+        if batch and not fits:
+            yield flush()
+            batch = []
+        if not batch:
+            batch_preamble, batch_tokens, completion_tokens = preamble, preamble_tokens[preamble], 0
+        batch.append(verse)
+        batch_tokens += verse_tokens
+        completion_tokens += verse_completion_tokens
+    if batch:
+        yield flush()
+
+
+def split_batch_alignments(response) -> dict:
+    """
+    Demultiplex a batched alignment response into {vref: alignment}.
+    Accepts the requested array of {"vref", "alignment"} objects, or an object keyed by vref.
+    Raises json.JSONDecodeError if the response isn't JSON.
+    """
+    if not isinstance(response, str):
+        raise json.JSONDecodeError('No response text', str(response), 0)
+    data = json.loads(response)
+    if isinstance(data, dict):
+        return {vref: alignment for vref, alignment in data.items() if isinstance(alignment, list)}
+    alignments = {}
+    for item in data if isinstance(data, list) else []:
+        if isinstance(item, dict) and isinstance(item.get('vref'), str) and isinstance(item.get('alignment'), list):
+            alignments[item['vref']] = item['alignment']
+    return alignments
+
+
+class AlignmentCheckpoint():
+    """
+    Tracks which verses of an alignment run are done, so an interrupted run can be resumed.
+
+    Results are appended to the run's JSONL output through `write`, and each write also appends
+    `vref<TAB>ok<TAB>end_offset` to `<output>.checkpoint`. Resuming only reads that small index, plus
+    any output rows written after the last checkpointed offset (e.g., if the run crashed between the two writes).
+    Output files without a checkpoint (from older or finished runs) are indexed from scratch on first use.
+    A row counts as failed if it has `"error": "true"`; failed verses are retried on resume.
+    Call `finish` once a run completes: the checkpoint is only kept for runs that were interrupted.
+    """
+
+    def __init__(self, output_file_path: str):
+        self.output_file_path = output_file_path
+        self.path = f'{output_file_path}.checkpoint'
+        self.status: dict[str, bool] = {} # vref -> whether its latest row succeeded
+        self.offset = 0 # how far into the output file the checkpoint covers
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if not line.endswith('\n') or len(parts) != 3: # partially written
+                        continue
+                    vref, ok, offset = parts
+                    self.status[vref] = ok == '1'
+                    self.offset = int(offset)
+
+        output_size = os.path.getsize(self.output_file_path) if os.path.exists(self.output_file_path) else 0
+        if output_size < self.offset: # the output was replaced, so the checkpoint is stale
+            self.status.clear()
+            self.offset = 0
+            os.remove(self.path)
+        if output_size > self.offset:
+            # Index rows that made it to the output but not to the checkpoint
+            with open(self.output_file_path, 'rb') as f:
+                f.seek(self.offset)
+                offset = self.offset
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._record(row, offset)
+
+    @staticmethod
+    def is_success(row: dict) -> bool:
+        return row.get('error') != 'true'
+
+    def _record(self, row: dict, offset: int):
+        ok = self.is_success(row)
+        self.status[row['vref']] = ok
+        self.offset = offset
+        with open(self.path, 'a') as f:
+            f.write(f"{row['vref']}\t{int(ok)}\t{offset}\n")
+
+    def write(self, row: dict):
+        """Append a result row to the output file and record it in the checkpoint"""
+        with self.lock:
+            with open(self.output_file_path, 'a') as f:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write('\n')
+                f.flush()
+                offset = f.tell()
+            self._record(row, offset)
+
+    def is_done(self, vref: str) -> bool:
+        return self.status.get(vref, False)
+
+    def get_remaining(self, verses: list[dict]) -> list[dict]:
+        """Verses that haven't been aligned successfully yet"""
+        remaining = [verse for verse in verses if not self.is_done(verse['vref'])]
+        print(f'Resuming {self.output_file_path}: {len(verses) - len(remaining)} verses already aligned, {len(remaining)} to go '
+              f'({sum(1 for verse in remaining if verse["vref"] in self.status)} retries of failed verses)')
+        return remaining
+
+    def compact(self):
+        """Rewrite the output with only the latest row per vref (dropping failed rows that were since retried)"""
+        with self.lock:
+            rows = {}
+            with open(self.output_file_path, 'r') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    rows.pop(row['vref'], None) # keep the position of the latest row
+                    rows[row['vref']] = row
+            tmp_path = f'{self.output_file_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                for row in rows.values():
+                    f.write(json.dumps(row, ensure_ascii=False))
+                    f.write('\n')
+            os.replace(tmp_path, self.output_file_path)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.status.clear()
+            self.offset = 0
+            self._load()
+
+    def finish(self, compact: bool = False):
+        """The run completed: optionally `compact` the output, then remove the checkpoint (a later resume re-indexes the output)"""
+        if compact:
+            self.compact()
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def get_output_file_path(output_dir: str, prefix: str, timestamp: str, resume=None, suffix: str = '') -> str:
+    """
+    Output file for a run: a new timestamped file, or with `resume` an existing one to continue
+    (`resume='latest'` picks the most recent output of the same run, script and model).
+    """
+    if resume is None:
+        return f'{output_dir}/{prefix}_{timestamp}{suffix}.jsonl'
+    if resume != 'latest':
+        return resume
+    # Exactly `<prefix>_<timestamp><suffix>.jsonl`, so that e.g. chunk outputs (`..._3.jsonl`) don't match a run without a suffix
+    timestamp_pattern = re.sub(r'\d', r'\\d', re.escape(timestamp)) # any timestamp shaped like this run's
+    pattern = re.compile(f'{re.escape(prefix)}_{timestamp_pattern}{re.escape(suffix)}\\.jsonl')
+    candidates = [path for path in glob.glob(f'{output_dir}/{glob.escape(prefix)}_*.jsonl') if pattern.fullmatch(os.path.basename(path))]
+    if not candidates:
+        print(f'No earlier output found for {prefix} in {output_dir}, starting a new run')
+        return f'{output_dir}/{prefix}_{timestamp}{suffix}.jsonl'
+    return max(candidates, key=os.path.getmtime)
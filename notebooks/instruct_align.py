@@ -3,11 +3,13 @@ import os
 import json
 import random
 import time
+from alignment_utils import cached_completion, add_cache_arguments, get_use_cache, AlignmentCheckpoint, get_output_file_path, count_tokens, pack_alignment_batches, split_batch_alignments
 
 openai.api_key = os.environ['OPENAI_API_KEY']
 openai.organization = os.environ['OPENAI_API_ORG']
 
 MAX_RETRIES = 10
+MAX_TOKENS = 1000
 
 ### PARSE ARGS ###
 
@@ -23,6 +25,10 @@ parser.add_argument('--n', type=int, default=0, help='Number of verses to sample
 parser.add_argument('--start_index', type=int, default=0, help='Start index for the verses to sample')
 parser.add_argument('--chunk_size', type=int, default=None, help='Size of each chunk')
 parser.add_argument('--current_chunk', type=int, default=None, help='Current chunk to process')
+add_cache_arguments(parser)
+parser.add_argument('--batch_size', type=int, default=1, help='Verses per prompt (they share one copy of the few-shot examples); 1 to align verse by verse')
+parser.add_argument('--batch_tokens', type=int, default=4096, help="Model context size in tokens; batches are split so that the prompt plus the expected alignments fit")
+parser.add_argument('--resume', type=str, nargs='?', const='latest', default=None, help='Continue an earlier run: path to its output file, or no value for the latest output of this run (skips aligned verses, retries failed ones)')
 
 # Parse the arguments
 args = parser.parse_args()
@@ -46,10 +52,8 @@ selected_model = args.model
 
 
 ### ALIGNMENT FUNCTIONS ###
-def generate_broad_greek_alignment_prompt(verse):
-    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
-    try:
-        return f'''Here are some general facts to note about Spanish:
+def generate_broad_greek_alignment_preamble():
+    return f'''Here are some general facts to note about Spanish:
 Spanish is a fusional language, ensure correct affix attachment; follow SVO order; mark verbs for tense, aspect, mood.
 For translating from Greek: replace Greeks's three-gender system with Spanish's two-gender system, ensuring agreement; shift to SVO order; adapt Greek Voice/Aspect/Mood markings to Spanish system.
 
@@ -100,20 +104,26 @@ Here is a phonological, semantic, orthographic alignment of that sentence:
 ]
 ```
 
-Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases  on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Always respond with perfect JSON:
+'''
+
+GREEK_ALIGNMENT_INSTRUCTION = 'Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases  on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Always respond with perfect JSON:'
 
-Target Phrase: {target}
+def generate_greek_verse_block(verse):
+    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
+    return f'''Target Phrase: {target}
 English Phrase: {bsb}
 Greek Phrase: {macula}
 '''
+
+def generate_broad_greek_alignment_prompt(verse):
+    try:
+        return generate_broad_greek_alignment_preamble() + GREEK_ALIGNMENT_INSTRUCTION + '\n\n' + generate_greek_verse_block(verse)
     except Exception as e:
         print('Error on Greek alignment prompt generation.', e)
         return 'ERROR'
 
-def generate_broad_hebrew_alignment_prompt(verse):
-    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
-    try:
-        return f'''Here are some general facts to note about Spanish:
+def generate_broad_hebrew_alignment_preamble():
+    return f'''Here are some general facts to note about Spanish:
 Spanish is a fusional language, ensure correct affix attachment; follow SVO order; mark verbs for tense, aspect, mood.
 For translating from Hebrew: shift to SVO order; adapt Hebrew Voice/Aspect/Mood markings to Spanish system.
 
@@ -176,12 +186,20 @@ Here is a phonological, semantic, orthographic alignment of that sentence:
 ]
 ```
 
-Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Always respond with perfect JSON:
+'''
+
+HEBREW_ALIGNMENT_INSTRUCTION = 'Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Always respond with perfect JSON:'
 
-Target: {target}
+def generate_hebrew_verse_block(verse):
+    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
+    return f'''Target: {target}
 English: {bsb}
 Hebrew: {macula}
 '''
+
+def generate_broad_hebrew_alignment_prompt(verse):
+    try:
+        return generate_broad_hebrew_alignment_preamble() + HEBREW_ALIGNMENT_INSTRUCTION + '\n\n' + generate_hebrew_verse_block(verse)
     except Exception as e:
         return 'ERROR'
     
@@ -200,21 +218,34 @@ def generate_broad_alignment_prompt(data_element):
     else:
         return generate_broad_greek_alignment_prompt(data_element)
 
-def align(prompt):
-    formatted_prompt = ("You are LangAlignerGPT. Analyze the user-supplied alignment examples below and follow any instructions the user gives. Always respond with perfect JSON.\n"
-                        f'{prompt}')
+# For batches: the preamble and verse block that `generate_broad_alignment_prompt` would use for a verse
+def get_alignment_preamble(data_element):
+    if book_idx[data_element['vref'][:3]] < 40:
+        return generate_broad_hebrew_alignment_preamble()
+    else:
+        return generate_broad_greek_alignment_preamble()
+
+def generate_verse_block(data_element):
+    if book_idx[data_element['vref'][:3]] < 40:
+        return generate_hebrew_verse_block(data_element)
+    else:
+        return generate_greek_verse_block(data_element)
+
+SYSTEM_PROMPT = "You are LangAlignerGPT. Analyze the user-supplied alignment examples below and follow any instructions the user gives. Always respond with perfect JSON.\n"
+
+def align(prompt, max_tokens=MAX_TOKENS):
+    formatted_prompt = f'{SYSTEM_PROMPT}{prompt}'
 
     max_retries = MAX_RETRIES
+    request = dict(
+        model=selected_model,
+        prompt=formatted_prompt,
+        temperature=0.1,
+        max_tokens=max_tokens,
+    )
     for i in range(max_retries):
         try:
-            response = openai.Completion.create(
-              model=selected_model,
-              prompt=formatted_prompt,
-              temperature=0.1,
-              max_tokens=1000,
-              api_key = os.environ['OPENAI_API_KEY'],
-            )
-            return response['choices'][0]['text']
+            return cached_completion(request, lambda: openai.Completion.create(**request, api_key=os.environ['OPENAI_API_KEY'])['choices'][0]['text'], use_cache=get_use_cache(args))
         except (openai.error.APIConnectionError, openai.error.APIError) as e:
             if i < max_retries - 1:  # i is zero indexed
                 continue
@@ -257,14 +288,20 @@ else:
         with open(f'{args.data_path}_{i}.json', 'r') as f:
             json_data.extend(json.load(f))
             
-if args.current_chunk is None:
-    output_file_path = f'{output_dir}/{os.path.basename(args.data_path)}_{bible_name}_{selected_model}_{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.jsonl'
-else:
-    output_file_path = f'{output_dir}/{os.path.basename(args.data_path)}_{bible_name}_{selected_model}_{datetime.datetime.now().strftime("%Y%m%d-%H%M")}_{args.current_chunk}.jsonl'
+output_file_path = get_output_file_path(
+    output_dir,
+    f'{os.path.basename(args.data_path)}_{bible_name}_{selected_model}',
+    datetime.datetime.now().strftime("%Y%m%d-%H%M"),
+    resume=args.resume,
+    suffix='' if args.current_chunk is None else f'_{args.current_chunk}',
+)
+checkpoint = AlignmentCheckpoint(output_file_path)
+if args.resume:
+    json_data = checkpoint.get_remaining(json_data)
 
 ### ALIGN ###
 
-for sample in json_data:
+def align_sample(sample):
     prompt = generate_broad_alignment_prompt(sample)
     retries = 0
     while retries < MAX_RETRIES:
@@ -272,6 +309,7 @@ for sample in json_data:
             response = align(prompt)
             output = json.loads(response)
             sample['alignment'] = output
+            sample['error'] = 'false' # clear the error from any earlier failed attempt, so resumed runs don't retry this verse
             break
         except json.JSONDecodeError:
             retries += 1
@@ -283,7 +321,25 @@ for sample in json_data:
                 time.sleep(1)  # Wait for 1 second before retrying
                 sample['alignment'] = response
                 sample['error'] = 'true'
-      
-    with open(output_file_path, 'a') as f:
-        f.write(json.dumps(sample, ensure_ascii=False))
-        f.write('\n')
+    return sample
+
+if args.batch_size > 1:
+    # Several verses per prompt; any verse missing from the response falls back to a prompt of its own
+    token_budget = args.batch_tokens - count_tokens(SYSTEM_PROMPT, selected_model)
+    for samples, prompt, max_tokens in pack_alignment_batches(json_data, get_alignment_preamble, generate_verse_block, args.batch_size, token_budget, selected_model):
+        try:
+            alignments = split_batch_alignments(align(prompt, max_tokens=max_tokens))
+        except json.JSONDecodeError:
+            alignments = {}
+        for sample in samples:
+            if sample['vref'] in alignments:
+                sample['alignment'] = alignments[sample['vref']]
+                sample['error'] = 'false'
+            else:
+                align_sample(sample)
+            checkpoint.write(sample)
+else:
+    for sample in json_data:
+        checkpoint.write(align_sample(sample))
+
+checkpoint.finish(compact=args.resume is not None) # resumed outputs have a row per attempt, keep only the latest
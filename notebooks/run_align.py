@@ -3,11 +3,14 @@ import os
 import json
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from alignment_utils import cached_completion, add_cache_arguments, get_use_cache, count_tokens, RateLimiter, AlignmentCheckpoint, get_output_file_path, get_batch_alignment_instruction, pack_alignment_batches, split_batch_alignments
 
 openai.api_key = os.environ['OPENAI_API_KEY']
 openai.organization = os.environ['OPENAI_API_ORG']
 
 MAX_RETRIES = 10
+MAX_TOKENS = 1200
 
 ### PARSE ARGS ###
 
@@ -21,6 +24,13 @@ parser.add_argument('--data_path', type=str, default='/Users/ryderwishart/transl
 parser.add_argument('--model', type=str, default='gpt-3.5-turbo-instruct', help='Name of the model')
 parser.add_argument('--n', type=int, default=0, help='Number of verses to sample')
 parser.add_argument('--ids_file_path', type=str, default=None, help='Path to the txt file containing vref ids')
+add_cache_arguments(parser)
+parser.add_argument('--concurrency', type=int, default=8, help='Number of verses to align at once')
+parser.add_argument('--rpm', type=int, default=3000, help='Requests per minute limit (0 for no limit)')
+parser.add_argument('--tpm', type=int, default=250000, help='Tokens per minute limit, prompt + max completion tokens (0 for no limit)')
+parser.add_argument('--batch_size', type=int, default=1, help='Verses per prompt (they share one copy of the few-shot examples); 1 to align verse by verse')
+parser.add_argument('--batch_tokens', type=int, default=4096, help="Model context size in tokens; batches are split so that the prompt plus the expected alignments fit")
+parser.add_argument('--resume', type=str, nargs='?', const='latest', default=None, help='Continue an earlier run: path to its output file, or no value for the latest output of this run (skips aligned verses, retries failed ones)')
 
 # Parse the arguments
 args = parser.parse_args()
@@ -29,6 +39,9 @@ args = parser.parse_args()
 print(f"Run Name: {args.run_name}")
 print(f"Data Path: {args.data_path}")
 print(f"Model: {args.model}")
+print(f"Concurrency: {args.concurrency}, limits: {args.rpm} requests/min, {args.tpm} tokens/min")
+if args.batch_size > 1:
+    print(f"Batch size: {args.batch_size} verses, up to {args.batch_tokens} tokens")
 if args.n == 0:
     print("Number of Verses to Sample: ALL")
 else:
@@ -41,10 +54,8 @@ if args.ids_file_path:
 
 
 ### ALIGNMENT FUNCTIONS ###
-def generate_broad_greek_alignment_prompt(verse):
-    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
-    try:
-        return f'''Translation style:
+def generate_broad_greek_alignment_preamble():
+    return f'''Translation style:
 The French translation is  a literal translation trying to stick closely to the Hebrew word order, but there may occasionally be instances where Target phrases differ to produce a more natural translation.
 
 Here is a sentence:
@@ -108,20 +119,26 @@ Here is a phonological, semantic, orthographic alignment of that sentence:
 ]
 ```
 
-Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases  on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Try to align in a fairly granular manner. Always respond with perfect JSON:
+'''
+
+GREEK_ALIGNMENT_INSTRUCTION = 'Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases  on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Try to align in a fairly granular manner. Always respond with perfect JSON:'
 
-Target: {target}
+def generate_greek_verse_block(verse):
+    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
+    return f'''Target: {target}
 English: {bsb}
 Greek: {macula}
 '''
+
+def generate_broad_greek_alignment_prompt(verse):
+    try:
+        return generate_broad_greek_alignment_preamble() + GREEK_ALIGNMENT_INSTRUCTION + '\n\n' + generate_greek_verse_block(verse)
     except Exception as e:
         print('Error on Greek alignment prompt generation.', e)
         return 'ERROR'
 
-def generate_broad_hebrew_alignment_prompt(verse): # FIXME: add a French example, and make it more granular
-    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
-    try:
-        return f'''Translation style:
+def generate_broad_hebrew_alignment_preamble(): # FIXME: add a French example, and make it more granular
+    return f'''Translation style:
 The French translation is  a literal translation trying to stick closely to the Hebrew word order, but there may occasionally be instances where Target phrases differ to produce a more natural translation.
 
 Here is a sentence:
@@ -180,12 +197,20 @@ Here is a phonological, semantic, orthographic alignment of that sentence:
 ]
 ```
 
-Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Try to align in a fairly granular manner. Always respond with perfect JSON:
+'''
+
+HEBREW_ALIGNMENT_INSTRUCTION = 'Please also align the following sentence. Avoid including multiple phrases in a single alignment unit. You may need to break phrases on commas or other major punctuation, including enclosing quotation marks. But you may also need to break a phrase along conjunctions or other words that typically mark the start of a new phrase. Try to align in a fairly granular manner. Always respond with perfect JSON:'
 
-Target: {target}
+def generate_hebrew_verse_block(verse):
+    bsb, macula, target = verse['bsb']['content'], verse['macula']['content'], verse['target']['content']
+    return f'''Target: {target}
 English: {bsb}
 Hebrew: {macula}
 '''
+
+def generate_broad_hebrew_alignment_prompt(verse):
+    try:
+        return generate_broad_hebrew_alignment_preamble() + HEBREW_ALIGNMENT_INSTRUCTION + '\n\n' + generate_hebrew_verse_block(verse)
     except Exception as e:
         return 'ERROR'
     
@@ -204,21 +229,42 @@ def generate_broad_alignment_prompt(data_element):
     else:
         return generate_broad_greek_alignment_prompt(data_element)
 
-def align(prompt):
-    formatted_prompt = ("You are LangAlignerGPT. Analyze the user-supplied alignment examples below and follow any instructions the user gives. Always respond with perfect JSON.\n"
-                        f'{prompt}')
+# For batches: the preamble and verse block that `generate_broad_alignment_prompt` would use for a verse
+def get_alignment_preamble(data_element):
+    if book_idx[data_element['vref'][:3]] < 40:
+        return generate_broad_hebrew_alignment_preamble()
+    else:
+        return generate_broad_greek_alignment_preamble()
+
+def generate_verse_block(data_element):
+    if book_idx[data_element['vref'][:3]] < 40:
+        return generate_hebrew_verse_block(data_element)
+    else:
+        return generate_greek_verse_block(data_element)
+
+SYSTEM_PROMPT = "You are LangAlignerGPT. Analyze the user-supplied alignment examples below and follow any instructions the user gives. Always respond with perfect JSON.\n"
 
+def align(prompt, max_tokens=MAX_TOKENS):
+    formatted_prompt = f'{SYSTEM_PROMPT}{prompt}'
 
+
+    request = dict(
+        model=args.model,
+        prompt=formatted_prompt,
+        temperature=0.1,
+        max_tokens=max_tokens,
+    )
+    def create():
+        # Only requests that actually reach the API count against the rate limits (cache hits don't)
+        rate_limiter.acquire(count_tokens(formatted_prompt, args.model) + max_tokens)
+        return openai.Completion.create(**request)['choices'][0]['text']
     for i in range(MAX_RETRIES):
         try:
-            response = openai.Completion.create(
-              model=args.model,
-              prompt=formatted_prompt,
-              temperature=0.1,
-              max_tokens=1200,
-            #   api_key = os.environ['OPENAI_API_KEY'],
-            )
-            return response['choices'][0]['text']
+            return cached_completion(request, create, use_cache=get_use_cache(args))
+        except openai.error.RateLimitError as e:
+            time.sleep(min(2 ** i, 60)) # our limits are set too high for the account; back off and try again
+            if i == MAX_RETRIES - 1:
+                return {"error": str(e)}
         except (openai.error.APIConnectionError, openai.error.APIError) as e:
             if i < MAX_RETRIES - 1:  # i is zero indexed
                 continue
@@ -256,9 +302,14 @@ if specified_ids:
 
 ### ALIGN ###
 
-output_file_path = f'{output_dir}/alignments_{os.path.basename(args.data_path)}_{args.run_name}_{args.model}_{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.jsonl'
+output_file_path = get_output_file_path(output_dir, f'alignments_{os.path.basename(args.data_path)}_{args.run_name}_{args.model}', datetime.datetime.now().strftime("%Y%m%d-%H%M"), resume=args.resume)
+checkpoint = AlignmentCheckpoint(output_file_path)
+if args.resume:
+    json_data = checkpoint.get_remaining(json_data)
 
-for verse in json_data:
+rate_limiter = RateLimiter(args.rpm, args.tpm)
+
+def align_verse(verse):
     prompt = generate_broad_alignment_prompt(verse)
     try:
         print('aligning', verse['vref'])
@@ -266,9 +317,45 @@ for verse in json_data:
         output = json.loads(response) # FIXME: use pyjson5 ?
         verse['alignment'] = output
         verse['error'] = 'false'
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, TypeError): # TypeError: align() gave up and returned an error dict
         verse['alignment'] = 'Error: Maximum retries exceeded'
         verse['error'] = 'true'
-    with open(output_file_path, 'a') as f:
-        f.write(json.dumps(verse, ensure_ascii=False))
-        f.write('\n')
+    return verse
+
+def align_batch(batch):
+    verses, prompt, max_tokens = batch
+    try:
+        print('aligning', ', '.join(verse['vref'] for verse in verses))
+        alignments = split_batch_alignments(align(prompt, max_tokens=max_tokens))
+    except json.JSONDecodeError:
+        alignments = {}
+    for verse in verses:
+        if verse['vref'] in alignments:
+            verse['alignment'] = alignments[verse['vref']]
+            verse['error'] = 'false'
+        else:
+            align_verse(verse) # missing from the batch response: fall back to a prompt of its own
+    return verses
+
+# Verses are aligned concurrently, and written in the order they finish (each line carries its vref)
+if args.batch_size > 1:
+    token_budget = args.batch_tokens - count_tokens(SYSTEM_PROMPT, args.model)
+    tasks = list(pack_alignment_batches(json_data, get_alignment_preamble, generate_verse_block, args.batch_size, token_budget, args.model, instruction=get_batch_alignment_instruction(granular=True)))
+    task_function = align_batch
+    print(f'Packed {len(json_data)} verses into {len(tasks)} prompts')
+else:
+    tasks = json_data
+    task_function = lambda verse: [align_verse(verse)]
+
+start_time = time.time()
+aligned = 0
+with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    futures = [executor.submit(task_function, task) for task in tasks]
+    for future in as_completed(futures):
+        for verse in future.result():
+            checkpoint.write(verse)
+            aligned += 1
+            if aligned % 100 == 0:
+                print(f'{aligned}/{len(json_data)} verses aligned ({aligned / (time.time() - start_time) * 60:.0f} verses/min, {rate_limiter.waited_seconds:.0f}s waited on rate limits)')
+
+checkpoint.finish(compact=args.resume is not None) # resumed outputs have a row per attempt, keep only the latest
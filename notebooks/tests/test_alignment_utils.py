@@ -0,0 +1,87 @@
+import unittest
+import json
+import os
+import tempfile
+import time
+
+from notebooks.alignment_utils import AlignmentCheckpoint, get_output_file_path
+
+
+class TestGetOutputFilePath(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def touch(self, name: str, mtime: float) -> str:
+        path = f'{self.directory.name}/{name}'
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_new_run(self):
+        self.assertEqual(get_output_file_path('out', 'run', '20240101-1200', suffix='_2'), 'out/run_20240101-1200_2.jsonl')
+        self.assertEqual(get_output_file_path('out', 'run', '20240101-1200', resume='out/old.jsonl'), 'out/old.jsonl')
+
+    def test_latest_matches_the_exact_run(self):
+        now = time.time()
+        expected = self.touch('run_20240101-1200.jsonl', now - 30)
+        self.touch('run_20240102-1200_3.jsonl', now - 20) # a chunk of the same run
+        self.touch('run_long_20240103-1200.jsonl', now - 10) # a run whose name starts with ours
+        self.touch('run_20240104-1200.jsonl.checkpoint', now)
+        self.assertEqual(get_output_file_path(self.directory.name, 'run', '20240105-1200', resume='latest'), expected)
+        chunk = get_output_file_path(self.directory.name, 'run', '20240105-1200', resume='latest', suffix='_3')
+        self.assertEqual(os.path.basename(chunk), 'run_20240102-1200_3.jsonl')
+
+    def test_latest_without_earlier_output(self):
+        self.touch('other_20240101-1200.jsonl', time.time())
+        path = get_output_file_path(self.directory.name, 'run', '20240105-1200', resume='latest')
+        self.assertEqual(os.path.basename(path), 'run_20240105-1200.jsonl')
+
+
+class TestAlignmentCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.output_path = f'{self.directory.name}/run.jsonl'
+
+    def read_rows(self) -> list[dict]:
+        with open(self.output_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_resume_after_an_interruption(self):
+        verses = [{'vref': f'GEN 1:{i}'} for i in range(1, 6)]
+        checkpoint = AlignmentCheckpoint(self.output_path)
+        checkpoint.write({'vref': 'GEN 1:1', 'error': 'false'})
+        checkpoint.write({'vref': 'GEN 1:2', 'error': 'true'})
+        with open(self.output_path, 'a') as f: # written to the output, but the run died before the checkpoint
+            f.write(json.dumps({'vref': 'GEN 1:3', 'error': 'false'}) + '\n')
+            f.write('{"vref": "GEN 1:4", "err') # and this row was cut short
+
+        resumed = AlignmentCheckpoint(self.output_path)
+        self.assertEqual([verse['vref'] for verse in resumed.get_remaining(verses)], ['GEN 1:2', 'GEN 1:4', 'GEN 1:5'])
+
+    def test_finish(self):
+        checkpoint = AlignmentCheckpoint(self.output_path)
+        checkpoint.write({'vref': 'GEN 1:1', 'error': 'true'})
+        checkpoint.write({'vref': 'GEN 1:2', 'error': 'false'})
+        checkpoint.write({'vref': 'GEN 1:1', 'error': 'false'}) # retried
+        self.assertTrue(os.path.exists(checkpoint.path))
+        checkpoint.finish(compact=True)
+        self.assertFalse(os.path.exists(checkpoint.path))
+        self.assertEqual(self.read_rows(), [{'vref': 'GEN 1:2', 'error': 'false'}, {'vref': 'GEN 1:1', 'error': 'false'}])
+        self.assertEqual(AlignmentCheckpoint(self.output_path).get_remaining([{'vref': 'GEN 1:1'}, {'vref': 'GEN 1:3'}]), [{'vref': 'GEN 1:3'}])
+
+    def test_replaced_output_invalidates_the_checkpoint(self):
+        checkpoint = AlignmentCheckpoint(self.output_path)
+        checkpoint.write({'vref': 'GEN 1:1', 'alignment': 'a long alignment', 'error': 'false'})
+        with open(self.output_path, 'w') as f:
+            f.write(json.dumps({'vref': 'GEN 1:2'}) + '\n')
+        resumed = AlignmentCheckpoint(self.output_path)
+        self.assertFalse(resumed.is_done('GEN 1:1'))
+        self.assertTrue(resumed.is_done('GEN 1:2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
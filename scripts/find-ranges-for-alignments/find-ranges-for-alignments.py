@@ -1,30 +1,23 @@
 import os
 import re
+import bisect
 import json
 import argparse
-from fuzzywuzzy import process, fuzz
-from nltk.util import ngrams
+from collections import Counter, deque
+from itertools import islice
+from multiprocessing import Pool
+from rapidfuzz import fuzz, utils
 from tqdm import tqdm
 from typing import List, Dict, Union, Optional, Any, NamedTuple
 import requests
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description='Process alignment files.')
-parser.add_argument('filepath', help='the file to process')
-args = parser.parse_args()
-
-print(f"Processing {args.filepath}")
-
-MASK_TOKEN = '*'
+MAX_NGRAM_SIZE = 10
+MIN_MATCH_SCORE = 30 # fuzzy matches scoring at or below this are treated as not found
 
 # Define a NamedTuple for range results
 class RangeResult(NamedTuple):
     startPosition: int
     endPosition: int
-    dummy_content: str
-
-# Define a global variable to keep track of unmatched tokens
-macula_tokens_not_matched = 0
 
 def download_file(url: str, output_path: str) -> None:
     """Download a file if it does not exist."""
@@ -65,118 +58,264 @@ def assign_macula_tokens_by_vref(normalize_data: list[Dict[str, Any]]) -> List[D
         processed_data.append(data)
     return processed_data
 
-def generate_ngrams(text, n):
-    return [' '.join(gram) for gram in ngrams(text.split(), n)]
-
-def find_best_match(text, choices):
-    scores = [(choice, fuzz.WRatio(text, choice)) for choice in choices]
-    scores = sorted(scores, key=lambda x: (x[1], len(x[0])), reverse=True)
-    return scores[0] if scores else (None, 0)
-
-def find_ranges(dummy_content: str, text: str) -> RangeResult:
-    global macula_tokens_not_matched
-    text_not_found_in_content_value = RangeResult(-1, -1, dummy_content)  # Dummy content, start, end
+def normalize_for_matching(text: str) -> str:
+    """Lowercase, with punctuation and other non-alphanumerics turned into spaces (what fuzzywuzzy's full_process did)"""
+    return ' '.join(token for token in (utils.default_process(token) for token in text.split()) if token)
+
+class TokenSpans():
+    """
+    The whitespace-separated tokens of a verse, with their character offsets and normalized text.
+    Computed once per verse, so that each fuzzy search only joins the n-grams it needs.
+    """
+    def __init__(self, content: str):
+        matches = list(re.finditer(r'\S+', content))
+        self.offsets = [(match.start(), match.end()) for match in matches]
+        self.starts = [start for start, _ in self.offsets]
+        self.normalized = [normalize_for_matching(match.group()) for match in matches]
+
+class MatchState():
+    """
+    The parts of a verse that earlier matches have used up, so that each span is only matched once.
+
+    Consumed characters are marked in a bytearray mask over the content (rather than masked out of a copy of it),
+    and the tokens they touch are updated in place: a token is skipped by the fuzzy search once it's fully consumed,
+    and a partly consumed one (e.g. a word whose prefix was matched) is only matched on what's left of it.
+    Each n-gram's text is joined once per verse, when it's first a candidate; only n-grams with a partly consumed
+    token are joined again.
+    """
+    def __init__(self, content: str):
+        self.content = content
+        self.spans = TokenSpans(content)
+        self.mask = bytearray(len(content))
+        self.token_text = list(self.spans.normalized)
+        self.token_consumed = [False] * len(self.spans.offsets)
+        self.token_changed = [False] * len(self.spans.offsets) # partly consumed, so token_text differs from the original
+        self.ngram_text: Dict[tuple, str] = {} # (first token, size) -> n-gram text, from the original tokens
+        self.unmatched = 0 # searches that found nothing
+
+    def find(self, text: str) -> int:
+        """Start of the first exact occurrence of text that doesn't overlap a consumed span, or -1"""
+        start = self.content.find(text)
+        while start != -1:
+            consumed = self.mask.find(1, start, start + len(text))
+            if consumed == -1:
+                return start
+            start = self.content.find(text, consumed + 1)
+        return -1
+
+    def get_remaining_text(self, start: int, end: int) -> str:
+        """The unconsumed runs of characters in [start, end), joined by spaces"""
+        runs = []
+        run_start = self.mask.find(0, start, end)
+        while run_start != -1:
+            run_end = self.mask.find(1, run_start, end)
+            if run_end == -1:
+                run_end = end
+            runs.append(self.content[run_start:run_end])
+            run_start = self.mask.find(0, run_end, end)
+        return ' '.join(runs)
+
+    def consume(self, start: int, end: int) -> tuple:
+        """Mark [start, end) as used, returning it without any already consumed characters at either end"""
+        while start < end and self.mask[start]:
+            start += 1
+        while end > start and self.mask[end - 1]:
+            end -= 1
+        self.mask[start:end] = b'\x01' * (end - start)
+        first = max(bisect.bisect_right(self.spans.starts, start) - 1, 0)
+        for i in range(first, len(self.spans.offsets)):
+            token_start, token_end = self.spans.offsets[i]
+            if token_start >= end:
+                break
+            if token_end <= start:
+                continue
+            if self.mask.find(0, token_start, token_end) == -1:
+                self.token_consumed[i] = True
+                self.token_text[i] = ''
+            else:
+                self.token_changed[i] = True
+                self.token_text[i] = normalize_for_matching(self.get_remaining_text(token_start, token_end))
+        return start, end
+
+    def get_candidates(self, query_size: int) -> List[tuple]:
+        """
+        (start, end, normalized text) of the n-grams that could match a query of `query_size` tokens:
+        from half to twice its size (at most MAX_NGRAM_SIZE), skipping n-grams with a consumed token.
+
+        NOTE: this trades some recall for speed. Every size from 1 to MAX_NGRAM_SIZE used to be scored, so a phrase
+        could match a much shorter or longer span (e.g., a 6-token phrase could match the 2 tokens it shares with
+        the verse); now the best span within the size bounds is taken instead, or nothing if none scores high enough.
+        """
+        offsets = self.spans.offsets
+        # Prefix counts of consumed and changed tokens, so an n-gram includes one iff the count changes across it
+        consumed, changed = [0], [0]
+        for token_consumed, token_changed in zip(self.token_consumed, self.token_changed):
+            consumed.append(consumed[-1] + token_consumed)
+            changed.append(changed[-1] + token_changed)
+        min_size = min(max(1, query_size // 2), MAX_NGRAM_SIZE)
+        max_size = min(max(2 * query_size, 2), MAX_NGRAM_SIZE)
+        candidates = []
+        for size in range(min_size, max_size + 1):
+            for first in range(len(offsets) - size + 1):
+                last = first + size - 1
+                if consumed[last + 1] != consumed[first]:
+                    continue
+                if changed[last + 1] != changed[first]:
+                    text = ' '.join(token for token in self.token_text[first:last + 1] if token)
+                else:
+                    text = self.ngram_text.get((first, size))
+                    if text is None:
+                        text = self.ngram_text[first, size] = ' '.join(token for token in self.spans.normalized[first:last + 1] if token)
+                candidates.append((offsets[first][0], offsets[last][1], text))
+        return candidates
+
+def find_best_match(text: str, candidates: List[tuple]) -> Optional[tuple]:
+    """
+    Best fuzzy match (WRatio) for text among candidate spans, as (start, end, score), or None if nothing scores above MIN_MATCH_SCORE.
+    Equally good matches are told apart by a distance penalty: how far the span's length is from the text's, then how far into the verse it starts.
+    """
+    query = normalize_for_matching(text)
+    best, ties = MIN_MATCH_SCORE, []
+    for index, candidate in enumerate(candidates):
+        # As in process.extractOne, the cutoff rises to the best score so far, so weaker spans are given up on early;
+        # unlike it, every span tied for the top score is kept for the tie-break
+        score = fuzz.WRatio(query, candidate[2], processor=None, score_cutoff=best)
+        if score > best:
+            best, ties = score, [index]
+        elif score == best:
+            ties.append(index)
+    if best <= MIN_MATCH_SCORE:
+        return None
+    index = min(ties, key=lambda index: (abs(len(candidates[index][2]) - len(query)), candidates[index][0]))
+    start, end, _ = candidates[index]
+    return start, end, best
+
+def find_ranges(state: MatchState, text: str) -> RangeResult:
+    """
+    Find text in a verse, preferring an exact match and falling back to the best fuzzy-matching n-gram.
+    The matched characters are consumed in `state`, so they aren't matched again.
+    """
+    text_not_found_in_content_value = RangeResult(-1, -1)
 
     if type(text) != str:
         return text_not_found_in_content_value
     
     # Initial simple search
     # FIXME: add some other simple use cases that might allow for strict string matching?
-    start_position = dummy_content.find(text)
+    start_position = state.find(text)
     if start_position != -1:
-        end_position = start_position + len(text)
-        dummy_content = dummy_content[:start_position] + MASK_TOKEN * len(text) + dummy_content[end_position:]
-        # print(dummy_content)
-        return RangeResult(start_position, end_position - 1, dummy_content)
-
-    # If not found, generate N-grams and find the best match
-    all_ngrams = []
-    for n in range(1, 11):  # NOTE: check 1-grams to 10-grams
-        all_ngrams.extend(generate_ngrams(dummy_content, n))
+        start_position, end_position = state.consume(start_position, start_position + len(text))
+        return RangeResult(start_position, end_position - 1)
 
-    closest_match, score = find_best_match(text, all_ngrams) # FIXME: we should add a distance penalty as a tie-breaker
+    # If not found, score the n-grams of the verse and take the best match
+    match = find_best_match(text, state.get_candidates(len(text.split())))
     
-    if score > 30:
-        start_position = dummy_content.find(closest_match)
-        end_position = start_position + len(closest_match)
-        dummy_content = dummy_content[:start_position] + MASK_TOKEN * len(closest_match) + dummy_content[end_position:]
-        # print(dummy_content)
-        return RangeResult(start_position, end_position - 1, dummy_content)
+    if match is not None:
+        start_position, end_position = state.consume(match[0], match[1])
+        return RangeResult(start_position, end_position - 1)
     else:
-        macula_tokens_not_matched = macula_tokens_not_matched + 1
+        state.unmatched += 1
 
     return text_not_found_in_content_value
 
-def range_align_macula_tokens(processed_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Align macula tokens by range."""
-    # for data in processed_data:
-    for data in tqdm(processed_data):
-        content: str = data['macula']['content']
-        dummy_content = content[:]
-        tokens: List[Dict[str, Any]] = data['macula'].get('token_ids', [])
-        for i, token in enumerate(tokens):
-            if i > 1000:  # arbitrary number, adjust as needed
-                print(f"Breaking after {i} iterations for vref {data['vref']}.")
-                break
-            text = token['text']
-            if text == '':
-                continue  # Skip empty tokens
-            range = find_ranges(dummy_content, text)
-            if isinstance(range, RangeResult):
-                dummy_content = range.dummy_content  # Update the dummy_content for the next iteration
-                token['range'] = {"startPosition": range.startPosition, "endPosition": range.endPosition}
-            else:
-                print(f"Error for vref {data['vref']}: {range}")
-    return processed_data
+def range_align_macula_tokens(data: Dict[str, Any], stats: Counter) -> Dict[str, Any]:
+    """Align the macula tokens of one verse by range."""
+    content: str = data['macula']['content']
+    state = MatchState(content if isinstance(content, str) else '')
+    tokens: List[Dict[str, Any]] = data['macula'].get('token_ids', [])
+    for i, token in enumerate(tokens):
+        if i > 1000:  # arbitrary number, adjust as needed
+            print(f"Breaking after {i} iterations for vref {data['vref']}.")
+            break
+        text = token['text']
+        if text == '':
+            continue  # Skip empty tokens
+        range = find_ranges(state, text)
+        if isinstance(range, RangeResult):
+            token['range'] = {"startPosition": range.startPosition, "endPosition": range.endPosition}
+        else:
+            print(f"Error for vref {data['vref']}: {range}")
+    stats['macula_tokens_not_matched'] += state.unmatched
+    return data
 
-def range_align_generated_alignments_to_vers(processed_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Align generated alignments to verses."""
-    for data in tqdm(processed_data):
-    # for data in processed_data:
-        # print(f'Processing {data}')
-        bsb_content = data['bsb']['content']
-        macula_content = data['macula']['content']
-        target_content = data['target']['content']
-        
-        dummy_content_dict = {
-            'English phrase': str(bsb_content[:]) if isinstance(bsb_content, str) else '',
-            'Macula phrase': str(macula_content[:]) if isinstance(macula_content, str) else '',
-            'Target phrase': str(target_content[:]) if isinstance(target_content, str) else ''
-        }
-        
-        alignment: Any = data.get('alignments') if 'alignments' in data else data.get('alignment') # Handle both 'alignments' and 'alignment' keys
-        
-        # Check if alignment is None or a string (which means there was an error), and skip processing if it is
-        if alignment is None or isinstance(alignment, str):
-            print(f"Skipping vref {data['vref']} due to error or None value in alignment data: {alignment}")
-            continue
-        
-        # for align in tqdm(alignment):
-        for align in alignment:
-            for phrase in ['English phrase', 'Macula phrase', 'Target phrase']:
-                original_text = align.get(phrase, None)
-                if original_text is None:
-                    print(f"Warning: Missing key '{phrase}' for vref {data['vref']}")
-                    continue
-                content = {
-                    'English phrase': bsb_content,
-                    'Macula phrase': macula_content,
-                    'Target phrase': target_content
-                }[phrase]
-                if not isinstance(content, str):
-                    print(f"Error: content is not a string (phrase: {phrase}) (vref: {data['vref']}) content: {content}")
-                    continue  # Skip None values
-                if content == '':
-                    print(f"Error: content is empty string (phrase: {phrase}) (vref: {data['vref']})")  # This is a string, not a list
-                    continue  # Skip empty strings
-                dummy_content = dummy_content_dict[phrase]
-                ranges = find_ranges(dummy_content, original_text)
-                dummy_content_dict[phrase] = ranges.dummy_content
-                align[phrase] = {
-                    'original-text-value': original_text,
-                    'ranges': [{"startPosition": ranges.startPosition, "endPosition": ranges.endPosition}]
-                }
-    return processed_data
+def range_align_generated_alignments_to_verse(data: Dict[str, Any], stats: Counter) -> Dict[str, Any]:
+    """Align the generated alignments of one verse to the verse."""
+    bsb_content = data['bsb']['content']
+    macula_content = data['macula']['content']
+    target_content = data['target']['content']
+    
+    match_states = {
+        'English phrase': MatchState(bsb_content if isinstance(bsb_content, str) else ''),
+        'Macula phrase': MatchState(macula_content if isinstance(macula_content, str) else ''),
+        'Target phrase': MatchState(target_content if isinstance(target_content, str) else '')
+    }
+    
+    alignment: Any = data.get('alignments') if 'alignments' in data else data.get('alignment') # Handle both 'alignments' and 'alignment' keys
+    
+    # Check if alignment is None or a string (which means there was an error), and skip processing if it is
+    if alignment is None or isinstance(alignment, str):
+        print(f"Skipping vref {data['vref']} due to error or None value in alignment data: {alignment}")
+        return data
+    
+    # for align in tqdm(alignment):
+    for align in alignment:
+        for phrase in ['English phrase', 'Macula phrase', 'Target phrase']:
+            original_text = align.get(phrase, None)
+            if original_text is None:
+                print(f"Warning: Missing key '{phrase}' for vref {data['vref']}")
+                continue
+            content = {
+                'English phrase': bsb_content,
+                'Macula phrase': macula_content,
+                'Target phrase': target_content
+            }[phrase]
+            if not isinstance(content, str):
+                print(f"Error: content is not a string (phrase: {phrase}) (vref: {data['vref']}) content: {content}")
+                continue  # Skip None values
+            if content == '':
+                print(f"Error: content is empty string (phrase: {phrase}) (vref: {data['vref']})")  # This is a string, not a list
+                continue  # Skip empty strings
+            ranges = find_ranges(match_states[phrase], original_text)
+            align[phrase] = {
+                'original-text-value': original_text,
+                'ranges': [{"startPosition": ranges.startPosition, "endPosition": ranges.endPosition}]
+            }
+    stats['macula_tokens_not_matched'] += sum(state.unmatched for state in match_states.values())
+    return data
+
+def range_align_verse(data: Dict[str, Any]) -> tuple:
+    """Find all the ranges of one verse record; returns the record and its stats (run in the worker processes)"""
+    stats: Counter = Counter()
+    data = range_align_macula_tokens(data, stats)
+    data = range_align_generated_alignments_to_verse(data, stats)
+    stats['verses'] += 1
+    return data, stats
+
+def range_align_chunk(records: List[Dict[str, Any]]) -> List[tuple]:
+    return [range_align_verse(data) for data in records]
+
+def range_align_verses(processed_data: List[Dict[str, Any]], workers: int = 1, chunksize: int = 64):
+    """
+    Find the ranges of every verse record, yielding (record, stats) in input order.
+
+    Verses are independent, so with `workers` > 1 they're sharded across a process pool, `chunksize` records
+    per task. At most two chunks per worker are submitted ahead of the one being yielded, so a slow consumer
+    (e.g., the output writer) holds back the workers rather than letting finished results pile up in memory,
+    as Pool.imap would.
+    """
+    if workers <= 1:
+        for data in processed_data:
+            yield range_align_verse(data)
+        return
+    records = iter(processed_data)
+    with Pool(workers) as pool:
+        pending: deque = deque()
+        while chunk := list(islice(records, chunksize)):
+            pending.append(pool.apply_async(range_align_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
 
 def clean_brackets(s: str) -> str:
     """Remove brackets from a string."""
@@ -279,23 +418,35 @@ def fetch_alignment_keys(normalize_data: list[Dict[str, Any]]) -> set:
 
 test_data = '''{"vref": "GEN 1:11", "bsb": {"vref": "GEN 1:11", "content": "Then God said, “Let the earth bring forth vegetation: seed-bearing plants and fruit trees, each bearing fruit with seed according to its kind.” And it was so."}, "macula": {"vref": "GEN 1:11", "content": "וַיֹּ֣אמֶר אֱלֹהִ֗ים תַּֽדְשֵׁ֤א הָאָ֨רֶץ֙ דֶּ֔שֶׁא עֵ֚שֶׂב מַזְרִ֣יעַ זֶ֔רַע עֵ֣ץ פְּרִ֞י עֹ֤שֶׂה פְּרִי֙ לְמִינ֔וֹ אֲשֶׁ֥ר זַרְעוֹ־ ב֖וֹ עַל־ הָאָ֑רֶץ וַֽיְהִי־ כֵֽן׃"}, "target": {"vref": "GEN 1:11", "content": "Entonces ʼElohim dijo: Produzca la tierra vegetación: hierba que haga germinar semilla y árbol frutal que dé fruto sobre la tierra según su especie, cuya semilla esté en él. Y fue así."}, "alignments": [{"Spanish phrase": "Entonces ʼElohim dijo:", "English phrase": "Then God said,", "Hebrew phrase": "וַיֹּ֣אמֶר אֱלֹהִ֗ים"}, {"Spanish phrase": "Produzca la tierra vegetación:", "English phrase": "\\\"Let the earth bring forth vegetation:", "Hebrew phrase": "תַּֽדְשֵׁ֤א הָאָ֨רֶץ֙ דֶּ֔שֶׁא"}, {"Spanish phrase": "hierba que haga germinar semilla", "English phrase": "seed-bearing plants", "Hebrew phrase": "עֵשֶׂב מַזְרִיעַ זרע"}, {"Spanish phrase": "y árbol frutal que dé fruto sobre la tierra", "English phrase": "\\\"and fruit trees, each bearing fruit with seed according to its kind.\\\"", "Hebrew phrase": "\\\"עץ פרי עושה פרי למינו\\\""}, {"Spanish phrase": ", cuya semilla esté en él.", "English phrase": "\\\"And it was so.\\\"", "Hebrew phrase": "\\\"אשר זרעו בו. ויהי-כן\\\""}]}'''
 
-# Main processing
-if args.filepath == 'test':
-    normalize_data = normalize_phrases('test', test=test_data)
-else:
-    normalize_data = normalize_phrases(args.filepath)
-
-keys = fetch_alignment_keys(normalize_data)
-processed_data = assign_macula_tokens_by_vref(normalize_data)
-processed_data = range_align_macula_tokens(processed_data)
-final_processed_data = range_align_generated_alignments_to_vers(processed_data)
-
-# Writing the final output
-output_filepath = f'{os.path.splitext(args.filepath)[0]}_final_output.jsonl'
-print(f"{macula_tokens_not_matched} macula tokens were not matched")
-with open(output_filepath, 'w') as outfile:
-    for data in final_processed_data:
-        outfile.write(json.dumps(data, ensure_ascii=False) + '\n')
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description='Process alignment files.')
+    parser.add_argument('filepath', help='the file to process')
+    parser.add_argument('--workers', type=int, default=1, help='processes to find ranges in (verses are independent, so they can be spread over all cores)')
+    parser.add_argument('--chunksize', type=int, default=64, help='verses handed to a worker at a time')
+    args = parser.parse_args()
+
+    print(f"Processing {args.filepath}")
+
+    if args.filepath == 'test':
+        normalize_data = normalize_phrases('test', test=test_data)
+    else:
+        normalize_data = normalize_phrases(args.filepath)
+
+    keys = fetch_alignment_keys(normalize_data)
+    processed_data = assign_macula_tokens_by_vref(normalize_data)
+
+    # Writing the final output as verses are done (results arrive in input order)
+    output_filepath = f'{os.path.splitext(args.filepath)[0]}_final_output.jsonl'
+    stats: Counter = Counter()
+    with open(output_filepath, 'w') as outfile:
+        for data, verse_stats in tqdm(range_align_verses(processed_data, args.workers, args.chunksize), total=len(processed_data)):
+            stats.update(verse_stats)
+            outfile.write(json.dumps(data, ensure_ascii=False) + '\n')
+    print(f"{stats['macula_tokens_not_matched']} macula tokens were not matched")
+
+if __name__ == '__main__':
+    main()
 
 # TODO: add a coverage report for outputs like the following
 '''
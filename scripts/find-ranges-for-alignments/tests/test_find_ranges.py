@@ -0,0 +1,118 @@
+import unittest
+import importlib.util
+import copy
+import os
+import sys
+from unittest import mock
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'find-ranges-for-alignments.py')
+
+
+def load_script():
+    """The script's name has dashes, so it's loaded from its path rather than imported"""
+    spec = importlib.util.spec_from_file_location('find_ranges_for_alignments', SCRIPT_PATH)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+
+def make_verse(i: int) -> dict:
+    return {
+        'vref': f'GEN 1:{i}',
+        'bsb': {'content': f'And God  said, let there be light number {i}.'},
+        'macula': {
+            'content': 'וַיֹּ֣אמֶר אֱלֹהִ֗ים יְהִ֣י א֑וֹר',
+            'token_ids': [{'text': text, 'id': f'o0100{i}00{j}'} for j, text in enumerate(['וַיֹּ֣אמֶר', 'אֱלֹהִ֗ים', 'יְהִ֣י', 'אור'])],
+        },
+        'target': {'content': f'Y dijo Dios: Sea la luz {i}.'},
+        'alignments': [
+            {'English phrase': 'And God said,', 'Macula phrase': 'וַיֹּ֣אמֶר אֱלֹהִ֗ים', 'Target phrase': 'Y dijo Dios:'},
+            {'English phrase': 'Let there be light', 'Macula phrase': 'יהי אור', 'Target phrase': f'sea la luz {i}'},
+        ],
+    }
+
+
+class TestFindRanges(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.script = load_script()
+
+    def test_overlapping_occurrences(self):
+        # 'ana' occurs at 0, 4 and 6; the one at 6 overlaps the one at 4, so the third search only gets what's left
+        state = self.script.MatchState('ana anana')
+        self.assertEqual(self.script.find_ranges(state, 'ana'), self.script.RangeResult(0, 2))
+        self.assertEqual(self.script.find_ranges(state, 'ana'), self.script.RangeResult(4, 6))
+        self.assertEqual(self.script.find_ranges(state, 'ana'), self.script.RangeResult(7, 8))
+        self.assertEqual(self.script.find_ranges(state, 'ana'), self.script.RangeResult(-1, -1))
+        self.assertEqual(state.unmatched, 1)
+
+    def test_double_spaces(self):
+        # fuzzy matches map back to the original character offsets, whatever the whitespace between tokens
+        state = self.script.MatchState('In  the  beginning God')
+        self.assertEqual(self.script.find_ranges(state, 'the  Beginning,'), self.script.RangeResult(4, 17))
+        self.assertEqual(self.script.find_ranges(state, 'god'), self.script.RangeResult(19, 21))
+        self.assertEqual(self.script.find_ranges(state, 'In'), self.script.RangeResult(0, 1))
+
+    def test_partly_consumed_token(self):
+        state = self.script.MatchState('seed-bearing plants')
+        self.assertEqual(self.script.find_ranges(state, 'seed'), self.script.RangeResult(0, 3))
+        self.assertEqual(state.token_text, ['bearing', 'plants'])
+        self.assertEqual(state.get_candidates(2), [(0, 12, 'bearing'), (13, 19, 'plants'), (0, 19, 'bearing plants')])
+        # the match starts after the consumed prefix, and uses up both tokens
+        self.assertEqual(self.script.find_ranges(state, 'Bearing Plants'), self.script.RangeResult(4, 18))
+        self.assertEqual(state.token_consumed, [True, True])
+        self.assertEqual(state.get_candidates(2), [])
+
+    def test_candidates_skip_consumed_tokens(self):
+        state = self.script.MatchState('a b c d')
+        self.assertEqual(self.script.find_ranges(state, 'b'), self.script.RangeResult(2, 2))
+        self.assertEqual(state.get_candidates(1), [(0, 1, 'a'), (4, 5, 'c'), (6, 7, 'd'), (4, 7, 'c d')])
+
+    def test_candidate_sizes_are_bounded_by_the_query(self):
+        state = self.script.MatchState('a b c d e f g h')
+        sizes = lambda query_size: sorted({len(text.split()) for _, _, text in state.get_candidates(query_size)})
+        self.assertEqual(sizes(1), [1, 2])
+        self.assertEqual(sizes(4), [2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(sizes(8), [4, 5, 6, 7, 8])
+        # the 2-token span 'beginning word' is too short for a 6-token phrase, so the best 3-token span is taken
+        state = self.script.MatchState('zz yy beginning word xx')
+        self.assertEqual(self.script.find_ranges(state, 'in the beginning was the word'), self.script.RangeResult(3, 19))
+
+
+class TestRangeAlignVerses(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.script = load_script()
+        # The pool pickles the script's functions by module name, so the module must be registered while the tests run
+        patcher = mock.patch.dict(sys.modules, {cls.script.__name__: cls.script})
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
+    def test_workers_match_serial(self):
+        verses = [make_verse(i) for i in range(1, 12)]
+        serial = list(self.script.range_align_verses(copy.deepcopy(verses)))
+        parallel = list(self.script.range_align_verses(copy.deepcopy(verses), workers=2, chunksize=2)) # more chunks than are let in flight
+        self.assertEqual(parallel, serial)
+        self.assertEqual([data['vref'] for data, _ in parallel], [verse['vref'] for verse in verses])
+        self.assertEqual(sum(stats['verses'] for _, stats in serial), len(verses))
+        self.assertIn('range', serial[0][0]['macula']['token_ids'][0])
+
+    def test_backpressure(self):
+        pulled = []
+
+        def verses():
+            for i in range(1, 50):
+                pulled.append(i)
+                yield make_verse(i)
+
+        results = self.script.range_align_verses(verses(), workers=2, chunksize=1)
+        data, _ = next(results)
+        self.assertEqual(data['vref'], 'GEN 1:1')
+        self.assertEqual(len(pulled), 4) # two chunks per worker, until the first result is taken
+        results.close()
+
+
+if __name__ == '__main__':
+    unittest.main()